@@ -26,56 +26,72 @@ StreamSet = (function() {
     this.scale_z = d3.scale.linear();
   }
 
+  // keep in sync with StreamsHandler.MAX_ACTIVITIES
+  var STREAM_BATCH_SIZE = 50;
+
   /**
-   * Get a stream and attach it to the activity. Returns a promise
-   * that resolves to a copy of the activity, and a 'stream' property
-   * with stream data.
+   * Attach stream data from /api/streams to the activity, as a
+   * 'stream' property with stream data and a geojson feature.
    */
-  StreamSet.prototype.load_stream_ = function(activity) {
-    var activity_id = activity.activity_id;
-    if (activity.stream)
-      return Promise.resolve(activity);
-    return this.xhr_('/api/streams', {activity_id: activity_id,
+  function attach_stream(activity, stream) {
+    activity.stream = stream;
+    if (!stream.latlng ||
+        !stream.latlng.data) {
+      console.log("Missing latlng: ", stream.latlng);
+      return activity;
+    }
+    var geojson = {
+      type: 'Feature',
+      geometry: {
+        type: 'LineString',
+        coordinates: stream.latlng.data.map(function(latlng, i) {
+          // geojson uses lnglat
+          var altitude = stream.altitude &&
+                stream.altitude.data &&
+                stream.altitude.data[i] || 0;
+          return [latlng[1], latlng[0], altitude];
+        })
+      }
+    };
+    stream.geojson = geojson;
+    return activity;
+  }
+
+  /**
+   * Get the streams for a batch of activities in one request, and
+   * attach them to the activities. Returns a promise that resolves
+   * to the activities.
+   */
+  StreamSet.prototype.load_stream_batch_ = function(activities) {
+    var activity_ids = activities.map(accessor('activity_id'));
+    return this.xhr_('/api/streams', {activity_id: activity_ids,
                                       resolution: this.resolution })
       .then(function(streams) {
-        var stream = streams.result.streams[activity_id];
-        activity.stream = stream;
-        if (!stream.latlng ||
-            !stream.latlng.data) {
-          console.log("Missing latlng: ", stream.latlng);
-          return activity;
+        if (streams.result.missing && streams.result.missing.length) {
+          console.log("Streams not stored yet: ", streams.result.missing);
         }
-        var geojson = {
-          type: 'Feature',
-          geometry: {
-            type: 'LineString',
-            coordinates: stream.latlng.data.map(function(latlng, i) {
-              // geojson uses lnglat
-              var altitude = stream.altitude &&
-                    stream.altitude.data &&
-                    stream.altitude.data[i] || 0;
-              return [latlng[1], latlng[0], altitude];
-            })
-          }
-        };
-        stream.geojson = geojson;
-        return activity;
+        return activities.map(function(activity) {
+          return attach_stream(activity,
+                               streams.result.streams[activity.activity_id] || {});
+        });
       });
   };
 
-
   /**
    * Returns a promise that resolves the an array of all activities.
    */
   StreamSet.prototype.load_streams_ = function(activities) {
+    var pending = activities.filter(function(activity) {
+      return !activity.stream;
+    });
     var results = [];
-    for (var i = 0; i < activities.length; ++i) {
-      results.push(this.load_stream_(activities[i]));
+    for (var i = 0; i < pending.length; i += STREAM_BATCH_SIZE) {
+      results.push(this.load_stream_batch_(pending.slice(i, i + STREAM_BATCH_SIZE)));
     }
     return Promise.all(results)
       .then(function(e) {
-        console.log("Streams loaded (", results.length, ')');
-        return e;
+        console.log("Streams loaded (", pending.length, ')');
+        return activities;
       });
   };
 
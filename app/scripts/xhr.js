@@ -22,9 +22,12 @@ function XHRContext(progress) {
         if (params) {
             var p = [];
             for (var key in params) {
-                var value = params[key] || '';
-                p.push(encodeURIComponent(key) + '=' +
-                       encodeURIComponent(value));
+                // arrays become repeated parameters
+                var values = [].concat(params[key]);
+                for (var i = 0; i < values.length; i++) {
+                    p.push(encodeURIComponent(key) + '=' +
+                           encodeURIComponent(values[i] || ''));
+                }
             }
             url += '?' + p.join('&');
         }
@@ -0,0 +1,67 @@
+"""
+How long a fresh instance takes to import main.app, and then to load
+each handler the first time a request needs it.
+
+Every run is a new interpreter, so nothing is already imported. Each
+run prints raceways.startup's report as JSON, and the medians over the
+runs are shown.
+
+Usage::
+
+    python benchmarks/cold_start.py [runs]
+
+Needs the App Engine SDK and the app's libraries on the path.
+"""
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+RUNS = 10
+
+# run in the child interpreter
+CHILD = """
+import json, time
+start = time.time()
+import main
+imported = time.time() - start
+from raceways import startup
+for route in main.app.router.match_routes:
+    main.app.router.load_handler(route.handler)
+result = startup.report()
+result['import main'] = round(imported * 1000, 1)
+print json.dumps(result)
+"""
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT)
+    return json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main(runs=RUNS):
+    results = [run_once() for i in xrange(runs)]
+    names = []
+    for result in results:
+        for name in result:
+            if name not in names:
+                names.append(name)
+    print "{:<60} {:>10} {:>10}".format('', 'median ms', 'max ms')
+    for name in names:
+        values = [result[name] for result in results if name in result]
+        print "{:<60} {:>10.1f} {:>10.1f}".format(name, median(values), max(values))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,90 @@
+"""
+How raceways.routes clustering scales with the number of activities.
+
+A synthetic athlete rides ROUTES different routes from the same few
+start points, each with GPS noise, plus some one-off rides. Tracks are
+simplified the way they are at ingest (raceways.simplify), then
+clustered. Reports the time taken and how many candidates got past each
+stage of the prefilter.
+
+Usage::
+
+    python benchmarks/route_clustering.py [activities ...]
+
+Needs the App Engine SDK on the path, for raceways.routes' imports.
+"""
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from raceways import routes
+from raceways import simplify
+
+ROUTES = 60
+ONE_OFF_FRACTION = 0.2
+POINTS = 1000
+STARTS = [(37.774929, -122.419416), (37.804363, -122.271111), (37.441883, -122.143019)]
+
+
+def random_walk(rng, start, points):
+    lat, lng = start
+    heading = rng.uniform(0, 2 * math.pi)
+    result = []
+    for i in xrange(points):
+        heading += rng.uniform(-0.2, 0.2)
+        lat += 0.0001 * math.cos(heading)
+        lng += 0.0001 * math.sin(heading)
+        result.append((lat, lng))
+    # ride home again
+    return result + result[-2::-1]
+
+
+def make_activities(count, seed=42):
+    rng = random.Random(seed)
+    base_routes = [random_walk(rng, rng.choice(STARTS), POINTS // 2) for i in xrange(ROUTES)]
+    activities = []
+    for activity_id in xrange(count):
+        if rng.random() < ONE_OFF_FRACTION:
+            track = random_walk(rng, rng.choice(STARTS), POINTS // 2)
+        else:
+            track = rng.choice(base_routes)
+        # about 10m of GPS noise
+        activities.append([(lat + rng.gauss(0, 0.0001), lng + rng.gauss(0, 0.0001))
+                           for lat, lng in track])
+    return activities
+
+
+def simplified_tracks(activities):
+    tracks = []
+    for activity_id, latlng in enumerate(activities):
+        significances = simplify.significance(latlng)
+        kept = simplify.kept_indices(significances, routes.SIMPLIFY_TOLERANCE)
+        tracks.append(routes.make_track(activity_id, [latlng[index] for index in kept]))
+    return tracks
+
+
+def main(*counts):
+    counts = counts or (500, 1000, 2000, 5000)
+    all_tracks = simplified_tracks(make_activities(max(counts)))
+    print "{:>10} {:>8} {:>10} {:>12} {:>12} {:>10}".format(
+        'activities', 'routes', 'recurring', 'candidates', 'frechet', 'seconds')
+    for count in counts:
+        clusterer = routes.Clusterer()
+        start = time.time()
+        for track in all_tracks[:count]:
+            clusterer.add(track)
+        elapsed = time.time() - start
+        recurring = sum(1 for route in clusterer.routes
+                        if len(route) >= routes.MIN_ACTIVITIES)
+        print "{:>10} {:>8} {:>10} {:>12} {:>12} {:>10.2f}".format(
+            count, len(clusterer.routes), recurring,
+            clusterer.stats['cell_candidates'], clusterer.stats['frechet_comparisons'],
+            elapsed)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,83 @@
+"""
+Compare the size and decode time of the packed stream encoding against
+the JSON encoding used by version 4 Stream entities.
+
+Usage::
+
+    python benchmarks/stream_encoding.py [points]
+
+If the App Engine SDK is importable the serialized entity sizes are
+reported too, otherwise only the stored payloads are compared.
+"""
+import json
+import math
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from raceways import encoding
+
+
+def make_ride(points):
+    """
+    A synthetic ride: a random walk around San Francisco at strava's
+    6 decimal places, with altitude to 0.1m.
+    """
+    rng = random.Random(42)
+    lat, lng, alt = 37.774929, -122.419416, 20.0
+    latlng = []
+    altitude = []
+    heading = 0.0
+    for i in xrange(points):
+        heading += rng.uniform(-0.3, 0.3)
+        lat += 0.00005 * math.cos(heading)
+        lng += 0.00005 * math.sin(heading)
+        alt = max(0.0, alt + rng.uniform(-0.5, 0.5))
+        latlng.append([round(lat, 6), round(lng, 6)])
+        altitude.append(round(alt, 1))
+    return {'latlng': latlng, 'altitude': altitude}
+
+
+def entity_size(stream_type, data, packed):
+    try:
+        from google.appengine.ext import ndb
+        from raceways import model
+    except ImportError:
+        return None
+    stream = model.Stream(id=model.Stream.make_key_string(1, stream_type))
+    stream.type = stream_type
+    if packed:
+        stream.set_data(data)
+    else:
+        stream.data = data
+    return len(ndb.ModelAdapter().entity_to_pb(stream).Encode())
+
+
+def main(points=10000, repeat=20):
+    ride = make_ride(points)
+    print "{:>10} {:>14} {:>12} {:>12} {:>12}".format(
+        'stream', 'format', 'bytes', 'entity', 'decode ms')
+    for stream_type, data in sorted(ride.iteritems()):
+        as_json = json.dumps(data)
+        name, blob = encoding.encode_stream(stream_type, data)
+        assert encoding.decode_stream(stream_type, name, blob) == data
+
+        json_time = timeit.timeit(lambda: json.loads(as_json), number=repeat)
+        packed_time = timeit.timeit(
+            lambda: encoding.decode_stream(stream_type, name, blob),
+            number=repeat)
+
+        for label, size, elapsed, packed in (
+                ('json', len(as_json), json_time, False),
+                (name, len(blob), packed_time, True)):
+            print "{:>10} {:>14} {:>12} {:>12} {:>12.2f}".format(
+                stream_type, label, size,
+                entity_size(stream_type, data, packed) or '-',
+                elapsed * 1000 / repeat)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -14,54 +14,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import webapp2
-import httplib2
-import urllib
-import json
+import time
+
+from raceways import startup
 
-from google.appengine.api import oauth, users, memcache, urlfetch
+import webapp2
 
-from requests.packages import urllib3
 
-from raceways import JINJA_ENVIRONMENT
-from raceways.handler import BaseHandler
-from raceways.handlers.login import LoginHandler, LogoutHandler
-from raceways.handlers.homepage import HomepageHandler
-from raceways.handlers.oauthhandler import OauthCallbackHandler
-from raceways.handlers.profile import ProfileHandler
-from raceways.handlers.update import UpdateHandler
-from raceways.handlers.activities import ActivitiesHandler
-from raceways.handlers.streams import StreamsHandler
-from raceways.handlers.user_info import UserInfoHandler
+class LazyRouter(webapp2.Router):
+    """
+    Router that times the import of handlers given as strings, which
+    are only imported when a request first matches them.
+    """
+    def load_handler(self, handler):
+        if isinstance(handler, basestring):
+            if handler not in self.handlers:
+                with startup.timed(handler):
+                    self.handlers[handler] = webapp2.import_string(handler)
+            handler = self.handlers[handler]
+        return handler
 
-from stravalib.client import Client
-from stravalib import unithelper
+    def default_dispatcher(self, request, response):
+        # webapp2.Router.default_dispatcher, with the import timed
+        route, args, kwargs = rv = self.match(request)
+        request.route, request.route_args, request.route_kwargs = rv
+        if route.handler_adapter is None:
+            route.handler_adapter = self.adapt(self.load_handler(route.handler))
+        return route.handler_adapter(request, response)
 
-class DisconnectStravaHandler(BaseHandler):
-    def get(self):
-        if not self.user:
-            print "User wasn't logged in, redirecting"
-            self.redirect(self.request.host_url);
+    # webapp2.Router binds dispatch to its own default_dispatcher
+    dispatch = default_dispatcher
 
-class ConnectHandler(webapp2.RequestHandler):
-    def get(self):
-        pass
+class WSGIApplication(webapp2.WSGIApplication):
+    router_class = LazyRouter
 
 webapp2_config = {}
 webapp2_config['webapp2_extras.sessions'] = {
     'secret_key': 'ldjaf;lksdjf;l  alsjdfl asldkj0q2k'
     }
 
-app = webapp2.WSGIApplication([
-    ('/', HomepageHandler),
-    ('/oauth2callback', OauthCallbackHandler),
-    ('/login', LoginHandler),
-    ('/logout', LogoutHandler),
-    ('/profile', ProfileHandler),
-    ('/api/update', UpdateHandler),
-    ('/api/activities', ActivitiesHandler),
-    ('/api/streams', StreamsHandler),
-    ('/api/user_info', UserInfoHandler),
+# handlers are imported by the router on first use, see raceways.startup
+app = WSGIApplication([
+    ('/', 'raceways.handlers.homepage.HomepageHandler'),
+    ('/oauth2callback', 'raceways.handlers.oauthhandler.OauthCallbackHandler'),
+    ('/login', 'raceways.handlers.login.LoginHandler'),
+    ('/logout', 'raceways.handlers.login.LogoutHandler'),
+    ('/profile', 'raceways.handlers.profile.ProfileHandler'),
+    ('/api/update', 'raceways.handlers.update.UpdateHandler'),
+    ('/api/activities', 'raceways.handlers.activities.ActivitiesHandler'),
+    ('/api/activities/near', 'raceways.handlers.activities.ActivitiesNearHandler'),
+    ('/api/streams', 'raceways.handlers.streams.StreamsHandler'),
+    ('/api/proximity', 'raceways.handlers.proximity.ProximityHandler'),
+    ('/api/user_info', 'raceways.handlers.user_info.UserInfoHandler'),
+    ('/api/jobs', 'raceways.handlers.jobs.JobsHandler'),
+    ('/api/summary', 'raceways.handlers.summary.SummaryHandler'),
+    ('/api/routes', 'raceways.handlers.routes.RoutesHandler'),
+    ('/api/rate_limit', 'raceways.handlers.rate_limit.RateLimitHandler'),
+    ('/api/_stats', 'raceways.handlers.stats.StatsHandler'),
+    ('/tasks/streams', 'raceways.handlers.tasks.StreamTaskHandler'),
+    ('/tasks/routes', 'raceways.handlers.tasks.RouteTaskHandler'),
     ],
                               config=webapp2_config,
                               debug=True)
+
+startup.record('main', time.time() - startup.STARTED)
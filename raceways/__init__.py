@@ -1,12 +1,19 @@
 import os
-import urllib
 
-import jinja2
+from raceways import startup
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(
-        os.path.join(os.path.dirname(os.path.dirname(__file__)),
-                     'templates')),
-    extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
 
+def make_jinja_environment():
+    import jinja2
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         'templates')),
+        extensions=['jinja2.ext.autoescape'],
+        autoescape=True)
+
+_jinja_environment = startup.Lazy('jinja2', make_jinja_environment)
+
+
+def get_jinja_environment():
+    return _jinja_environment.get()
@@ -0,0 +1,226 @@
+"""
+Read-through caching of stored entities.
+
+Two tiers: a bounded LRU in the instance's memory, then memcache, then
+the datastore. Values are kept pickled and compressed in both tiers,
+so the LRU can evict by their real size.
+
+Each TieredCache has a namespace, which should include every version
+that changes the cached values (Stream.version, client.KEY_VERSION),
+so bumping a version invalidates everything cached under the old one.
+Single entries are invalidated with delete_multi().
+"""
+import cPickle as pickle
+import threading
+import zlib
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from raceways import instrumentation
+from raceways import model
+from raceways import simplify
+
+MAX_LOCAL_BYTES = 16 * 1024 * 1024
+
+# memcache won't take values bigger than 1MB
+MAX_MEMCACHE_BYTES = 1000000
+
+
+def serialize(value):
+    return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def deserialize(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of byte strings, holding at most
+    max_bytes.
+    """
+    def __init__(self, max_bytes=MAX_LOCAL_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            blob = self.entries.pop(key, None)
+            if blob is not None:
+                self.entries[key] = blob
+            return blob
+
+    def set(self, key, blob):
+        if len(blob) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = blob
+            self.size += len(blob)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# shared by every TieredCache in the instance
+local_cache = LRUCache()
+
+# every TieredCache, for their stats
+caches = []
+
+
+class TieredCache(object):
+    def __init__(self, namespace, local=None, use_memcache=True):
+        self.namespace = namespace
+        self.local = local or local_cache
+        self.use_memcache = use_memcache
+        self.local_hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+        caches.append(self)
+
+    def get_blobs(self, keys):
+        """
+        Returns a dict of the serialized values for whichever keys are
+        cached.
+        """
+        result = {}
+        missing = []
+        memcache_hits = 0
+        for key in keys:
+            blob = self.local.get((self.namespace, key))
+            if blob is None:
+                missing.append(key)
+            else:
+                result[key] = blob
+        self.local_hits += len(result)
+
+        if missing and self.use_memcache:
+            found = memcache.get_multi(missing, namespace=self.namespace)
+            for key, blob in found.iteritems():
+                self.local.set((self.namespace, key), blob)
+            result.update(found)
+            memcache_hits = len(found)
+            self.memcache_hits += memcache_hits
+
+        self.misses += len(keys) - len(result)
+        instrumentation.count('cache.local_hits', len(result) - memcache_hits)
+        instrumentation.count('cache.memcache_hits', memcache_hits)
+        instrumentation.count('cache.misses', len(keys) - len(result))
+        return result
+
+    def get_multi(self, keys):
+        """
+        Returns a dict of the cached values for whichever keys are
+        cached.
+        """
+        return dict((key, deserialize(blob))
+                    for key, blob in self.get_blobs(keys).iteritems())
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def set_multi(self, mapping):
+        blobs = {}
+        for key, value in mapping.iteritems():
+            blob = serialize(value)
+            self.local.set((self.namespace, key), blob)
+            if len(blob) <= MAX_MEMCACHE_BYTES:
+                blobs[key] = blob
+        if blobs and self.use_memcache:
+            memcache.set_multi(blobs, namespace=self.namespace)
+
+    def set(self, key, value):
+        self.set_multi({key: value})
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.local.delete((self.namespace, key))
+        if self.use_memcache:
+            memcache.delete_multi(keys, namespace=self.namespace)
+
+    def stats(self):
+        lookups = self.local_hits + self.memcache_hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'local_hits': self.local_hits,
+            'memcache_hits': self.memcache_hits,
+            'misses': self.misses,
+            'hit_ratio': lookups and float(lookups - self.misses) / lookups,
+            }
+
+
+stream_cache = TieredCache('streams|v={}'.format(model.Stream.version))
+
+
+@ndb.tasklet
+def get_stream_dicts_async(requests, resolution=None, tolerance=None, lazy=False):
+    """
+    Cached version of model.Stream.get_multi_async(), returning
+    Stream.to_dict() results (or None) for the (activity_id,
+    stream_type) pairs in requests, simplified to tolerance.
+
+    With lazy=True, callables that produce the dicts are returned
+    instead, so that decoding can wait until the dict is needed.
+    """
+    keys = [stream_cache_key(activity_id, stream_type, resolution, tolerance)
+            for activity_id, stream_type in requests]
+    blobs = stream_cache.get_blobs(keys)
+
+    missing = [index for index, key in enumerate(keys) if key not in blobs]
+    streams = yield model.Stream.get_multi_async([requests[index] for index in missing],
+                                                 resolution=resolution)
+
+    loaders = {}
+    for key, blob in blobs.iteritems():
+        loaders[key] = lambda blob=blob: deserialize(blob)
+    for index, stream in zip(missing, streams):
+        # missing streams aren't cached, they may show up any time
+        if stream is not None:
+            loaders[keys[index]] = _stream_loader(keys[index], stream, tolerance)
+
+    if lazy:
+        raise ndb.Return([loaders.get(key) for key in keys])
+    raise ndb.Return([loaders[key]() if key in loaders else None for key in keys])
+
+
+def _stream_loader(key, stream, tolerance):
+    def load():
+        value = stream.to_dict(tolerance=tolerance)
+        stream_cache.set(key, value)
+        return value
+    return load
+
+
+def stream_cache_key(activity_id, stream_type, resolution=None, tolerance=None):
+    key = model.Stream.make_key_string(activity_id, stream_type, resolution=resolution)
+    if tolerance:
+        key += "|tolerance={}".format(tolerance)
+    return key
+
+
+def invalidate_streams(requests, resolution=None):
+    # the other resolutions may have been derived from this one
+    resolutions = set([resolution]) | set(model.Stream.RESOLUTION_POINTS)
+    stream_cache.delete_multi([
+        stream_cache_key(activity_id, stream_type, stream_resolution, tolerance)
+        for activity_id, stream_type in requests
+        for stream_resolution in resolutions
+        for tolerance in simplify.LEVELS])
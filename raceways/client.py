@@ -1,18 +1,18 @@
 
 import urllib
-import json
+import logging
 from functools import wraps
-import time
 from raceways.model import Athlete, Stream
+from raceways import cache
+from raceways import instrumentation
 from google.appengine.ext import ndb
 
 def jsonresponse(f):
     @wraps(f)
     def reply(*args, **kwds):
-        now = time.time()
-        headers, body = f(*args, **kwds)
-        print "Uncached handler took {}s".format(time.time() - now)
-        return json.loads(body)
+        with instrumentation.span('client.' + f.__name__):
+            headers, body = f(*args, **kwds)
+        return instrumentation.json_loads(body)
     return reply
 
 api_prefix = 'https://www.strava.com/api/v3/'
@@ -28,7 +28,7 @@ def api_call(name, *url_segments, **params):
 
     if params:
         url += "?" + urllib.urlencode(sorted(kwds.iteritems()))
-    print "Requesting {}".format(url)
+    logging.debug("Requesting %s", url)
     return url
 
 KEY_VERSION = 1
@@ -56,6 +56,9 @@ def entity(ModelClass, subkey=None):
     """
     def decorator(f):
         f.model_class = ModelClass
+        entity_cache = cache.TieredCache('entity|{}|v={}'.format(ModelClass.__name__,
+                                                                 KEY_VERSION))
+        f.entity_cache = entity_cache
         @wraps(f)
         def wrapper(self, id=None, *args, **kwds):
             if id is not None:
@@ -65,13 +68,17 @@ def entity(ModelClass, subkey=None):
                 if kwds:
                     entity_id += "|" + "|".join("{}={}".format(key, value)
                                                 for key,value in kwds.iteritems())
+                cached = entity_cache.get(entity_id)
+                if cached is not None:
+                    return cached
                 model_entity = ModelClass.get_by_id(entity_id)
                 if model_entity is not None:
-                    return model_entity.to_dict()
-            now = time.time()
-            header, body = f(self, id=id, *args, **kwds)
-            print "Took {}s".format(time.time() - now)
-            json_data = json.loads(body)
+                    result = model_entity.to_dict()
+                    entity_cache.set(entity_id, result)
+                    return result
+            with instrumentation.span('client.' + f.__name__):
+                header, body = f(self, id=id, *args, **kwds)
+            json_data = instrumentation.json_loads(body)
             # this is a massive hack to deal with streams which return dictionary objects?!
             if subkey:
                 subkey_value = kwds.get(subkey)
@@ -84,10 +91,17 @@ def entity(ModelClass, subkey=None):
                 json_data = new_data
 
             model_entity = ModelClass(id=entity_id)
+            packs_data = hasattr(model_entity, 'set_data')
             for key, value in json_data.iteritems():
-                if key != 'id':
-                    setattr(model_entity, key, value)
-            model_entity.put()
+                if key == 'id' or (packs_data and key == 'data'):
+                    continue
+                setattr(model_entity, key, value)
+            if packs_data and 'data' in json_data:
+                model_entity.set_data(json_data['data'])
+            # whoever did the actual fetch stores the entity
+            if not getattr(header, 'shared', False):
+                model_entity.put()
+                entity_cache.set(entity_id, model_entity.to_dict())
             return json_data
             
         return wrapper
@@ -95,19 +109,37 @@ def entity(ModelClass, subkey=None):
     
 
 class StravaClient(object):
-    def __init__(self, http):
-        self.http = http
+    """
+    Blocking calls to the strava API, made through an
+    AuthRequestContext so they share its transport, rate limiting and
+    token refreshes with the asynchronous ones.
+    """
+    def __init__(self, arc):
+        self.arc = arc
+
+    @ndb.tasklet
+    def request_async(self, url):
+        """
+        Returns a tuple of (response, body). Concurrent requests for
+        the same url share one fetch, in which case response.shared is
+        True.
+        """
+        response = yield self.arc.urlfetch(url, coalesce=True)
+        raise ndb.Return((response, response.content))
+
+    def request(self, url):
+        return self.request_async(url).get_result()
 
     @entity(Athlete)
     def athlete(self, id=None):
-        return self.http.request(api_call('athlete', id=id))
+        return self.request(api_call('athlete', id=id))
 
     @jsonresponse
     def athlete_activities(self, id=None, before=None, after=None, page=None, per_page=None):
-        return self.http.request(api_call('athlete/activities', id=id, before=before, after=after, page=page, per_page=per_page))
+        return self.request(api_call('athlete/activities', id=id, before=before, after=after, page=page, per_page=per_page))
 
 
     @entity(Stream, subkey='type')
     def activity_stream(self, id=None, type=None, resolution=None, series_type=None):
-        return self.http.request(api_call('activities', str(id), 'streams', type,
+        return self.request(api_call('activities', str(id), 'streams', type,
                                           resolution=resolution, series_type=series_type))
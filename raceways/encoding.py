@@ -0,0 +1,182 @@
+"""
+Compact binary encodings for stream data.
+
+Strava streams are long lists of numbers (or [lat, lng] pairs for the
+latlng stream). Storing them as JSON makes the entities large and slow
+to decode, so instead we store them as delta-encoded fixed-point int32
+arrays, optionally zlib-compressed.
+
+An encoding is described by a short string such as 'delta-e7/zlib':
+the scheme ('delta' or 'json'), the decimal exponent used for the
+fixed-point conversion, and an optional compression suffix.
+"""
+import json
+import sys
+import zlib
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # the pure python path below is used instead, it is just slower
+    numpy = None
+
+JSON = 'json'
+DELTA = 'delta'
+ZLIB = 'zlib'
+
+# latlng gets 7 decimal places (~1cm), which is more than strava sends
+LATLNG_EXPONENT = 7
+# everything else (altitude, distance, velocity, ...) gets centi-units
+SCALAR_EXPONENT = 2
+
+def _to_bytes(values):
+    # raises OverflowError for anything that doesn't fit in an int32
+    packed = array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def _from_bytes(blob):
+    packed = array('i')
+    packed.fromstring(blob)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed
+
+
+def _fixed_point(values, exponent):
+    scale = 10 ** exponent
+    return [int(round(value * scale)) for value in values]
+
+
+def _delta(values, width):
+    """
+    Replace each value with its difference from the value `width`
+    slots earlier, so interleaved channels (lat, lng) delta separately.
+    """
+    return values[:width] + [values[i] - values[i - width]
+                             for i in xrange(width, len(values))]
+
+
+def _undelta(values, width):
+    for i in xrange(width, len(values)):
+        values[i] += values[i - width]
+    return values
+
+
+def _is_number(value):
+    return (isinstance(value, (int, long, float)) and
+            not isinstance(value, bool))
+
+
+def choose_encoding(stream_type, data):
+    """
+    Pick the best encoding for the given stream. Returns a tuple of
+    (scheme, exponent, width).
+    """
+    if not data:
+        return JSON, 0, 1
+    if stream_type == 'latlng':
+        if all(isinstance(pair, (list, tuple)) and len(pair) == 2 and
+               _is_number(pair[0]) and _is_number(pair[1]) for pair in data):
+            return DELTA, LATLNG_EXPONENT, 2
+        return JSON, 0, 1
+    if all(isinstance(value, (int, long)) and not isinstance(value, bool)
+           for value in data):
+        return DELTA, 0, 1
+    if all(_is_number(value) for value in data):
+        return DELTA, SCALAR_EXPONENT, 1
+    return JSON, 0, 1
+
+
+def encoding_name(scheme, exponent, compressed):
+    name = scheme
+    if scheme == DELTA:
+        name += '-e{}'.format(exponent)
+    if compressed:
+        name += '/' + ZLIB
+    return name
+
+
+def parse_encoding(name):
+    """
+    Returns (scheme, exponent, compressed) for an encoding name.
+    """
+    parts = name.split('/')
+    compressed = ZLIB in parts[1:]
+    scheme = parts[0]
+    exponent = 0
+    if scheme.startswith(DELTA + '-e'):
+        exponent = int(scheme[len(DELTA) + 2:])
+        scheme = DELTA
+    elif scheme != JSON:
+        raise ValueError("Unknown stream encoding '{}'".format(name))
+    return scheme, exponent, compressed
+
+
+def encode_stream(stream_type, data, compress=True):
+    """
+    Encode stream data, returning a tuple of (encoding_name, blob).
+    """
+    scheme, exponent, width = choose_encoding(stream_type, data)
+    if scheme == DELTA:
+        if width == 2:
+            flat = [value for pair in data for value in pair]
+        else:
+            flat = data
+        try:
+            blob = _to_bytes(_delta(_fixed_point(flat, exponent), width))
+        except OverflowError:
+            scheme, exponent = JSON, 0
+    if scheme == JSON:
+        blob = json.dumps(data, separators=(',', ':'))
+
+    if compress:
+        blob = zlib.compress(blob, 6)
+    return encoding_name(scheme, exponent, compress), blob
+
+
+def _decode_numpy(blob, exponent, width):
+    values = numpy.frombuffer(blob, dtype='<i4').astype(numpy.int64)
+    values = values.reshape(-1, width).cumsum(axis=0)
+    if exponent:
+        values = values / float(10 ** exponent)
+    if width == 1:
+        values = values.reshape(-1)
+    return values.tolist()
+
+
+def decode_stream(stream_type, name, blob):
+    """
+    Decode a blob produced by encode_stream() back to a list.
+    """
+    scheme, exponent, compressed = parse_encoding(name)
+    if compressed:
+        blob = zlib.decompress(blob)
+    if scheme == JSON:
+        return json.loads(blob)
+
+    width = 2 if stream_type == 'latlng' else 1
+    if numpy is not None:
+        return _decode_numpy(blob, exponent, width)
+    values = _undelta(_from_bytes(blob).tolist(), width)
+    if exponent:
+        scale = float(10 ** exponent)
+        values = [value / scale for value in values]
+    if width == 2:
+        return [[values[i], values[i + 1]] for i in xrange(0, len(values), 2)]
+    return values
+
+
+def pack_ints(values):
+    """
+    A compressed int32 array, for index-like data that doesn't need a
+    stream encoding.
+    """
+    return zlib.compress(_to_bytes(list(values)))
+
+
+def unpack_ints(blob):
+    return _from_bytes(zlib.decompress(blob)).tolist()
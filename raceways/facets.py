@@ -0,0 +1,133 @@
+"""
+Server side version of Dataset.run_filters_().
+
+For each athlete a model.FacetIndex maps every value of every facet
+(type, gear, commute, ...) to the sorted ids of the activities that
+have it. A filter is then a union of those id lists within each facet
+and an intersection across facets, without loading any activities.
+
+Like raceways.summary, the index is built from the stored activities
+the first time it is needed, and updated as UpdateHandler writes new
+activities.
+"""
+import bisect
+import datetime
+
+import numpy
+from google.appengine.ext import ndb
+
+from raceways import model
+
+# same names as the FACETS day_of_week display in profile.js
+DAYS = ("Sun", "Mon", "Tue", "Wed", "Thurs", "Fri", "Sat")
+
+FACETS = ('type', 'gear_id', 'commute', 'trainer', 'location_city',
+          'year', 'month', 'day_of_week')
+
+
+def facet_values(activity):
+    """
+    The value of every facet for an activity, as strings.
+    """
+    values = {
+        'type': activity.type or '',
+        'gear_id': activity.gear_id or '',
+        'commute': 'true' if activity.commute else 'false',
+        'trainer': 'true' if activity.trainer else 'false',
+        'location_city': activity.location_city or '',
+        }
+    # strava dates look like 2014-06-01T07:30:00Z
+    start_date = activity.start_date_local or activity.start_date
+    if start_date:
+        day = datetime.datetime.strptime(start_date[:10], '%Y-%m-%d').date()
+        values['year'] = str(day.year)
+        values['month'] = start_date[:7]
+        values['day_of_week'] = DAYS[day.isoweekday() % 7]
+    return values
+
+
+def add_activity(postings, activity):
+    activity_id = activity.key.id()
+    for facet, value in facet_values(activity).iteritems():
+        ids = postings.setdefault(facet, {}).setdefault(value, [])
+        index = bisect.bisect_left(ids, activity_id)
+        if index == len(ids) or ids[index] != activity_id:
+            ids.insert(index, activity_id)
+
+
+def parse_filters(params):
+    """
+    Turn facet=name:value parameters into {name: [values]}.
+    """
+    filters = {}
+    for param in params:
+        facet, _, value = param.partition(':')
+        if facet not in FACETS:
+            raise ValueError("Unknown facet: {}".format(facet))
+        filters.setdefault(facet, []).append(value)
+    return filters
+
+
+def match(postings, filters):
+    """
+    Sorted ids of the activities matching filters: any of the values
+    given for a facet, and every facet.
+    """
+    result = None
+    for facet, values in filters.iteritems():
+        ids = numpy.array([], dtype=numpy.int64)
+        for value in values:
+            ids = numpy.union1d(ids, postings.get(facet, {}).get(value, []))
+        if result is None:
+            result = ids
+        else:
+            result = numpy.intersect1d(result, ids)
+        if not len(result):
+            break
+    if result is None:
+        return []
+    return result.astype(numpy.int64).tolist()
+
+
+@ndb.tasklet
+def get_index_async(athlete_id):
+    """
+    The athlete's index, built from the stored activities if there
+    isn't one yet.
+    """
+    index = yield model.FacetIndex.get_by_id_async(int(athlete_id))
+    if index is None:
+        activities = yield model.Activity.query(
+            model.Activity.athlete_id == int(athlete_id)).fetch_async()
+        index = yield _add_activities_async(athlete_id, activities)
+    raise ndb.Return(index)
+
+
+@ndb.tasklet
+def add_activities_async(athlete_id, activities):
+    """
+    Add newly written activities (model.Activity) to the athlete's
+    index.
+    """
+    yield get_index_async(athlete_id)
+    index = yield _add_activities_async(athlete_id, activities)
+    raise ndb.Return(index)
+
+
+@ndb.transactional_tasklet
+def _add_activities_async(athlete_id, activities):
+    index = yield model.FacetIndex.get_by_id_async(int(athlete_id))
+    if index is None:
+        index = model.FacetIndex(id=int(athlete_id), postings={})
+    indexed = set(index.activity_ids)
+    added = False
+    for activity in activities:
+        if activity.key.id() in indexed:
+            continue
+        add_activity(index.postings, activity)
+        index.activity_ids.append(activity.key.id())
+        indexed.add(activity.key.id())
+        added = True
+    if added:
+        yield index.put_async()
+    raise ndb.Return(index)
@@ -1,15 +1,14 @@
 import os
+import copy
 import webapp2
-import httplib2
-from stravalib import unithelper
 from functools import wraps
 from datetime import datetime
 import urlparse
 import urllib
 import time
 import json
+import hashlib
 import traceback
-from identitytoolkit import gitkitclient
 
 # for async context
 from google.appengine.ext import ndb
@@ -20,8 +19,16 @@ from oauth2client.appengine import StorageByKeyName
 from oauth2client.client import flow_from_clientsecrets
 
 from raceways.model import RacewaysUser
-from raceways import JINJA_ENVIRONMENT
+from raceways import get_jinja_environment
+from raceways import instrumentation
+from raceways import startup
+from raceways import tokens
+from raceways import transport
 from raceways import util
+from raceways import jsonstream
+from raceways import ratelimit
+from raceways import singleflight
+from raceways import wireformat
 from raceways.client import StravaClient
 
 # CLIENT_SECRETS = os.path.join(os.path.dirname(os.path.dirname(__file__)),
@@ -29,15 +36,49 @@ from raceways.client import StravaClient
 STRAVA_SECRETS = os.path.join(os.path.dirname(os.path.dirname(__file__)),
                               "strava_secret.json")
 
-gitkit_instance = gitkitclient.GitkitClient.FromConfigFile(
-    os.path.join(os.path.dirname(os.path.dirname(__file__)),
-                 "gitkit-server-config.json"))
+GITKIT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             "gitkit-server-config.json")
+
+def make_gitkit_instance():
+    from identitytoolkit import gitkitclient
+    return gitkitclient.GitkitClient.FromConfigFile(GITKIT_CONFIG)
+
+_gitkit_instance = startup.Lazy('gitkit', make_gitkit_instance)
+
+def get_gitkit_instance():
+    return _gitkit_instance.get()
 
 COOKIEMAKER = SecureCookieSerializer('abcd')
 
+# how long a verified gitkit token is trusted without asking gitkit again
+GITKIT_TOKEN_SECONDS = 10 * 60
+
+# how long a user's strava credentials are cached in memcache
+CREDENTIALS_SECONDS = 60 * 60
+
 class NoStravaUser(BaseException):
     pass
 
+class BadRequest(Exception):
+    """
+    Raised by handlers for parameters they can't use. api_handler
+    turns it into a 400, anything else is a 500.
+    """
+    pass
+
+class NotModified(Exception):
+    """
+    Raised by BaseHandler.check_etag() when the client's copy is
+    current. api_handler turns it into a 304.
+    """
+    pass
+
+def make_etag(*parts):
+    """
+    An ETag for a response that is entirely determined by parts.
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
 def using_template(template_name):
     def call_wrapper(f):
         @wraps(f)
@@ -46,7 +87,9 @@ def using_template(template_name):
             template = self.get_template(template_name)
             defaults = self.get_defaults()
             result.update(defaults)
-            self.response.write(template.render(result))
+            with instrumentation.span('template.render'):
+                rendered = template.render(result)
+            self.response.write(rendered)
         return wrapper
     return call_wrapper
 
@@ -69,32 +112,70 @@ def api_handler(f):
         self.response.cache_control.max_age = 30
         self.response.cache_control.no_cache = False
         
-        self.response.headers['content-type'] = 'text/plain'
+        # the App Engine frontend gzips json for clients that accept
+        # it (and won't let us set Content-Encoding ourselves)
+        self.response.headers['content-type'] = 'application/json; charset=utf-8'
 
         # use cors to allow cross-domain requests
         self.response.headers['Access-Control-Allow-Origin'] = '*'
         
-        print "Running wrapper"
+        def write(data):
+            instrumentation.count('bytes.response', len(data))
+            self.response.write(data)
+
         try:
             result = f(self, *args, **kwds)
+            if isinstance(result, wireformat.BinaryResult):
+                self.response.headers['content-type'] = result.content_type
+                with instrumentation.span('binary.encode'):
+                    result.write_to(write)
+                return
+            if isinstance(result, (jsonstream.LazyDict, jsonstream.LazyList)):
+                # streaming mode: write the envelope as the result resolves
+                envelope = jsonstream.LazyDict([
+                    ("status", "SUCCESS"),
+                    ("result", result),
+                    ])
+                # this includes resolving the lazy parts
+                with instrumentation.span('json.encode'):
+                    jsonstream.write_json(write, envelope,
+                                          default=json_default_encode)
+                return
             envelope = {
                 "result": result,
                 "status": "SUCCESS",
                 }
+        except NotModified:
+            self.response.clear()
+            self.response.status_int = 304
+            return
         except Exception as e:
-            tb = traceback.format_exc()
-            envelope = {
-                "result": "ERROR",
-                "messages": [str(e)],
-                "traceback": tb.split('\n')
-                }
-        # print "wrapper done"
-            
-        self.response.write(json.dumps(envelope, indent=4, default=json_default_encode))
+            # drop anything that was already streamed, and the caching
+            # headers check_etag() may have set for the real response
+            self.response.clear()
+            self.response.headers['content-type'] = 'application/json; charset=utf-8'
+            self.response.etag = None
+            del self.response.cache_control
+            self.response.cache_control.no_cache = True
+            self.response.status_int = 400 if isinstance(e, BadRequest) else 500
+            envelope = error_envelope(e)
+        with instrumentation.span('json.encode'):
+            body = json.dumps(envelope, separators=(',', ':'),
+                              default=json_default_encode)
+        write(body)
         
     return wrapper
 
+def error_envelope(e):
+    tb = traceback.format_exc()
+    return {
+        "result": "ERROR",
+        "messages": [str(e)],
+        "traceback": tb.split('\n')
+        }
+
 def ValidateCookie(request, response):
+    from identitytoolkit import gitkitclient
     securetoken = request.cookies['atoken']
     userstring = COOKIEMAKER.deserialize('atoken', securetoken)
     if not userstring:
@@ -103,6 +184,22 @@ def ValidateCookie(request, response):
 
     return gitkitclient.GitkitUser.FromDictionary(json.loads(userstring))
 
+def VerifyGitkitToken(token):
+    """
+    The gitkit client's VerifyGitkitToken(), remembering verified
+    tokens in memcache for GITKIT_TOKEN_SECONDS.
+    """
+    from identitytoolkit import gitkitclient
+    key = hashlib.sha1(token).hexdigest()
+    userstring = memcache.get(key, namespace='gitkit')
+    if userstring is not None:
+        return gitkitclient.GitkitUser.FromDictionary(json.loads(userstring))
+    user = get_gitkit_instance().VerifyGitkitToken(token)
+    if user:
+        memcache.set(key, json.dumps(user.ToRequest()),
+                     time=GITKIT_TOKEN_SECONDS, namespace='gitkit')
+    return user
+
 def SetUserCookie(response, user):
     cookieval = COOKIEMAKER.serialize('atoken', json.dumps(user.ToRequest()))
 
@@ -111,22 +208,15 @@ def SetUserCookie(response, user):
 def authorized(f):
     @wraps(f)
     def wrapper(self, *args, **kwds):
-
-        if 'atoken' in self.request.cookies:
-            self.user = ValidateCookie(self.request, self.response)
-            
-        elif 'gtoken' in self.request.cookies:
-            self.user = gitkit_instance.VerifyGitkitToken(self.request.cookies['gtoken'])
-            if self.user:
-                SetUserCookie(self.response, self.user)
-        if not self.user or not self.strava_storage.get():
+        # dispatch() has already identified the user
+        strava_credentials = self.get_credentials()
+        if not strava_credentials:
             print "Redirecting..."
             return self.redirect('/')
-        strava_credentials = self.strava_storage.get()
 
-        # eventually hope to remove this part!
-        strava_credentials.authorize(self.http)
-        self.arc = AuthRequestContext(strava_credentials)
+        self.arc = AuthRequestContext(strava_credentials,
+                                      athlete_id=credentials_athlete_id(strava_credentials))
+        self.strava = StravaClient(self.arc)
         return f(self, *args, **kwds)
     return wrapper
 
@@ -141,102 +231,233 @@ def ReconstructURL(url, params):
     url_parts[4] = urllib.urlencode(query, doseq=True)
     return urlparse.urlunparse(url_parts)
 
+class ProcessCache(object):
+    """
+    A dict with the get/set interface oauth2client's clientsecrets
+    expects of a cache, so the secrets file is read and parsed once per
+    process rather than on every request.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, namespace=None):
+        return self.values.get((namespace, key))
+
+    def set(self, key, value, namespace=None):
+        self.values[(namespace, key)] = value
+
+class MemcacheTTL(object):
+    """
+    memcache, with an expiry and a namespace, in the shape
+    StorageByKeyName wants of its cache.
+    """
+    def __init__(self, namespace, time):
+        self.namespace = namespace
+        self.time = time
+
+    def get(self, key):
+        return memcache.get(key, namespace=self.namespace)
+
+    def set(self, key, value):
+        memcache.set(key, value, time=self.time, namespace=self.namespace)
+
+    def delete(self, key):
+        memcache.delete(key, namespace=self.namespace)
+
+secrets_cache = ProcessCache()
+
+credentials_cache = MemcacheTTL('credentials', CREDENTIALS_SECONDS)
+
+def get_credentials_storage(user_id):
+    """
+    The StorageByKeyName of a user's strava credentials, read through
+    credentials_cache.
+    """
+    return StorageByKeyName(RacewaysUser, user_id, 'strava_credentials_new',
+                            cache=credentials_cache)
+
+def credentials_athlete_id(credentials):
+    token_response = getattr(credentials, 'token_response', None) or {}
+    return token_response.get('athlete', {}).get('id')
+
 class AuthRequestContext(object):
     """
     Perform asynchronous requests to a given url given a set of
-    credentials. Makes sure that only one refresh is happening at a
-    time.
+    credentials. Expired or rejected tokens are refreshed through
+    raceways.tokens, which makes sure that only one refresh is
+    happening at a time.
+
+    Every request is admitted by the ratelimit scheduler first, with
+    the given priority, and raises ratelimit.RateLimited if strava's
+    quota doesn't allow it right now.
     """
-    def __init__(self, credentials):
+    def __init__(self, credentials, athlete_id=None, priority=ratelimit.INTERACTIVE):
         self.credentials = credentials
-        self.request_futures = set()
+        self.athlete_id = athlete_id
+        self.priority = priority
 
     @ndb.tasklet
-    def _urlfetch(self, url, **kwds):
+    def _urlfetch(self, url, priority=None, **kwds):
         """
-        Same semantics as _urlfetch except that it stores the futures for later
+        Fetch url through the transport, once the ratelimit scheduler
+        admits it.
         """
         # url = ReconstructURL(url, kwds)
-        ctx = ndb.get_context()
-        future = ctx.urlfetch(url, **kwds)
-        self.request_futures.add(future)
-        result = yield future
-        self.request_futures.remove(future)
+        scheduler = ratelimit.get_scheduler()
+        yield scheduler.acquire_async(self.athlete_id, priority or self.priority)
+        try:
+            result = yield transport.get_transport().fetch_async(url, **kwds)
+        finally:
+            scheduler.release()
+        yield scheduler.record_response_async(result.headers, result.status_code)
+        if result.status_code == 429:
+            retry_after = yield scheduler.retry_after_async()
+            raise ratelimit.RateLimited(retry_after)
         raise ndb.Return(result)
 
     @ndb.tasklet
-    def urlfetch(self, url, headers=None, **kwds):
+    def urlfetch(self, url, headers=None, priority=None, coalesce=False, **kwds):
+        """
+        Fetch url with the credentials applied. With coalesce=True,
+        concurrent fetches of the same url share one request (see
+        raceways.singleflight) and a singleflight.FetchedResponse is
+        returned.
+        """
+        if not coalesce:
+            result = yield self._authorized_urlfetch(url, headers=headers,
+                                                     priority=priority, **kwds)
+            raise ndb.Return(result)
+
+        @ndb.tasklet
+        def fetch():
+            result = yield self._authorized_urlfetch(url, headers=headers,
+                                                     priority=priority, **kwds)
+            raise ndb.Return(singleflight.FetchedResponse.from_urlfetch(result))
+
+        result, shared = yield singleflight.get_single_flight().do_async(
+            self._coalesce_key(url), fetch,
+            share=lambda result: result.status_code == 200)
+        if shared:
+            result = copy.copy(result)
+            result.shared = True
+        raise ndb.Return(result)
+
+    def _coalesce_key(self, url):
+        """
+        The singleflight key of url. What strava answers depends on
+        whose token asks, so only fetches made for the same athlete are
+        shared.
+        """
+        return '{}|{}'.format(tokens.identity(self.credentials, self.athlete_id), url)
+
+    @ndb.tasklet
+    def _authorized_urlfetch(self, url, headers=None, priority=None, **kwds):
         if headers is None:
             headers = {}
 
+        coordinator = tokens.get_coordinator()
+        if tokens.needs_refresh(self.credentials):
+            yield coordinator.refresh_async(self.credentials, self.athlete_id)
+
+        access_token = self.credentials.access_token
         self.credentials.apply(headers)
 
-        result = yield self._urlfetch(url, headers=headers, **kwds)
+        result = yield self._urlfetch(url, headers=headers, priority=priority, **kwds)
 
         if result.status_code == 401:
-
-            if self.request_futures:
-                # if there are other outstanding futures, then one of
-                # them will refresh for us?
-                yield self.request_futures
-            else:
-                # ok we're the only outstanding request, we are
-                # responsible for the refresh
-                
-
-                # ugly, using sync HTTP for this part, because the
-                # code in OAuth2Credentials.refresh is too complicated
-                # to copy here right now
-                clean_http = httplib2.Http(memcache)
-                self.credentials.refresh(clean_http) # failure?
-                
-            credentials.apply(headers)
-            result = yield self._urlfetch(url, headers=headers, **kwds)
+            # only refreshes if nobody else has replaced the token yet
+            yield coordinator.refresh_async(self.credentials, self.athlete_id,
+                                            stale_token=access_token)
+            self.credentials.apply(headers)
+            result = yield self._urlfetch(url, headers=headers, priority=priority, **kwds)
 
         raise ndb.Return(result)
-        
+
 class BaseHandler(webapp2.RequestHandler):
     def dispatch(self):
         self.deadline = time.time() + 58        # 60 seconds plus buffer
-        self.http = httplib2.Http(memcache)
-        
-        self.user = None
-        if 'atoken' in self.request.cookies:
-            self.user = ValidateCookie(self.request, self.response)
-        
-        elif 'gtoken' in self.request.cookies:
-            self.user = gitkit_instance.VerifyGitkitToken(self.request.cookies['gtoken'])
+
+        # before authentication, so its RPCs are recorded too
+        instrumentation.start_request(self.request.path)
+        try:
+            self.user = None
+            if 'atoken' in self.request.cookies:
+                self.user = ValidateCookie(self.request, self.response)
+
+            elif 'gtoken' in self.request.cookies:
+                self.user = VerifyGitkitToken(self.request.cookies['gtoken'])
+                if self.user:
+                    SetUserCookie(self.response, self.user)
             if self.user:
-                SetUserCookie(self.response, self.user)
-        if self.user:
-            self.strava_storage = StorageByKeyName(RacewaysUser,
-                                                   self.user.user_id,
-                                                   'strava_credentials_new')
-        # note that authorization has not happened yet
-        self.strava = StravaClient(self.http)
-
-        # where do we use this?
-        self.strava_flow = flow_from_clientsecrets(
+                self.strava_storage = get_credentials_storage(self.user.user_id)
+            # set up by authorized
+            self.strava = None
+
+            webapp2.RequestHandler.dispatch(self)
+        finally:
+            recorder = instrumentation.finish_request()
+            if instrumentation.DEBUG_HEADER in self.request.headers:
+                self.response.headers[instrumentation.STATS_HEADER] = recorder.summary()
+
+    @webapp2.cached_property
+    def strava_flow(self):
+        # only the login pages need this
+        return flow_from_clientsecrets(
             STRAVA_SECRETS,
             scope="view_private",
-            redirect_uri=self.request.host_url + '/login')
-        
-        webapp2.RequestHandler.dispatch(self)
+            redirect_uri=self.request.host_url + '/login',
+            cache=secrets_cache)
+
+    def get_credentials(self):
+        """
+        The user's strava credentials, or None, read at most once per
+        request.
+        """
+        if not hasattr(self, '_strava_credentials'):
+            self._strava_credentials = None
+            if self.user:
+                self._strava_credentials = self.strava_storage.get()
+        return self._strava_credentials
+
+    def check_etag(self, etag, max_age=None, vary=('Cookie',)):
+        """
+        Set the response's ETag, and raise NotModified if the client
+        already has it, before any of the response is built. Responses
+        are per user, so they are only cached privately.
+        """
+        self.response.etag = etag
+        self.response.cache_control.private = True
+        self.response.vary = vary
+        if max_age is not None:
+            self.response.cache_control.max_age = max_age
+        if etag in self.request.if_none_match:
+            raise NotModified()
+
+    def get_int(self, name, default=None):
+        """
+        The request parameter name as an int, default if it is
+        missing. Raises BadRequest if it isn't a number.
+        """
+        value = self.request.get(name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest("{} must be a whole number, got '{}'".format(name, value))
 
     def get_defaults(self):
+        from stravalib import unithelper
         return {            # modules
             'unithelper': unithelper,
             'json': json,
             'formats': util,            # ugh name collision with 'util'
             }
     def get_template(self, name):
-        return JINJA_ENVIRONMENT.get_template(name)
+        return get_jinja_environment().get_template(name)
 
     def get_athlete(self):
-        strava_credentials = self.strava_storage.get()
+        strava_credentials = self.get_credentials()
         if not strava_credentials:
             raise NoStravaUser()
-        strava_credentials_json = json.loads(strava_credentials.to_json())
-        from pprint import pprint
-        #pprint(strava_credentials_json)
-        return strava_credentials_json['token_response']['athlete']
+        return strava_credentials.token_response['athlete']
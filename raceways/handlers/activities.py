@@ -1,26 +1,196 @@
 from google.appengine.api import users
 
 import json
-from raceways.handler import BaseHandler, api_handler, authorized
+from raceways.handler import BaseHandler, BadRequest, api_handler, authorized, make_etag
 from raceways.client import StravaClient
 from google.appengine.ext import ndb
 from raceways import model
+from raceways import jsonstream
+from raceways import facets
+from raceways import spatial
+from raceways import metrics
 
 class ActivitiesHandler(BaseHandler):
+    """
+    Lists the athlete's activities, newest first.
+
+    Query parameters, all optional:
+      limit: page size, the next page is fetched with the returned cursor
+      cursor: from the previous page
+      after, before: only activities that started in this range
+          (strava's ISO dates, "2014-06-01" works too)
+      fields: "summary" for just model.Activity.SUMMARY_FIELDS, or a
+          comma separated list of properties. The combined extents of
+          the activities' streams are then only returned if
+          stream_extents is one of them.
+      facet: name:value, any of facets.FACETS, e.g.
+          facet=type:Ride&facet=type:Run&facet=year:2014 for rides or
+          runs in 2014. These are answered from the facets index, newest
+          (by id) first, and can't be combined with after/before.
+
+    Without a limit every activity is returned.
+    """
+    MAX_LIMIT = 500
+
     @authorized
     @api_handler
     @ndb.toplevel
     def get(self):
-        result = {
-            'activities': []
-            }
-
         athlete_id = self.get_athlete()['id']
+        fields = self.get_fields()
+
+        try:
+            facet_filters = facets.parse_filters(self.request.GET.getall('facet'))
+        except ValueError as e:
+            raise BadRequest(str(e))
+        if facet_filters:
+            result = yield self.get_faceted(athlete_id, facet_filters, fields)
+            raise ndb.Return(result)
+
+        query = model.Activity.query(model.Activity.athlete_id == athlete_id)
+        after = self.request.get('after')
+        if after:
+            query = query.filter(model.Activity.start_date >= after)
+        before = self.request.get('before')
+        if before:
+            query = query.filter(model.Activity.start_date < before)
+        query = query.order(-model.Activity.start_date)
 
-        athlete = model.Athlete.get_by_id(id=athlete_id)
+        options = {}
+        if fields == model.Activity.SUMMARY_FIELDS:
+            options['projection'] = fields
 
-        activities = yield model.Activity.query(model.Activity.athlete_id == athlete_id).fetch_async()
+        limit = self.get_int('limit')
+        result = jsonstream.LazyDict()
+        if limit:
+            limit = min(limit, self.MAX_LIMIT)
+            cursor = self.request.get('cursor')
+            if cursor:
+                options['start_cursor'] = ndb.Cursor(urlsafe=cursor)
+            activities, next_cursor, more = yield query.fetch_page_async(limit, **options)
+            result.append('cursor', next_cursor.urlsafe() if more and next_cursor else None)
+            result.append('more', more)
+        else:
+            activities = yield query.fetch_async(**options)
 
-        result['activities'].extend(activity.to_dict() for activity in activities)
+        # each activity is only converted as it is written out
+        self.check_etag(self.activities_etag(activities, fields))
+        result.append('extents', self.extents(activities, fields))
+        result.append('activities', jsonstream.LazyList(
+            self.activity_dict(activity, fields) for activity in activities))
+        raise ndb.Return(result)
+
+    @ndb.tasklet
+    def get_faceted(self, athlete_id, facet_filters, fields):
+        if self.request.get('after') or self.request.get('before'):
+            raise BadRequest("Use the year and month facets to filter facets by date")
+        index = yield facets.get_index_async(athlete_id)
+        activity_ids = facets.match(index.postings, facet_filters)
+        activity_ids.reverse()
+
+        result = jsonstream.LazyDict()
+        limit = self.get_int('limit')
+        if limit:
+            limit = min(limit, self.MAX_LIMIT)
+            # the cursor is the last id of the previous page
+            cursor = self.get_int('cursor')
+            if cursor:
+                activity_ids = [activity_id for activity_id in activity_ids
+                                if activity_id < cursor]
+            more = len(activity_ids) > limit
+            activity_ids = activity_ids[:limit]
+            result.append('cursor', str(activity_ids[-1]) if more else None)
+            result.append('more', more)
 
+        activities = yield ndb.get_multi_async([ndb.Key(model.Activity, activity_id)
+                                                for activity_id in activity_ids])
+        self.check_etag(self.activities_etag(activities, fields))
+        result.append('extents', self.extents(activities, fields))
+        result.append('activities', jsonstream.LazyList(
+            self.activity_dict(activity, fields)
+            for activity in activities if activity is not None))
         raise ndb.Return(result)
+
+    def get_fields(self):
+        fields = self.request.get('fields')
+        if not fields:
+            return None
+        if fields == 'summary':
+            return model.Activity.SUMMARY_FIELDS
+        fields = tuple(field.strip() for field in fields.split(','))
+        for field in fields:
+            if field not in model.Activity._properties:
+                raise BadRequest("Unknown activity field: {}".format(field))
+        return fields
+
+    def activities_etag(self, activities, fields):
+        """
+        Activities only change when they are written, which bumps
+        their updated time. Projected activities don't have it, but
+        none of their fields change after the first write.
+        """
+        if fields == model.Activity.SUMMARY_FIELDS:
+            versions = [activity.key.id() for activity in activities]
+        else:
+            versions = [(activity.key.id(), activity.updated)
+                        for activity in activities if activity is not None]
+        return make_etag(self.request.path_qs, versions)
+
+    def extents(self, activities, fields):
+        """
+        The combined stream_extents of the activities, so a client can
+        fit its view to all of them before loading any streams.
+        """
+        if fields is not None and 'stream_extents' not in fields:
+            return None
+        return metrics.combine_extents(activity.stream_extents
+                                       for activity in activities if activity is not None)
+
+    def activity_dict(self, activity, fields):
+        if fields is None:
+            return activity.to_dict
+        return lambda: activity.to_dict(include=fields)
+
+
+class ActivitiesNearHandler(ActivitiesHandler):
+    """
+    The athlete's activities that pass through a bounding box, from
+    the spatial index.
+
+    Query parameters:
+      bbox: min_lng,min_lat,max_lng,max_lat
+      fields: as for ActivitiesHandler
+      resolution: of the stored streams to index, if the athlete has no
+          index yet
+    """
+
+    @authorized
+    @api_handler
+    @ndb.toplevel
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        fields = self.get_fields()
+        try:
+            min_lat, min_lng, max_lat, max_lng = spatial.parse_bbox(self.request.get('bbox'))
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+        indexed = yield model.ActivityCells.query(
+            model.ActivityCells.athlete_id == athlete_id).get_async(keys_only=True)
+        if indexed is None:
+            yield spatial.index_stored_async(
+                athlete_id,
+                resolution=self.request.get('resolution') or model.Stream.SOURCE_RESOLUTION)
+
+        activity_ids = yield spatial.activities_in_bbox_async(athlete_id, min_lat, min_lng,
+                                                              max_lat, max_lng)
+        activities = yield ndb.get_multi_async([ndb.Key(model.Activity, activity_id)
+                                                for activity_id in activity_ids])
+        self.check_etag(self.activities_etag(activities, fields))
+        raise ndb.Return(jsonstream.LazyDict([
+            ('activity_ids', activity_ids),
+            ('extents', self.extents(activities, fields)),
+            ('activities', jsonstream.LazyList(
+                self.activity_dict(activity, fields)
+                for activity in activities if activity is not None)),
+            ]))
@@ -11,12 +11,9 @@ class HomepageHandler(BaseHandler):
         if self.user:
             # store strava auth in session (eventually want to store this
             # along side the user!)
-            strava_credentials = self.strava_storage.get()
+            strava_credentials = self.get_credentials()
             if not strava_credentials:
                 strava_auth_uri = self.strava_flow.step1_get_authorize_url()
-
-            else:
-                strava_credentials.authorize(self.http)
         else:
             strava_credentials = None
 
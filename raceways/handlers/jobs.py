@@ -0,0 +1,15 @@
+from raceways.handler import BaseHandler, BadRequest, api_handler, authorized
+from raceways import model
+
+class JobsHandler(BaseHandler):
+    @authorized
+    @api_handler
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        job_id = self.get_int('id')
+        if not job_id:
+            raise BadRequest("Pass the id of a job")
+        job = model.SyncJob.get_by_id(job_id)
+        if job is None or job.athlete_id != athlete_id:
+            raise KeyError("No such job: {}".format(self.request.get('id')))
+        return job.progress()
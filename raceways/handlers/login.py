@@ -1,11 +1,15 @@
 
+import webapp2
+
+from raceways import transport
 from raceways.handler import BaseHandler
 
 class LoginHandler(BaseHandler):
     def get(self):
         if 'code' in self.request.GET:
             code = self.request.GET['code']
-            credentials = self.strava_flow.step2_exchange(code)
+            credentials = self.strava_flow.step2_exchange(
+                code, http=transport.HttpAdapter())
             self.strava_storage.put(credentials)
             return self.redirect('/')
 
@@ -15,3 +19,13 @@ class LogoutHandler(BaseHandler):
             del self.request.cookies['gtoken']
 
         return self.redirect('/')
+
+class DisconnectStravaHandler(BaseHandler):
+    def get(self):
+        if not self.user:
+            print "User wasn't logged in, redirecting"
+            self.redirect(self.request.host_url);
+
+class ConnectHandler(webapp2.RequestHandler):
+    def get(self):
+        pass
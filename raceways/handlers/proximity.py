@@ -0,0 +1,36 @@
+from raceways.handler import BaseHandler, BadRequest, api_handler, authorized
+from google.appengine.ext import ndb
+from raceways import model
+from raceways import proximity
+
+class ProximityHandler(BaseHandler):
+
+    @authorized
+    @api_handler
+    @ndb.toplevel
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        # of the proximity streams, the index is always built from
+        # the source resolution
+        resolution = self.request.get('resolution') or model.Stream.SOURCE_RESOLUTION
+        buckets = self.get_int('buckets', proximity.DEFAULT_BUCKETS)
+        if not proximity.MIN_BUCKETS <= buckets <= proximity.MAX_BUCKETS:
+            raise BadRequest("buckets must be between {} and {}, got {}".format(
+                proximity.MIN_BUCKETS, proximity.MAX_BUCKETS, buckets))
+
+        index = yield proximity.get_index_async(athlete_id, buckets=buckets)
+
+        activity_ids = self.request.GET.getall('activity_id') or index.activity_ids
+        streams = yield proximity.proximity_streams_async(
+            index, activity_ids, resolution=resolution)
+
+        result = {
+            'buckets': index.buckets,
+            'extents': index.extents,
+            'max_proximity': max([max(data) for data in streams.itervalues() if data] or [0]),
+            'proximity': {},
+            }
+        for activity_id, data in streams.iteritems():
+            result['proximity'][activity_id] = { 'data': data }
+
+        raise ndb.Return(result)
@@ -0,0 +1,12 @@
+from raceways.handler import BaseHandler, api_handler, authorized
+from google.appengine.ext import ndb
+from raceways import ratelimit
+
+class RateLimitHandler(BaseHandler):
+    @authorized
+    @api_handler
+    @ndb.toplevel
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        result = yield ratelimit.get_scheduler().utilisation_async(athlete_id=athlete_id)
+        raise ndb.Return(result)
@@ -0,0 +1,28 @@
+from raceways.handler import BaseHandler, api_handler, authorized
+from google.appengine.ext import ndb
+from raceways import model
+from raceways import routes
+
+class RoutesHandler(BaseHandler):
+    """
+    The athlete's recurring routes, most ridden first. Pass rebuild=1
+    to recluster in the background.
+    """
+
+    @authorized
+    @api_handler
+    @ndb.toplevel
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        result = {}
+        if self.request.get('rebuild'):
+            routes.enqueue_rebuild(athlete_id, self.request.get('resolution') or
+                                   model.Stream.SOURCE_RESOLUTION)
+            result['rebuilding'] = True
+
+        athlete_routes = yield model.Route.query(
+            model.Route.athlete_id == athlete_id).fetch_async()
+        athlete_routes.sort(key=lambda route: len(route.activity_ids), reverse=True)
+        result['routes'] = [dict(route.to_dict(), id=route.key.id())
+                            for route in athlete_routes]
+        raise ndb.Return(result)
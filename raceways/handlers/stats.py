@@ -0,0 +1,17 @@
+from raceways.handler import BaseHandler, api_handler
+from raceways import cache
+from raceways import instrumentation
+from raceways import startup
+
+class StatsHandler(BaseHandler):
+    """
+    The instance's instrumentation totals since it started, its cache
+    hit ratios and how long it took to start. Admin only, see app.yaml.
+    """
+    @api_handler
+    def get(self):
+        self.response.cache_control.no_cache = True
+        result = instrumentation.totals.to_dict()
+        result['caches'] = [tiered_cache.stats() for tiered_cache in cache.caches]
+        result['startup'] = startup.report()
+        return result
@@ -1,47 +1,116 @@
 from google.appengine.api import users
 
 import json
-from raceways.handler import BaseHandler, api_handler, authorized
+from raceways.handler import BaseHandler, BadRequest, api_handler, authorized, make_etag
 from raceways.client import StravaClient
 from google.appengine.ext import ndb
 from raceways import model
+from raceways import cache
+from raceways import simplify
+from raceways import jsonstream
+from raceways import ingest
+from raceways import metrics
+from raceways import wireformat
 
 class StreamsHandler(BaseHandler):
+    DEFAULT_TYPES = ('latlng', 'altitude')
+    TYPES = ingest.STREAM_TYPES + metrics.DERIVED_TYPES
+
+    # stored streams don't change, so once every requested stream
+    # exists the response can be cached for a long time
+    COMPLETE_MAX_AGE = 7 * 24 * 60 * 60
+
+    # most activities a single request can ask for, keep in sync with
+    # STREAM_BATCH_SIZE in streamset.js
+    MAX_ACTIVITIES = 50
 
     @authorized
     @api_handler
     @ndb.toplevel
     def get(self):
-        result = {
-            'streams': {}
-            }
-        streams_result = result['streams']
+        """
+        Streams for up to MAX_ACTIVITIES activity_ids are loaded in one
+        batch, and written out one activity at a time, only decoded as
+        they are written. Activities that are missing any of the
+        streams are listed in missing. Ask for the derived streams from
+        raceways.metrics with e.g. type=distance&type=grade.
 
-        activity_ids = self.request.GET.getall('activity_id')
+        With format=binary, or an Accept header asking for
+        wireformat.CONTENT_TYPE, the streams are sent as float32
+        arrays, see raceways.wireformat.
+        """
+        activity_ids = []
+        for activity_id in self.request.GET.getall('activity_id'):
+            if activity_id not in activity_ids:
+                activity_ids.append(activity_id)
+        if len(activity_ids) > self.MAX_ACTIVITIES:
+            raise BadRequest("At most {} activity_ids per request, got {}".format(
+                self.MAX_ACTIVITIES, len(activity_ids)))
         resolution = self.request.get('resolution')
-        stream_keys = []
-        stream_types = []
-        activity_ids2 = []
+        tolerance = self.get_tolerance()
+        stream_types = self.request.GET.getall('type') or self.DEFAULT_TYPES
+        for stream_type in stream_types:
+            if stream_type not in self.TYPES:
+                raise BadRequest("Unknown stream type: {}".format(stream_type))
+        stream_requests = []
         for activity_id in activity_ids:
-            streams_result[activity_id] = {}
-            for type in ('latlng', 'altitude'):
-                stream_key = ndb.Key(
-                    model.Stream,
-                    model.Stream.make_key_string(activity_id, type, resolution=resolution))
-                stream_keys.append(stream_key)
-                stream_types.append(type)
-                activity_ids2.append(activity_id)
-
-        streams = yield ndb.get_multi_async(stream_keys)
-
-        for activity_id, stream_type, stream in zip(activity_ids2, stream_types, streams):
-            activity = streams_result[activity_id]
-            if stream is None:
-                activity[stream_type] = {}
-            else:
-                activity[stream_type] = stream.to_dict()
-
-        # self.response.cache_expires(60*60)
-        # self.response.cache_control = 'private'
-        # self.response.vary = 'Cookie'
-        raise ndb.Return(result)
+            for type in stream_types:
+                stream_requests.append((activity_id, type))
+
+        loaders = yield cache.get_stream_dicts_async(stream_requests,
+                                                     resolution=resolution,
+                                                     tolerance=tolerance,
+                                                     lazy=True)
+
+        # nothing has been decoded yet, so a 304 costs only the lookups
+        binary = self.wants_binary()
+        present = [loader is not None for loader in loaders]
+        self.check_etag(make_etag(model.Stream.version, resolution, tolerance,
+                                  stream_requests, present, binary),
+                        max_age=self.COMPLETE_MAX_AGE if all(present) else None,
+                        vary=('Cookie', 'Accept'))
+
+        if binary:
+            raise ndb.Return(wireformat.StreamRecords(tolerance, [
+                (activity_id, stream_type, loader)
+                for (activity_id, stream_type), loader in zip(stream_requests, loaders)]))
+
+        # activities with any stream not stored yet, so the client can
+        # ask for them to be fetched
+        missing = []
+        for (activity_id, stream_type), loader in zip(stream_requests, loaders):
+            if loader is None and activity_id not in missing:
+                missing.append(activity_id)
+
+        streams_result = jsonstream.LazyDict()
+        activities = {}
+        for (activity_id, stream_type), loader in zip(stream_requests, loaders):
+            if activity_id not in activities:
+                activities[activity_id] = jsonstream.LazyDict()
+                streams_result.append(activity_id, activities[activity_id])
+            activities[activity_id].append(stream_type, loader or {})
+
+        raise ndb.Return(jsonstream.LazyDict([
+            ('tolerance', tolerance),
+            ('missing', missing),
+            ('streams', streams_result),
+            ]))
+
+    def wants_binary(self):
+        if self.request.get('format'):
+            return self.request.get('format') == 'binary'
+        return wireformat.CONTENT_TYPE in self.request.headers.get('Accept', '')
+
+    def get_tolerance(self):
+        """
+        The simplification level asked for, either as tolerance=
+        (meters) or zoom= (map zoom level, optionally with latitude=).
+        """
+        try:
+            tolerance = float(self.request.get('tolerance') or 0) or None
+            zoom = self.request.get('zoom')
+            zoom = float(zoom) if zoom else None
+            latitude = float(self.request.get('latitude') or 0)
+        except ValueError as e:
+            return 0
+        return simplify.choose_level(tolerance=tolerance, zoom=zoom, latitude=latitude)
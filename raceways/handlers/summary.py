@@ -0,0 +1,25 @@
+from raceways.handler import BaseHandler, api_handler, authorized
+from google.appengine.ext import ndb
+from raceways import summary
+
+class SummaryHandler(BaseHandler):
+    """
+    Totals and facet counts of the athlete's activities. Filter with
+    any of summary.DIMENSIONS, e.g. ?type=Ride&year=2014&year=2015
+    or ?month=2014-06
+    """
+
+    @authorized
+    @api_handler
+    @ndb.toplevel
+    def get(self):
+        athlete_id = self.get_athlete()['id']
+        activity_summary = yield summary.get_summary_async(athlete_id)
+
+        filters = {}
+        for dimension in summary.DIMENSIONS:
+            filters[dimension] = self.request.GET.getall(dimension)
+
+        result = summary.aggregate(activity_summary.buckets, filters)
+        result['activity_count'] = len(activity_summary.activity_ids)
+        raise ndb.Return(result)
@@ -0,0 +1,26 @@
+import webapp2
+from google.appengine.ext import ndb
+from raceways import jobs
+from raceways import model
+from raceways import routes
+
+class StreamTaskHandler(webapp2.RequestHandler):
+    """
+    Push queue worker for raceways.jobs. Failing with a 500 makes the
+    queue retry the task with backoff.
+    """
+    @ndb.toplevel
+    def post(self):
+        attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+        yield jobs.run_stream_task_async(dict(self.request.POST.items()), attempt)
+
+
+class RouteTaskHandler(webapp2.RequestHandler):
+    """
+    Reclusters an athlete's routes, see raceways.routes.
+    """
+    @ndb.toplevel
+    def post(self):
+        yield routes.rebuild_routes_async(int(self.request.get('athlete_id')),
+                                          resolution=self.request.get('resolution') or
+                                          model.Stream.SOURCE_RESOLUTION)
@@ -2,10 +2,15 @@
 API_PREFIX = 'https://www.strava.com/api/v3/'
 
 from raceways import model
+from raceways import facets
+from raceways import instrumentation
+from raceways import jobs
+from raceways import ratelimit
+from raceways import summary
+from raceways import util
 from raceways.client import api_call
 from raceways.handler import BaseHandler, authorized, api_handler
 from google.appengine.ext import ndb
-import json
 from itertools import tee, izip, islice
 
 # from itertools docs
@@ -24,8 +29,27 @@ def load_activities(activity_ids):
     result = pending_keys, ndb.get_multi_async(pending_keys)
     raise ndb.Return(result)
 
+# strava won't return more than this many activities per page
+MAX_PER_PAGE = 200
+
+# how many pages to request at once when backfilling the whole history
+BACKFILL_CONCURRENCY = 4
+
+
+class ActivityFetchError(Exception):
+    pass
+
 
 class UpdateHandler(BaseHandler):
+    """
+    Pull new activities from strava, and start a model.SyncJob to
+    fetch their streams in the background.
+
+    The first sync fetches the `count` most recent activities. After
+    that, the latest start_date we have seen is kept in a
+    model.AthleteSync and only activities after it are requested.
+    Pass backfill=1 to page through the athlete's entire history.
+    """
 
     @authorized
     @api_handler
@@ -42,17 +66,24 @@ class UpdateHandler(BaseHandler):
             per_page = 10
 
         resolution = self.request.get('resolution', 'high')
+        if resolution in model.Stream.RESOLUTION_POINTS:
+            # the other resolutions are derived from this one
+            resolution = model.Stream.SOURCE_RESOLUTION
 
         pending_writes = []
+        new_records = []
 
-        athlete = model.Athlete.get_by_id(id=athlete_id)
+        sync = yield model.AthleteSync.get_by_id_async(athlete_id)
 
-        activities = yield self.arc.urlfetch(api_call('athlete/activities',
-                                                      id=athlete_id,
-                                                      per_page=per_page,
-                                                      resolution=resolution))
+        if self.request.get('backfill'):
+            strava_activities = yield self.fetch_history(athlete_id)
+        elif sync and sync.latest_start_date:
+            strava_activities = yield self.fetch_activities_after(
+                athlete_id, util.strava_timestamp(sync.latest_start_date))
+        else:
+            strava_activities = yield self.fetch_activities_page(
+                athlete_id, 1, per_page)
 
-        strava_activities = json.loads(activities.content)
         result['total_activities'] = len(strava_activities)
         pending_keys, activity_records = yield load_activities([activity['id'] for activity in strava_activities])
 
@@ -77,22 +108,20 @@ class UpdateHandler(BaseHandler):
             assert activity_records[index] is None
             activity_records[index] = activity_record
             result['new_activities'].append(strava_activity)
+            new_records.append(activity_record)
             pending_writes.append(activity_record.put_async())
 
         # now pick up missing streams
-        pending_stream_keys = []
+        pending_stream_requests = []
         for activity_record in activity_records:
             for stream_type in ('latlng', 'altitude'):
-                stream_key = ndb.Key(
-                    model.Stream,
-                    model.Stream.make_key_string(activity_record.key.id(),
-                                                 stream_type, resolution=resolution))
                 # for pairwise() later
-                pending_stream_keys.append(stream_key)
+                pending_stream_requests.append((activity_record.key.id(), stream_type))
 
         # load all streams from the database (!)
-        print "Looking up {} stream key pairs..".format(len(pairwise(pending_stream_keys)))
-        stream_records = yield ndb.get_multi_async(pending_stream_keys)
+        print "Looking up {} stream key pairs..".format(len(pairwise(pending_stream_requests)))
+        stream_records = yield model.Stream.get_multi_async(pending_stream_requests,
+                                                            resolution=resolution)
         # resolve futures
         
         stream_requests = []
@@ -101,39 +130,77 @@ class UpdateHandler(BaseHandler):
             if latlng_stream is None or altitude_stream is None:
                 stream_requests.append(activity_record.key.id())
 
-        pending_stream_requests = yield self.fetch_streams(
-            stream_requests, resolution=resolution)
-
-        while pending_stream_requests:
-            f = ndb.Future.wait_any(pending_stream_requests.keys())
-            activity_id = pending_stream_requests[f]
-            del pending_stream_requests[f]
-            
-            streams = json.loads(f.get_result().content)
-
-            for stream in streams:
-                stream_type = stream['type']   # latlng or altitude
-                stream_entity_id = model.Stream.make_key_string(activity_id, stream_type, resolution=resolution)
-                stream_record = model.Stream(id=stream_entity_id)
-
-                for key, value in stream.iteritems():
-                    setattr(stream_record, key, value)
-                stream_record.activity_id = activity_id
-
-                pending_writes.append(stream_record.put_async())
-
         print "Awaiting {} writes...".format(len(pending_writes))
         yield pending_writes
+        if new_records:
+            yield (summary.add_activities_async(athlete_id, new_records),
+                   facets.add_activities_async(athlete_id, new_records))
+
+        # the streams themselves are fetched in the background
+        job = None
+        if stream_requests:
+            job = yield jobs.enqueue_stream_jobs_async(self.user.user_id, athlete_id,
+                                                       stream_requests,
+                                                       resolution=resolution)
+        result['job_id'] = job and job.key.id()
+
+        latest_start_date = max([activity['start_date'] for activity in strava_activities] or [None])
+        if latest_start_date:
+            if sync is None:
+                sync = model.AthleteSync(id=athlete_id)
+            if latest_start_date > sync.latest_start_date:
+                sync.latest_start_date = latest_start_date
+            yield sync.put_async()
+        result['latest_start_date'] = sync and sync.latest_start_date
 
         raise ndb.Return(result)
 
     @ndb.tasklet
-    def fetch_streams(self, activity_ids, resolution=None):
-        pending_stream_requests = {}
-        for id in activity_ids:
-            f = self.arc.urlfetch(
-                api_call('activities/{}/streams/latlng,altitude'.format(id),
-                         resolution=resolution))
-            pending_stream_requests[f] = id
-
-        raise ndb.Return(pending_stream_requests)
+    def fetch_activities_page(self, athlete_id, page, per_page, after=None,
+                              priority=None):
+        response = yield self.arc.urlfetch(api_call('athlete/activities',
+                                                    id=athlete_id,
+                                                    page=page,
+                                                    per_page=per_page,
+                                                    after=after),
+                                           priority=priority)
+        if response.status_code != 200:
+            raise ActivityFetchError("Fetching page {} of activities failed with {}".format(
+                page, response.status_code))
+        raise ndb.Return(instrumentation.json_loads(response.content))
+
+    @ndb.tasklet
+    def fetch_activities_after(self, athlete_id, after):
+        """
+        Page forward through everything that started after the
+        `after` timestamp, until strava runs out.
+        """
+        activities = []
+        page = 1
+        while True:
+            strava_activities = yield self.fetch_activities_page(
+                athlete_id, page, MAX_PER_PAGE, after=after)
+            activities.extend(strava_activities)
+            if len(strava_activities) < MAX_PER_PAGE:
+                break
+            page += 1
+        raise ndb.Return(activities)
+
+    @ndb.tasklet
+    def fetch_history(self, athlete_id):
+        """
+        Fetch the athlete's entire history, BACKFILL_CONCURRENCY pages
+        at a time.
+        """
+        activities = []
+        page = 1
+        while True:
+            pages = yield [self.fetch_activities_page(athlete_id, page + offset, MAX_PER_PAGE,
+                                                      priority=ratelimit.BACKFILL)
+                           for offset in xrange(BACKFILL_CONCURRENCY)]
+            for strava_activities in pages:
+                activities.extend(strava_activities)
+            if any(len(strava_activities) < MAX_PER_PAGE for strava_activities in pages):
+                break
+            page += BACKFILL_CONCURRENCY
+        raise ndb.Return(activities)
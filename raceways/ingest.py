@@ -0,0 +1,107 @@
+"""
+Everything that happens when a new stream is stored.
+
+This runs from the stream task queue workers (see raceways.jobs), not
+from user facing requests.
+"""
+import logging
+
+from google.appengine.ext import ndb
+
+from raceways import cache
+from raceways import instrumentation
+from raceways import metrics
+from raceways import model
+from raceways import proximity
+from raceways import simplify
+from raceways import spatial
+from raceways.client import api_call
+
+STREAM_TYPES = ('latlng', 'altitude')
+
+
+class StreamFetchError(Exception):
+    pass
+
+
+@ndb.tasklet
+def fetch_streams_async(arc, activity_id, resolution=None):
+    """
+    Fetch the latlng and altitude streams of an activity from strava.
+    Returns a tuple of (streams, shared) where streams is the list of
+    stream dicts, which is empty if strava has no streams for it
+    (e.g. a manual entry), and shared says whether a concurrent fetch
+    of the same streams did the work.
+    """
+    response = yield arc.urlfetch(
+        api_call('activities/{}/streams/{}'.format(activity_id, ','.join(STREAM_TYPES)),
+                 resolution=resolution),
+        coalesce=True)
+    if response.status_code == 404:
+        logging.info("No streams for activity %s", activity_id)
+        raise ndb.Return(([], False))
+    if response.status_code != 200:
+        raise StreamFetchError("Fetching streams for {} failed with {}".format(
+            activity_id, response.status_code))
+    raise ndb.Return((instrumentation.json_loads(response.content), response.shared))
+
+
+@ndb.transactional_tasklet
+def set_activity_extents_async(activity_id, extents):
+    """
+    Record the extents of newly stored streams on the activity, so
+    clients can fit their view before loading any streams.
+    """
+    if extents is None:
+        return
+    activity = yield model.Activity.get_by_id_async(int(activity_id))
+    if activity is None:
+        return
+    activity.stream_extents = extents
+    yield activity.put_async()
+
+
+@ndb.tasklet
+def ingest_streams_async(arc, athlete_id, activity_id, resolution=None):
+    """
+    Fetch, encode and store the streams of an activity, then fold them
+    into the athlete's derived indexes. Safe to retry.
+    """
+    streams, shared = yield fetch_streams_async(arc, activity_id, resolution=resolution)
+
+    new_streams = {}
+    for stream in streams:
+        new_streams[stream['type']] = stream['data']
+    if shared:
+        # whoever did the fetch is storing it
+        raise ndb.Return(new_streams)
+
+    # the simplification levels come from the latlng stream, but
+    # apply to every stream of the activity point for point
+    significances = None
+    if new_streams.get('latlng'):
+        significances = simplify.significance(new_streams['latlng'])
+
+    stream_records = []
+    derived = [{'type': stream_type, 'data': data}
+               for stream_type, data in metrics.derived_streams(new_streams).iteritems()]
+    for stream in streams + derived:
+        stream_record = model.Stream.from_strava(activity_id, stream,
+                                                 resolution=resolution)
+        stream_record.extents = metrics.stream_extents(stream['type'], stream['data'])
+        if significances and len(stream['data']) == len(significances):
+            stream_record.set_significance(significances)
+        stream_records.append(stream_record)
+    yield (ndb.put_multi_async(stream_records),
+           set_activity_extents_async(activity_id, metrics.activity_extents(
+               dict((record.type, record.extents) for record in stream_records),
+               resolution=resolution)))
+    cache.invalidate_streams([(activity_id, stream_record.type)
+                              for stream_record in stream_records],
+                             resolution=resolution)
+
+    if new_streams and resolution == model.Stream.SOURCE_RESOLUTION:
+        yield proximity.update_index_async(athlete_id, {activity_id: new_streams})
+    if new_streams.get('latlng'):
+        yield spatial.index_activity_async(athlete_id, activity_id, new_streams['latlng'])
+    raise ndb.Return(new_streams)
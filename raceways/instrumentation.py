@@ -0,0 +1,249 @@
+"""
+Where requests spend their time.
+
+Each request handled by a BaseHandler gets a Recorder, which collects
+spans (named, timed sections) and counters:
+
+- every datastore, memcache and urlfetch RPC, through App Engine's
+  apiproxy hooks (see install_rpc_hooks()), with the bytes sent and
+  received for each service
+- JSON encoding in api_handler and decoding of strava responses
+  (json_loads())
+- template rendering in using_template
+- hits and misses of the TieredCaches
+
+When the request is done its spans are added to the process-wide
+totals, which /api/_stats returns. The request's own summary is
+- sent back in the X-Raceways-Stats header if the request had an
+  X-Raceways-Debug header,
+- logged for SAMPLE_RATE of requests, and for every request slower
+  than SLOW_REQUEST_SECONDS.
+
+SAMPLE_RATE can be set with the RACEWAYS_STATS_SAMPLE_RATE
+environment variable (env_variables in app.yaml), so sampling can be
+turned up in production without touching the code.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+DEBUG_HEADER = 'X-Raceways-Debug'
+STATS_HEADER = 'X-Raceways-Stats'
+
+SAMPLE_RATE = float(os.environ.get('RACEWAYS_STATS_SAMPLE_RATE', 0.01))
+SLOW_REQUEST_SECONDS = 2.0
+
+# spans kept per request, beyond this they are only counted
+MAX_SPANS = 500
+
+HOOK_NAME = 'raceways_instrumentation'
+
+
+class SpanTotals(object):
+    """
+    Count, total and max duration of spans by name.
+    """
+    def __init__(self):
+        self.count = defaultdict(int)
+        self.total = defaultdict(float)
+        self.max = defaultdict(float)
+
+    def add(self, name, duration, count=1):
+        self.count[name] += count
+        self.total[name] += duration
+        self.max[name] = max(self.max[name], duration)
+
+    def to_dict(self):
+        return dict((name, {
+            'count': self.count[name],
+            'total_ms': round(self.total[name] * 1000, 1),
+            'mean_ms': round(self.total[name] * 1000 / self.count[name], 2),
+            'max_ms': round(self.max[name] * 1000, 1),
+            }) for name in self.count)
+
+
+class Recorder(object):
+    """
+    The spans and counters of one request. spans is a list of (name,
+    start, duration), start being seconds since the request started.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.spans = []
+        self.totals = SpanTotals()
+        self.counters = defaultdict(int)
+
+    def add_span(self, name, start, duration):
+        self.totals.add(name, duration)
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((name, start - self.started, duration))
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def summary(self):
+        """
+        One line: the total time, then count/milliseconds for each
+        span name, slowest first, then the counters.
+        """
+        parts = ['total={:.1f}ms'.format(self.elapsed() * 1000)]
+        for name in sorted(self.totals.count, key=lambda name: -self.totals.total[name]):
+            parts.append('{}={}/{:.1f}ms'.format(name, self.totals.count[name],
+                                                 self.totals.total[name] * 1000))
+        for name in sorted(self.counters):
+            parts.append('{}={}'.format(name, self.counters[name]))
+        return '; '.join(parts)
+
+
+class ProcessTotals(object):
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.spans = SpanTotals()
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add_recorder(self, recorder):
+        with self.lock:
+            self.requests += 1
+            self.spans.add('request', recorder.elapsed())
+            for name, count in recorder.totals.count.iteritems():
+                self.spans.count[name] += count
+                self.spans.total[name] += recorder.totals.total[name]
+                self.spans.max[name] = max(self.spans.max[name],
+                                           recorder.totals.max[name])
+            for name, count in recorder.counters.iteritems():
+                self.counters[name] += count
+
+    def add_span(self, name, duration):
+        with self.lock:
+            self.spans.add(name, duration)
+
+    def count(self, name, n):
+        with self.lock:
+            self.counters[name] += n
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'since': self.started,
+                'requests': self.requests,
+                'spans': self.spans.to_dict(),
+                'counters': dict(self.counters),
+                }
+
+
+totals = ProcessTotals()
+
+_local = threading.local()
+
+
+def current():
+    """
+    The Recorder of the request being handled by this thread, or None.
+    """
+    return getattr(_local, 'recorder', None)
+
+
+def start_request(name):
+    install_rpc_hooks()
+    _local.recorder = Recorder(name)
+    _local.rpc_starts = {}
+    return _local.recorder
+
+
+def finish_request():
+    """
+    Stop recording the current request, add it to the process totals
+    and log it if it is sampled or slow. Returns its Recorder.
+    """
+    recorder = current()
+    _local.recorder = None
+    _local.rpc_starts = {}
+    if recorder is None:
+        return None
+    recorder.finished = time.time()
+    totals.add_recorder(recorder)
+    if recorder.elapsed() >= SLOW_REQUEST_SECONDS:
+        logging.warning("Slow request %s: %s", recorder.name, recorder.summary())
+    elif random.random() < SAMPLE_RATE:
+        logging.info("Sampled request %s: %s", recorder.name, recorder.summary())
+    return recorder
+
+
+def record_span(name, start, duration):
+    recorder = current()
+    if recorder is None:
+        totals.add_span(name, duration)
+    else:
+        recorder.add_span(name, start, duration)
+
+
+@contextmanager
+def span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.time() - start)
+
+
+def count(name, n=1):
+    recorder = current()
+    if recorder is None:
+        totals.count(name, n)
+    else:
+        recorder.counters[name] += n
+
+
+def json_loads(content):
+    """
+    json.loads(content), timed as json.decode.
+    """
+    count('bytes.json_decoded', len(content))
+    with span('json.decode'):
+        return json.loads(content)
+
+
+def _pre_call(service, call, request, response, rpc=None):
+    starts = getattr(_local, 'rpc_starts', None)
+    if starts is not None:
+        starts[id(request)] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    starts = getattr(_local, 'rpc_starts', None)
+    if not starts:
+        return
+    start = starts.pop(id(request), None)
+    if start is None:
+        return
+    record_span('{}.{}'.format(service, call), start, time.time() - start)
+    for direction, message in (('sent', request), ('received', response)):
+        size = getattr(message, 'ByteSize', None)
+        if size is not None:
+            count('bytes_{}.{}'.format(direction, service), size())
+
+
+_hooks_installed = False
+
+
+def install_rpc_hooks():
+    """
+    Time every API call (datastore_v3, memcache, urlfetch...) made
+    while a request is being recorded.
+    """
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(HOOK_NAME, _post_call)
+    _hooks_installed = True
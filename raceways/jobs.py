@@ -0,0 +1,171 @@
+"""
+Background ingestion of activity streams.
+
+UpdateHandler creates a model.SyncJob and enqueues one task per
+activity whose streams are missing. Each task is handled by
+run_stream_task_async(), which fetches and stores the streams through
+raceways.ingest and records progress on the job as a model.SyncJobActivity.
+
+In production tasks go to the 'streams' push queue (see queue.yaml for
+the retry and backoff settings). LocalQueue is an in-process stand-in
+with the same retry behavior, for tests and scripts::
+
+    queue = jobs.LocalQueue()
+    jobs.set_queue(queue)
+    ... run the update ...
+    queue.run()
+"""
+import logging
+import time
+from collections import deque
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from raceways import ingest
+from raceways import model
+from raceways import ratelimit
+from raceways.handler import AuthRequestContext, get_credentials_storage
+
+QUEUE_NAME = 'streams'
+STREAM_TASK_URL = '/tasks/streams'
+
+# keep these in sync with queue.yaml
+MAX_ATTEMPTS = 6
+MIN_BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 600
+
+
+def backoff(attempt):
+    """
+    Seconds to wait before retrying after the given (0-based) attempt.
+    """
+    return min(MIN_BACKOFF_SECONDS * 2 ** attempt, MAX_BACKOFF_SECONDS)
+
+
+class TaskQueue(object):
+    """
+    Sends tasks to an App Engine push queue.
+    """
+    def __init__(self, name=QUEUE_NAME):
+        self.name = name
+
+    def add(self, task_params, countdown=None):
+        queue = taskqueue.Queue(self.name)
+        tasks = [taskqueue.Task(url=STREAM_TASK_URL, params=params, countdown=countdown)
+                 for params in task_params]
+        for start in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+
+
+class LocalQueue(object):
+    """
+    In-process stand-in for TaskQueue. Tasks run when run() is
+    called, and failures are retried after backoff() seconds.
+    """
+    def __init__(self, sleep=time.sleep):
+        self.tasks = deque()
+        self.sleep = sleep
+
+    def add(self, task_params, countdown=None):
+        for params in task_params:
+            self.tasks.append((params, 0, countdown))
+
+    def run(self):
+        while self.tasks:
+            params, attempt, countdown = self.tasks.popleft()
+            if countdown:
+                self.sleep(countdown)
+            try:
+                run_stream_task_async(params, attempt).get_result()
+            except Exception:
+                logging.exception("Stream task %r failed", params)
+                self.tasks.append((params, attempt + 1, backoff(attempt)))
+
+
+_queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue = TaskQueue()
+    return _queue
+
+
+def set_queue(queue):
+    global _queue
+    _queue = queue
+
+
+@ndb.tasklet
+def enqueue_stream_jobs_async(user_id, athlete_id, activity_ids, resolution=None):
+    """
+    Create a model.SyncJob covering activity_ids and enqueue a task
+    for each of them. Returns the job.
+    """
+    job = model.SyncJob(athlete_id=int(athlete_id),
+                        resolution=resolution,
+                        activity_ids=[int(activity_id) for activity_id in activity_ids])
+    yield job.put_async()
+
+    get_queue().add([{
+        'job_id': job.key.id(),
+        'user_id': user_id,
+        'athlete_id': athlete_id,
+        'activity_id': activity_id,
+        'resolution': resolution or '',
+        } for activity_id in activity_ids])
+    raise ndb.Return(job)
+
+
+@ndb.tasklet
+def record_progress_async(job_id, activity_id, failed=False):
+    """
+    Record the outcome of one activity of a job. Each outcome is an
+    entity of its own, so tasks don't contend on the job, and failing
+    to record it doesn't fail (and refetch) the task.
+    """
+    try:
+        yield model.SyncJobActivity.create(job_id, activity_id, failed=failed).put_async()
+    except Exception:
+        logging.exception("Couldn't record progress of activity %s on job %s",
+                          activity_id, job_id)
+
+
+@ndb.tasklet
+def run_stream_task_async(params, attempt=0):
+    """
+    Handle a single stream task. Raises to ask for a retry, until the
+    last attempt, where the activity is recorded as failed instead.
+    Rate limited tasks are re-enqueued to run once there is budget.
+    """
+    job_id = params['job_id']
+    activity_id = int(params['activity_id'])
+
+    credentials = get_credentials_storage(params['user_id']).get()
+    if credentials is None:
+        logging.error("No strava credentials for user %s", params['user_id'])
+        yield record_progress_async(job_id, activity_id, failed=True)
+        return
+
+    arc = AuthRequestContext(credentials, athlete_id=params['athlete_id'],
+                             priority=ratelimit.BACKFILL)
+    try:
+        yield ingest.ingest_streams_async(arc, params['athlete_id'], activity_id,
+                                          resolution=params.get('resolution') or None)
+    except ratelimit.RateLimited as e:
+        # not the task's fault, so try again once there is budget
+        # without using up an attempt
+        logging.info("Rate limited, retrying activity %s in %ds",
+                     activity_id, e.retry_after)
+        get_queue().add([params], countdown=int(e.retry_after) + 1)
+        return
+    except Exception:
+        if attempt + 1 < MAX_ATTEMPTS:
+            raise
+        logging.exception("Giving up on streams for activity %s", activity_id)
+        yield record_progress_async(job_id, activity_id, failed=True)
+        return
+
+    yield record_progress_async(job_id, activity_id)
@@ -0,0 +1,83 @@
+"""
+Incremental JSON output for API responses.
+
+A handler can return a LazyDict or LazyList instead of a plain dict or
+list. Their values may be callables (or ndb futures), which are only
+called while the response is being written, and each value is encoded
+and written on its own, so at most one of them is held decoded and
+serialized at a time.
+
+Output is compact: no indentation, no spaces after separators.
+"""
+import json
+
+from google.appengine.ext import ndb
+
+
+class LazyDict(object):
+    """
+    An ordered set of (key, value) pairs, written as a JSON object.
+    """
+    def __init__(self, items=None):
+        self.items = list(items or [])
+
+    def append(self, key, value):
+        self.items.append((key, value))
+
+
+class LazyList(object):
+    """
+    A sequence of values, written as a JSON array.
+    """
+    def __init__(self, values=None):
+        self.values = list(values or [])
+
+    def append(self, value):
+        self.values.append(value)
+
+
+def resolve(value):
+    if isinstance(value, ndb.Future):
+        return value.get_result()
+    if callable(value):
+        return value()
+    return value
+
+
+def write_json(write, value, default=None):
+    """
+    Write value as JSON through write(), resolving lazy values as they
+    are reached.
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+    _write(write, value, encoder)
+
+
+def _write(write, value, encoder):
+    value = resolve(value)
+    if isinstance(value, LazyDict):
+        _write_object(write, value.items, encoder)
+    elif isinstance(value, dict):
+        _write_object(write, value.iteritems(), encoder)
+    elif isinstance(value, LazyList):
+        write('[')
+        for index, item in enumerate(value.values):
+            if index:
+                write(',')
+            _write(write, item, encoder)
+            # let the resolved value go as soon as it's written
+            value.values[index] = None
+        write(']')
+    else:
+        write(encoder.encode(value))
+
+
+def _write_object(write, items, encoder):
+    write('{')
+    for index, (key, item) in enumerate(items):
+        if index:
+            write(',')
+        write(encoder.encode(unicode(key)))
+        write(':')
+        _write(write, item, encoder)
+    write('}')
@@ -0,0 +1,161 @@
+"""
+Values derived from the latlng and altitude streams at ingest.
+
+Rather than having every consumer walk the raw streams (as
+index_stream does with d3.extent on each page load), these are
+computed once with numpy when the streams are stored:
+
+- distance_haversine: cumulative haversine distance in meters at each
+  point (named apart from strava's own distance stream)
+- altitude_smooth: altitude averaged over SMOOTHING_METERS of distance
+- grade: percent grade of altitude_smooth over the same distance
+
+They are stored as Streams of their own (DERIVED_TYPES) next to the
+ones they come from, and every stored stream carries the extents of
+its data, see stream_extents().
+"""
+import numpy
+
+from raceways.simplify import EARTH_RADIUS
+
+DERIVED_TYPES = ('distance_haversine', 'altitude_smooth', 'grade')
+
+SMOOTHING_METERS = 100.0
+
+
+def haversine_steps(latlng):
+    """
+    Meters between each point of a latlng stream and the next.
+    """
+    latlng = numpy.radians(numpy.asarray(latlng, dtype=float))
+    lat, lng = latlng[:, 0], latlng[:, 1]
+    d_lat = numpy.diff(lat)
+    d_lng = numpy.diff(lng)
+    a = (numpy.sin(d_lat / 2) ** 2 +
+         numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * numpy.sin(d_lng / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+
+
+def cumulative_distance(latlng):
+    if not len(latlng):
+        return numpy.zeros(0)
+    return numpy.concatenate(([0.0], numpy.cumsum(haversine_steps(latlng))))
+
+
+def _windows(distance, window):
+    """
+    For each point, the [low, high) range of points within window / 2
+    meters of it.
+    """
+    low = numpy.searchsorted(distance, distance - window / 2, side='left')
+    high = numpy.searchsorted(distance, distance + window / 2, side='right')
+    return low, high
+
+
+def smooth(altitude, distance, window=SMOOTHING_METERS):
+    """
+    Moving average of altitude over window meters of distance.
+    """
+    altitude = numpy.asarray(altitude, dtype=float)
+    low, high = _windows(distance, window)
+    sums = numpy.concatenate(([0.0], numpy.cumsum(altitude)))
+    return (sums[high] - sums[low]) / (high - low)
+
+
+def grade(altitude, distance, window=SMOOTHING_METERS):
+    """
+    Percent grade at each point, over window meters of distance.
+    """
+    low, high = _windows(distance, window)
+    run = distance[high - 1] - distance[low]
+    rise = altitude[high - 1] - altitude[low]
+    result = numpy.zeros(len(distance))
+    moving = run > 0
+    result[moving] = rise[moving] / run[moving] * 100
+    return result
+
+
+def derived_streams(streams):
+    """
+    {type: data} of DERIVED_TYPES, from {type: data} of the latlng and
+    altitude streams. Streams that can't be derived are left out.
+    """
+    latlng = streams.get('latlng')
+    if not latlng:
+        return {}
+    distance = cumulative_distance(latlng)
+    result = {'distance_haversine': distance.tolist()}
+
+    altitude = streams.get('altitude')
+    if altitude and len(altitude) == len(latlng):
+        altitude_smooth = smooth(altitude, distance)
+        result['altitude_smooth'] = altitude_smooth.tolist()
+        result['grade'] = grade(altitude_smooth, distance).tolist()
+    return result
+
+
+def stream_extents(stream_type, data):
+    """
+    Bounds and point count of a stream's data, {'points': n} plus
+    min_lat/max_lat/min_lng/max_lng for latlng and min/max for
+    everything else. For altitude_smooth the total climb is included
+    too.
+    """
+    result = {'points': len(data)}
+    if not len(data):
+        return result
+    values = numpy.asarray(data, dtype=float)
+    if stream_type == 'latlng':
+        result['min_lat'], result['min_lng'] = values.min(axis=0).tolist()
+        result['max_lat'], result['max_lng'] = values.max(axis=0).tolist()
+    else:
+        result['min'] = float(values.min())
+        result['max'] = float(values.max())
+    if stream_type == 'altitude_smooth':
+        steps = numpy.diff(values)
+        result['elevation_gain'] = float(steps[steps > 0].sum())
+    return result
+
+
+def activity_extents(extents, resolution=None):
+    """
+    Extents of a whole activity, for model.Activity.stream_extents,
+    from {type: stream_extents()} of its streams. None if it has no
+    latlng points.
+    """
+    latlng = extents.get('latlng')
+    if not latlng or not latlng['points']:
+        return None
+    result = {
+        'points': latlng['points'],
+        'resolution': resolution,
+        }
+    for key in ('min_lat', 'max_lat', 'min_lng', 'max_lng'):
+        result[key] = latlng[key]
+    altitude = extents.get('altitude')
+    if altitude and altitude['points']:
+        result['min_alt'] = altitude['min']
+        result['max_alt'] = altitude['max']
+    if extents.get('distance_haversine', {}).get('points'):
+        result['distance'] = extents['distance_haversine']['max']
+    if 'elevation_gain' in extents.get('altitude_smooth', {}):
+        result['elevation_gain'] = extents['altitude_smooth']['elevation_gain']
+    return result
+
+
+def combine_extents(extents_list):
+    """
+    The extents covering every one of extents_list (activity_extents()
+    results, Nones are skipped), or None.
+    """
+    extents_list = [extents for extents in extents_list if extents]
+    if not extents_list:
+        return None
+    result = {'points': sum(extents['points'] for extents in extents_list)}
+    for axis in ('lat', 'lng', 'alt'):
+        lows = [extents['min_' + axis] for extents in extents_list if 'min_' + axis in extents]
+        highs = [extents['max_' + axis] for extents in extents_list if 'max_' + axis in extents]
+        if lows:
+            result['min_' + axis] = min(lows)
+            result['max_' + axis] = max(highs)
+    return result
@@ -2,6 +2,9 @@
 from google.appengine.ext import ndb
 from oauth2client.appengine import CredentialsNDBProperty
 
+from raceways import encoding as stream_encoding
+from raceways import simplify
+
 class RacewaysUser(ndb.Model):
     strava_credentials = CredentialsNDBProperty()
     strava_credentials_new = CredentialsNDBProperty()
@@ -40,6 +43,138 @@ class Athlete(ndb.Model):
     shoes = ndb.JsonProperty(repeated=True) # array of summary representations of the athlete's shoes
 
 
+class AthleteSync(ndb.Model):
+    """
+    Per athlete sync watermark, keyed by athlete id.
+    """
+    latest_start_date = ndb.StringProperty()  # start_date of the newest activity seen
+    last_sync = ndb.DateTimeProperty(auto_now=True)
+
+
+class ActivitySummary(ndb.Model):
+    """
+    Per athlete activity totals, keyed by athlete id. See
+    raceways.summary.
+    """
+    buckets = ndb.JsonProperty(compressed=True)  # {bucket key: totals}
+    activity_ids = ndb.IntegerProperty(repeated=True, indexed=False)  # already counted
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class FacetIndex(ndb.Model):
+    """
+    Per athlete inverted index of activities by facet value, keyed by
+    athlete id. See raceways.facets.
+    """
+    postings = ndb.JsonProperty(compressed=True)  # {facet: {value: [sorted activity ids]}}
+    activity_ids = ndb.IntegerProperty(repeated=True, indexed=False)  # already indexed
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ActivityCells(ndb.Model):
+    """
+    The geohash cells an activity passes through, keyed by activity
+    id. See raceways.spatial.
+    """
+    athlete_id = ndb.IntegerProperty()
+    cells = ndb.StringProperty(repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class Route(ndb.Model):
+    """
+    A recurring route: activities of one athlete that follow the same
+    track. See raceways.routes.
+    """
+    athlete_id = ndb.IntegerProperty()
+    activity_ids = ndb.IntegerProperty(repeated=True, indexed=False)  # oldest first
+    start_latlng = ndb.JsonProperty()
+    end_latlng = ndb.JsonProperty()
+    bbox = ndb.JsonProperty()  # [min_lat, min_lng, max_lat, max_lng]
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def make_key_string(cls, athlete_id, activity_id):
+        # routes are named after their first activity, so rebuilding
+        # keeps the same keys for the same routes
+        return "{}|activity={}".format(athlete_id, activity_id)
+
+    @classmethod
+    def create(cls, athlete_id, tracks):
+        """
+        A Route for a cluster of routes.Track, the first of which
+        defines its shape.
+        """
+        leader = tracks[0]
+        return cls(id=cls.make_key_string(athlete_id, leader.activity_id),
+                   athlete_id=int(athlete_id),
+                   activity_ids=[track.activity_id for track in tracks],
+                   start_latlng=[float(value) for value in leader.start],
+                   end_latlng=[float(value) for value in leader.end],
+                   bbox=[float(value) for value in leader.bbox])
+
+
+class SyncJob(ndb.Model):
+    """
+    A batch of background stream fetches, see raceways.jobs. The
+    outcome of each activity is a SyncJobActivity.
+    """
+    athlete_id = ndb.IntegerProperty()
+    resolution = ndb.StringProperty()
+    activity_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+    # only set on jobs from before SyncJobActivity
+    completed_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+    failed_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def progress(self):
+        completed = set(self.completed_ids)
+        failed = set(self.failed_ids)
+        outcomes = ndb.get_multi([SyncJobActivity.make_key(self.key.id(), activity_id)
+                                  for activity_id in self.activity_ids])
+        updated = self.updated
+        for outcome in outcomes:
+            if outcome is None:
+                continue
+            (failed if outcome.failed else completed).add(outcome.activity_id)
+            updated = max(updated, outcome.updated)
+        completed -= failed
+        total = len(self.activity_ids)
+        return {
+            'job_id': self.key.id(),
+            'total': total,
+            'completed': len(completed),
+            'failed': len(failed),
+            'done': len(completed) + len(failed) >= total,
+            'created': self.created,
+            'updated': updated,
+            }
+
+
+class SyncJobActivity(ndb.Model):
+    """
+    How one activity of a SyncJob went. These are root entities, not
+    children of the job, so that concurrent tasks write to different
+    entity groups.
+    """
+    job_id = ndb.IntegerProperty()
+    activity_id = ndb.IntegerProperty()
+    failed = ndb.BooleanProperty(default=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def make_key(cls, job_id, activity_id):
+        return ndb.Key(cls, "{}|{}".format(job_id, activity_id))
+
+    @classmethod
+    def create(cls, job_id, activity_id, failed=False):
+        return cls(key=cls.make_key(job_id, activity_id),
+                   job_id=int(job_id),
+                   activity_id=int(activity_id),
+                   failed=failed)
+
+
 class Activity(ndb.Model):
     resource_state = ndb.IntegerProperty()  # indicates level of detail
     external_id = ndb.StringProperty()  # provided at upload
@@ -88,21 +223,202 @@ class Activity(ndb.Model):
     splits_metric = ndb.JsonProperty() # array of metric split summaries - running activities only
     splits_standard = ndb.JsonProperty() # array of standard split summaries - running activities only
     best_efforts = ndb.JsonProperty() # array of best effort summaries - running activities only
+    stream_extents = ndb.JsonProperty()  # written at ingest, see raceways.metrics.activity_extents
+    updated = ndb.DateTimeProperty(auto_now=True)  # for ETags, None on old entities
+
+    # everything a list of activities needs, and nothing unindexed, so
+    # it can be fetched with a projection query. Keep this in sync
+    # with the composite index in index.yaml.
+    SUMMARY_FIELDS = ('activity_id', 'name', 'type', 'start_date',
+                      'start_date_local', 'distance', 'moving_time',
+                      'elapsed_time', 'total_elevation_gain', 'gear_id',
+                      'location_city', 'location_state', 'location_country',
+                      'commute', 'trainer')
 
 class Stream(ndb.Model):
-    version = 4
+    # version 5 moved the data into the packed blob, see
+    # raceways.encoding. Older versions are still readable through
+    # get_multi_async().
+    version = 5
+    legacy_versions = (4,)
+
+    # roughly how many points strava returns at each resolution. Only
+    # one resolution is fetched, the others are derived from it, see
+    # get_multi_async()
+    RESOLUTION_POINTS = {'low': 100, 'medium': 1000, 'high': 10000}
+    SOURCE_RESOLUTION = 'high'
+
     type = ndb.StringProperty()
-    data = ndb.JsonProperty()
+    data = ndb.JsonProperty()   # only used by version 4 entities
+    packed = ndb.BlobProperty()
+    encoding = ndb.StringProperty(indexed=False)
+    lod = ndb.BlobProperty()    # packed per point significance, see raceways.simplify
+    extents = ndb.JsonProperty()  # bounds and point count, see raceways.metrics
     activity_id = ndb.IntegerProperty()  # not used right now, this is embedded in the id
     series_type = ndb.StringProperty()
     original_size = ndb.IntegerProperty()
     resolution = ndb.StringProperty()   # low, medium or high
 
     @classmethod
-    def make_key_string(cls, activity_id, stream_type, resolution=None):
+    def make_key_string(cls, activity_id, stream_type, resolution=None, version=None):
+        if version is None:
+            version = cls.version
         if not resolution:
-            return "{}|v={}|type={}".format(activity_id, cls.version, stream_type)
+            return "{}|v={}|type={}".format(activity_id, version, stream_type)
         else:
             return "{}|v={}|type={}|resolution={}".format(
-                activity_id, cls.version, stream_type, resolution)
+                activity_id, version, stream_type, resolution)
+
+    @classmethod
+    def make_key(cls, activity_id, stream_type, resolution=None, version=None):
+        return ndb.Key(cls, cls.make_key_string(activity_id, stream_type,
+                                                resolution=resolution,
+                                                version=version))
+
+    @classmethod
+    @ndb.tasklet
+    def get_multi_async(cls, requests, resolution=None):
+        """
+        Load streams for a list of (activity_id, stream_type)
+        pairs. Streams that are missing at the current version are
+        looked up again under the legacy key versions, so old entities
+        are still returned. Missing streams come back as None.
+        """
+        keys = [cls.make_key(activity_id, stream_type, resolution=resolution)
+                for activity_id, stream_type in requests]
+        streams = yield ndb.get_multi_async(keys)
+
+        for version in cls.legacy_versions:
+            missing = [index for index, stream in enumerate(streams)
+                       if stream is None]
+            if not missing:
+                break
+            legacy_keys = [cls.make_key(requests[index][0], requests[index][1],
+                                        resolution=resolution, version=version)
+                           for index in missing]
+            legacy_streams = yield ndb.get_multi_async(legacy_keys)
+            for index, stream in zip(missing, legacy_streams):
+                streams[index] = stream
+
+        if resolution in cls.RESOLUTION_POINTS:
+            # derive missing resolutions from the stored one: high
+            # from the full stream, anything else from high
+            source = cls.SOURCE_RESOLUTION if resolution != cls.SOURCE_RESOLUTION else None
+            missing = [index for index, stream in enumerate(streams)
+                       if stream is None]
+            if missing:
+                sources = yield cls.get_multi_async([requests[index] for index in missing],
+                                                    resolution=source)
+                for index, stream in zip(missing, sources):
+                    if stream is not None:
+                        streams[index] = stream.downsample(requests[index][0], resolution)
+
+        raise ndb.Return(streams)
+
+    @classmethod
+    def from_strava(cls, activity_id, stream, resolution=None):
+        """
+        Build a (new version) entity out of a stream returned by the
+        strava streams API.
+        """
+        stream_record = cls(id=cls.make_key_string(activity_id, stream['type'],
+                                                   resolution=resolution))
+        for key, value in stream.iteritems():
+            if key != 'data':
+                setattr(stream_record, key, value)
+        stream_record.activity_id = int(activity_id)
+        stream_record.set_data(stream.get('data', []))
+        return stream_record
+
+    def downsample(self, activity_id, resolution):
+        """
+        An unsaved copy of this stream at a lower resolution, with
+        points spread evenly like strava's own resolutions.
+        """
+        data = self.get_data()
+        indices = simplify.sample_indices(len(data), self.RESOLUTION_POINTS[resolution])
+        stream = Stream(key=Stream.make_key(activity_id, self.type, resolution=resolution),
+                        type=self.type,
+                        activity_id=self.activity_id,
+                        series_type=self.series_type,
+                        original_size=self.original_size,
+                        resolution=resolution)
+        stream.set_data([data[index] for index in indices])
+        if self.lod:
+            significances = self.get_significance()
+            if len(significances) == len(data):
+                stream.set_significance([significances[index] for index in indices])
+        if self.extents:
+            stream.extents = dict(self.extents, points=len(indices))
+        return stream
+
+    def set_data(self, data, compress=True):
+        self.encoding, self.packed = stream_encoding.encode_stream(
+            self.type, data, compress=compress)
+        self.data = None
 
+    def get_data(self, tolerance=None):
+        """
+        The stream data, simplified to tolerance meters if the stream
+        has significances.
+        """
+        if self.packed is None:
+            data = self.data
+        else:
+            data = stream_encoding.decode_stream(self.type, self.encoding, self.packed)
+        if tolerance and self.lod:
+            significances = self.get_significance()
+            if len(significances) == len(data):
+                data = [data[index] for index in simplify.kept_indices(significances,
+                                                                       tolerance)]
+        return data
+
+    def set_significance(self, significances):
+        self.lod = stream_encoding.pack_ints(significances)
+
+    def get_significance(self):
+        if not self.lod:
+            return None
+        return stream_encoding.unpack_ints(self.lod)
+
+    def to_dict(self, include=None, exclude=None, tolerance=None):
+        wants_data = ((include is None or 'data' in include) and
+                      not (exclude and 'data' in exclude))
+        exclude = set(exclude or ()) | set(['packed', 'encoding', 'lod'])
+        result = super(Stream, self).to_dict(include=include, exclude=exclude)
+        if wants_data:
+            result['data'] = self.get_data(tolerance=tolerance)
+            if tolerance:
+                result['tolerance'] = tolerance
+        return result
+
+
+class ProximityIndex(ndb.Model):
+    """
+    Per athlete counts of how many activities pass through each cell
+    of a buckets^3 grid, from the Stream.SOURCE_RESOLUTION streams.
+    See raceways.proximity.
+    """
+    athlete_id = ndb.IntegerProperty()
+    resolution = ndb.StringProperty()
+    buckets = ndb.IntegerProperty()
+    extents = ndb.JsonProperty()  # {min_lng:, max_lng:, min_lat:, ...}
+    activity_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+    packed_ids = ndb.BlobProperty()     # sorted bucket ids
+    packed_counts = ndb.BlobProperty()  # activity count for each id
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def make_key_string(cls, athlete_id):
+        return "{}|v=2".format(athlete_id)
+
+    @classmethod
+    def make_key(cls, athlete_id):
+        return ndb.Key(cls, cls.make_key_string(athlete_id))
+
+    @classmethod
+    def create(cls, athlete_id, buckets):
+        return cls(key=cls.make_key(athlete_id),
+                   athlete_id=int(athlete_id),
+                   resolution=Stream.SOURCE_RESOLUTION,
+                   buckets=buckets)
@@ -0,0 +1,307 @@
+"""
+Server side version of StreamSet.generate_proximity_streams().
+
+The space covered by all of an athlete's activities is divided into
+buckets x buckets x buckets cells along lng, lat and altitude. Each
+cell counts how many distinct activities pass through it, and the
+proximity of a point is the count of the cell it falls in.
+
+The counts are stored in one model.ProximityIndex per athlete, with
+DEFAULT_BUCKETS, built from the Stream.SOURCE_RESOLUTION streams and
+kept up to date as new streams are ingested. Indexes with other
+bucket counts are built on request and not stored.
+"""
+import logging
+import zlib
+
+import numpy
+from google.appengine.ext import ndb
+
+from raceways import model
+
+DEFAULT_BUCKETS = 40
+
+# bucket ids are packed as int32, which is plenty for (buckets + 1)^3
+# at this size, and other bucket counts load every stream per request
+MIN_BUCKETS = 1
+MAX_BUCKETS = 255
+
+AXES = ('lng', 'lat', 'alt')
+
+# stream tasks update the index concurrently
+TRANSACTION_RETRIES = 10
+
+MAX_REBUILDS = 3
+
+
+def stream_coordinates(latlng, altitude):
+    """
+    Turn latlng/altitude stream data into an (n, 3) array of [lng,
+    lat, alt]. Like the geojson built in streamset.js, missing
+    altitudes become 0.
+    """
+    coords = numpy.zeros((len(latlng), 3))
+    if not len(latlng):
+        return coords
+    latlng = numpy.asarray(latlng, dtype=float)
+    coords[:, 0] = latlng[:, 1]
+    coords[:, 1] = latlng[:, 0]
+    if altitude is not None and len(altitude) == len(latlng):
+        coords[:, 2] = altitude
+    return coords
+
+
+def coordinate_extents(coordinate_arrays):
+    """
+    Returns {'min_lng': .., 'max_lng': .., ...} over all the given
+    coordinate arrays, or None if there are no points at all.
+    """
+    coordinate_arrays = [coords for coords in coordinate_arrays if len(coords)]
+    if not coordinate_arrays:
+        return None
+    mins = numpy.min([coords.min(axis=0) for coords in coordinate_arrays], axis=0)
+    maxes = numpy.max([coords.max(axis=0) for coords in coordinate_arrays], axis=0)
+    result = {}
+    for axis, low, high in zip(AXES, mins, maxes):
+        result['min_' + axis] = float(low)
+        result['max_' + axis] = float(high)
+    return result
+
+
+def within_extents(extents, coords):
+    if not len(coords):
+        return True
+    mins = coords.min(axis=0)
+    maxes = coords.max(axis=0)
+    for axis, low, high in zip(AXES, mins, maxes):
+        if low < extents['min_' + axis] or high > extents['max_' + axis]:
+            return False
+    return True
+
+
+def bucket_ids(coords, extents, buckets):
+    """
+    Flattened bucket id of every point. This matches the d3 scales in
+    generate_proximity_streams: rangeRound([0, buckets]) with clamping,
+    so there are buckets + 1 cells along each axis.
+    """
+    cells = numpy.zeros(coords.shape, dtype=numpy.int64)
+    for index, axis in enumerate(AXES):
+        low = extents['min_' + axis]
+        span = extents['max_' + axis] - low
+        if span > 0:
+            # d3 rounds half up, numpy.rint rounds half to even
+            scaled = numpy.floor((coords[:, index] - low) / span * buckets + 0.5)
+            cells[:, index] = numpy.clip(scaled, 0, buckets)
+    side = buckets + 1
+    return (cells[:, 0] * side + cells[:, 1]) * side + cells[:, 2]
+
+
+def merge_counts(ids, counts, activity_buckets):
+    """
+    Add one to the count of every bucket in each of activity_buckets
+    (arrays of unique bucket ids), returning new sorted (ids, counts).
+    """
+    all_ids = numpy.concatenate([ids] + list(activity_buckets))
+    all_counts = numpy.concatenate(
+        [counts] + [numpy.ones(len(b), dtype=numpy.int64) for b in activity_buckets])
+    merged_ids, inverse = numpy.unique(all_ids, return_inverse=True)
+    merged_counts = numpy.bincount(inverse, weights=all_counts)
+    return merged_ids.astype(numpy.int64), merged_counts.astype(numpy.int64)
+
+
+def proximity(point_ids, ids, counts):
+    """
+    Look up the count of the bucket each point falls in.
+    """
+    if not len(ids):
+        return numpy.zeros(len(point_ids), dtype=numpy.int64)
+    positions = numpy.searchsorted(ids, point_ids)
+    positions = numpy.clip(positions, 0, len(ids) - 1)
+    return numpy.where(ids[positions] == point_ids, counts[positions], 0)
+
+
+def pack(values):
+    return zlib.compress(numpy.asarray(values, dtype='<i4').tostring())
+
+
+def unpack(blob):
+    if not blob:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.frombuffer(zlib.decompress(blob), dtype='<i4').astype(numpy.int64)
+
+
+def set_counts(index, ids, counts):
+    index.packed_ids = pack(ids)
+    index.packed_counts = pack(counts)
+
+
+def get_counts(index):
+    """
+    Returns the (ids, counts) arrays stored in a model.ProximityIndex.
+    """
+    return unpack(index.packed_ids), unpack(index.packed_counts)
+
+
+@ndb.tasklet
+def load_coordinates_async(activity_ids, resolution=None):
+    """
+    Returns {activity_id: coords} for every activity that has a
+    stored latlng stream.
+    """
+    requests = []
+    for activity_id in activity_ids:
+        requests.append((activity_id, 'latlng'))
+        requests.append((activity_id, 'altitude'))
+    streams = yield model.Stream.get_multi_async(requests, resolution=resolution)
+
+    result = {}
+    for index, activity_id in enumerate(activity_ids):
+        latlng, altitude = streams[2 * index], streams[2 * index + 1]
+        if latlng is None:
+            continue
+        latlng_data = latlng.get_data()
+        if not latlng_data:
+            continue
+        result[int(activity_id)] = stream_coordinates(
+            latlng_data, altitude.get_data() if altitude else None)
+    raise ndb.Return(result)
+
+
+def build_index(index, coordinates):
+    """
+    (Re)build the counts of the given model.ProximityIndex from
+    scratch, using {activity_id: coords}.
+    """
+    extents = coordinate_extents(coordinates.values())
+    index.extents = extents
+    index.activity_ids = sorted(coordinates.keys())
+    ids = counts = numpy.zeros(0, dtype=numpy.int64)
+    if extents:
+        ids, counts = merge_counts(
+            ids, counts,
+            [numpy.unique(bucket_ids(coords, extents, index.buckets))
+             for coords in coordinates.values()])
+    set_counts(index, ids, counts)
+    return index
+
+
+@ndb.tasklet
+def rebuild_index_async(athlete_id, buckets=DEFAULT_BUCKETS, store=True):
+    """
+    Build the index from every stored stream. The stored index is
+    only replaced if it has no activities the rebuild didn't see,
+    i.e. no update_index_async() got in while it was loading.
+    """
+    for attempt in xrange(MAX_REBUILDS):
+        activity_keys = yield model.Activity.query(
+            model.Activity.athlete_id == int(athlete_id)).fetch_async(keys_only=True)
+        coordinates = yield load_coordinates_async(
+            [key.id() for key in activity_keys], resolution=model.Stream.SOURCE_RESOLUTION)
+        index = model.ProximityIndex.create(athlete_id, buckets)
+        build_index(index, coordinates)
+        if not store:
+            break
+        stored = yield _put_rebuilt_async(index)
+        if stored:
+            break
+    else:
+        logging.warning("Proximity index of athlete %s kept changing, gave up rebuilding",
+                        athlete_id)
+    raise ndb.Return(index)
+
+
+@ndb.transactional_tasklet(retries=TRANSACTION_RETRIES)
+def _put_rebuilt_async(index):
+    stored = yield index.key.get_async()
+    if stored is not None and set(stored.activity_ids) - set(index.activity_ids):
+        raise ndb.Return(False)
+    yield index.put_async()
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def get_index_async(athlete_id, buckets=DEFAULT_BUCKETS):
+    """
+    Returns the stored index, building it if it doesn't exist yet, or
+    an unstored one for other numbers of buckets.
+    """
+    if buckets != DEFAULT_BUCKETS:
+        index = yield rebuild_index_async(athlete_id, buckets, store=False)
+        raise ndb.Return(index)
+    index = yield model.ProximityIndex.make_key(athlete_id).get_async()
+    if index is None:
+        index = yield rebuild_index_async(athlete_id)
+    raise ndb.Return(index)
+
+
+@ndb.tasklet
+def update_index_async(athlete_id, new_streams):
+    """
+    Add newly ingested activities to the athlete's index.
+
+    new_streams maps activity_id to {'latlng': [...], 'altitude':
+    [...]}. If every new point fits in the existing extents, only the
+    counts of the buckets the new activities pass through change, in
+    a transaction since stream tasks run concurrently. Otherwise the
+    scales move and the whole index is rebuilt.
+    """
+    coordinates = {}
+    for activity_id, streams in new_streams.iteritems():
+        if streams.get('latlng'):
+            coordinates[int(activity_id)] = stream_coordinates(
+                streams['latlng'], streams.get('altitude'))
+    if not coordinates:
+        return
+
+    index = yield _merge_async(athlete_id, coordinates)
+    if index is None:
+        index = yield rebuild_index_async(athlete_id)
+    raise ndb.Return(index)
+
+
+@ndb.transactional_tasklet(retries=TRANSACTION_RETRIES)
+def _merge_async(athlete_id, coordinates):
+    """
+    Merge {activity_id: coords} into the stored index. Returns None if
+    it needs rebuilding instead.
+    """
+    index = yield model.ProximityIndex.make_key(athlete_id).get_async()
+    if index is None or not index.extents:
+        raise ndb.Return(None)
+
+    known = set(index.activity_ids)
+    coordinates = dict((activity_id, coords) for activity_id, coords in coordinates.iteritems()
+                       if activity_id not in known)
+    if not coordinates:
+        raise ndb.Return(index)
+    if not all(within_extents(index.extents, coords) for coords in coordinates.values()):
+        raise ndb.Return(None)
+
+    ids, counts = get_counts(index)
+    ids, counts = merge_counts(
+        ids, counts,
+        [numpy.unique(bucket_ids(coords, index.extents, index.buckets))
+         for coords in coordinates.values()])
+    set_counts(index, ids, counts)
+    index.activity_ids = sorted(known | set(coordinates.keys()))
+    yield index.put_async()
+    raise ndb.Return(index)
+
+
+@ndb.tasklet
+def proximity_streams_async(index, activity_ids, resolution=None):
+    """
+    Returns {activity_id: [proximity, ...]} with one value per point
+    of the activity's latlng stream.
+    """
+    coordinates = yield load_coordinates_async(activity_ids, resolution=resolution)
+    ids, counts = get_counts(index)
+    result = {}
+    for activity_id, coords in coordinates.iteritems():
+        if not index.extents:
+            result[activity_id] = [0] * len(coords)
+            continue
+        point_ids = bucket_ids(coords, index.extents, index.buckets)
+        result[activity_id] = proximity(point_ids, ids, counts).tolist()
+    raise ndb.Return(result)
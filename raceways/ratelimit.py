@@ -0,0 +1,353 @@
+"""
+Scheduling of requests to the strava API.
+
+Strava limits each application to a number of requests per 15 minutes
+and per day. Every request goes through the Scheduler, which keeps
+token buckets for the app as a whole and for each athlete, and caps
+the number of requests in flight per instance.
+
+Requests are either INTERACTIVE (page loads) or BACKFILL (bulk syncs
+from the task queue). Backfill requests are only admitted while the
+budgets are less than BACKFILL_MAX_UTILISATION used and can't take the
+last INTERACTIVE_RESERVED concurrency slots, so a big sync never
+starves the site. When a request can't be admitted RateLimited is
+raised with the number of seconds to wait.
+
+The bucket levels are shared between instances through memcache, and
+corrected from the X-RateLimit-Usage/X-RateLimit-Limit headers strava
+sends back. A 429 response stops all requests until the current 15
+minute window is over. The store is only used through the ndb
+context's asynchronous memcache calls, and admitting a request takes
+one batched round for all of its buckets, so requests in flight
+together aren't held up by each other's bookkeeping.
+"""
+import logging
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+INTERACTIVE = 'interactive'
+BACKFILL = 'backfill'
+
+SHORT_PERIOD = 15 * 60
+DAILY_PERIOD = 24 * 60 * 60
+SHORT_LIMIT = 600
+DAILY_LIMIT = 30000
+
+# no single athlete gets more than this per 15 minutes
+ATHLETE_SHORT_LIMIT = 200
+
+BACKFILL_MAX_UTILISATION = 0.75
+
+MAX_CONCURRENT = 10
+INTERACTIVE_RESERVED = 4
+
+# how often to check for a free slot when MAX_CONCURRENT are in flight
+CONCURRENCY_POLL_SECONDS = 0.05
+
+BACKOFF_KEY = 'ratelimit|backoff_until'
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(
+            "Strava rate limit reached, retry in {}s".format(int(retry_after)))
+        self.retry_after = retry_after
+
+
+def _completed(value):
+    future = ndb.Future()
+    future.set_result(value)
+    return future
+
+
+class MemcacheStore(object):
+    """
+    Shares bucket state between instances. Everything goes through the
+    ndb context's memcache calls, which are batched and don't block the
+    event loop. update_multi_async() is a compare-and-set loop, so
+    concurrent updates don't get lost.
+    """
+    def __init__(self, retries=5):
+        self.retries = retries
+
+    @ndb.tasklet
+    def update_multi_async(self, fns):
+        """
+        fns is {key: fn}, where fn takes the current value (or None)
+        and returns a tuple of (new_value, result). Every key is read
+        and written in the same round. Returns {key: result}.
+        """
+        context = ndb.get_context()
+        results = {}
+        pending = dict(fns)
+        for i in xrange(self.retries):
+            keys = sorted(pending)
+            values = yield [context.memcache_gets(key) for key in keys]
+            writes = []
+            for key, value in zip(keys, values):
+                new_value, results[key] = pending[key](value)
+                if value is None:
+                    writes.append(context.memcache_add(key, new_value, time=DAILY_PERIOD))
+                else:
+                    writes.append(context.memcache_cas(key, new_value, time=DAILY_PERIOD))
+            stored = yield writes
+            pending = dict((key, pending[key]) for key, ok in zip(keys, stored) if not ok)
+            if not pending:
+                break
+        else:
+            logging.warning("Lost the race for %s %d times", sorted(pending), self.retries)
+        raise ndb.Return(results)
+
+    @ndb.tasklet
+    def get_multi_async(self, keys):
+        context = ndb.get_context()
+        values = yield [context.memcache_get(key) for key in keys]
+        raise ndb.Return(values)
+
+    def set_async(self, key, value, time=0):
+        return ndb.get_context().memcache_set(key, value, time=time)
+
+
+class LocalStore(object):
+    """
+    In-process stand-in for MemcacheStore, for tests.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def update_multi_async(self, fns):
+        results = {}
+        with self.lock:
+            for key, fn in fns.iteritems():
+                self.values[key], results[key] = fn(self.values.get(key))
+        return _completed(results)
+
+    def get_multi_async(self, keys):
+        return _completed([self.values.get(key) for key in keys])
+
+    def set_async(self, key, value, time=0):
+        self.values[key] = value
+        return _completed(True)
+
+
+class TokenBucket(object):
+    """
+    capacity tokens, refilled evenly over period seconds. State is a
+    (tokens, timestamp) tuple in the store. take(), give_back() and
+    set_usage() return updates for store.update_multi_async(), so
+    several buckets are updated in one round.
+    """
+    def __init__(self, key, capacity, period):
+        self.key = key
+        self.capacity = capacity
+        self.rate = capacity / float(period)
+
+    def _tokens(self, state, now):
+        if state is None:
+            return float(self.capacity)
+        tokens, updated = state
+        return min(float(self.capacity), tokens + (now - updated) * self.rate)
+
+    def _wait(self, tokens, max_utilisation):
+        needed = 1 + self.capacity * (1 - max_utilisation) - tokens
+        return max(0.0, needed / self.rate)
+
+    def take(self, now, max_utilisation=1.0):
+        """
+        Take a token, as long as that leaves the bucket no more than
+        max_utilisation used. The update's result is a tuple of
+        (taken, seconds until a token could be taken).
+        """
+        def fn(state):
+            tokens = self._tokens(state, now)
+            if self.capacity - tokens + 1 <= self.capacity * max_utilisation:
+                return (tokens - 1, now), (True, 0.0)
+            return (tokens, now), (False, self._wait(tokens, max_utilisation))
+        return fn
+
+    def give_back(self, now):
+        def fn(state):
+            return (min(float(self.capacity), self._tokens(state, now) + 1), now), None
+        return fn
+
+    def set_usage(self, now, usage, limit):
+        """
+        Make sure the bucket is at least as empty as strava says it is.
+        """
+        remaining = self.capacity * (1 - float(usage) / limit)
+        def fn(state):
+            return (min(self._tokens(state, now), remaining), now), None
+        return fn
+
+    def utilisation(self, state, now):
+        return 1 - self._tokens(state, now) / self.capacity
+
+    def retry_after(self, state, now, max_utilisation=1.0):
+        """
+        Seconds until take() would succeed again.
+        """
+        return self._wait(self._tokens(state, now), max_utilisation)
+
+
+def _header(headers, name):
+    """
+    Case insensitive header lookup, urlfetch and httplib2 disagree.
+    """
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+class Scheduler(object):
+    def __init__(self, store=None, max_concurrent=MAX_CONCURRENT, clock=time.time):
+        self.store = store or MemcacheStore()
+        self.max_concurrent = max_concurrent
+        self.clock = clock
+        self.short_bucket = TokenBucket('ratelimit|app|short', SHORT_LIMIT, SHORT_PERIOD)
+        self.daily_bucket = TokenBucket('ratelimit|app|daily', DAILY_LIMIT, DAILY_PERIOD)
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def athlete_bucket(self, athlete_id):
+        return TokenBucket('ratelimit|athlete|{}'.format(athlete_id),
+                           ATHLETE_SHORT_LIMIT, SHORT_PERIOD)
+
+    @ndb.tasklet
+    def _try_acquire_async(self, athlete_id, priority):
+        slots = self.max_concurrent
+        max_utilisation = 1.0
+        if priority == BACKFILL:
+            slots -= INTERACTIVE_RESERVED
+            max_utilisation = BACKFILL_MAX_UTILISATION
+
+        with self.lock:
+            if self.active >= slots:
+                raise ndb.Return(False)
+            self.active += 1
+
+        now = self.clock()
+        buckets = [self.short_bucket, self.daily_bucket]
+        if athlete_id is not None:
+            buckets.append(self.athlete_bucket(athlete_id))
+        try:
+            # the backoff is rare, so check it in the same round as
+            # taking the tokens, and give them back if it is on
+            (backoff_until,), taken = yield (
+                self.store.get_multi_async([BACKOFF_KEY]),
+                self.store.update_multi_async(dict(
+                    (bucket.key, bucket.take(now, max_utilisation)) for bucket in buckets)))
+            refused = [wait for ok, wait in taken.itervalues() if not ok]
+            if backoff_until and backoff_until > now:
+                refused.append(backoff_until - now)
+            if refused:
+                give_back = dict((bucket.key, bucket.give_back(now))
+                                 for bucket in buckets if taken[bucket.key][0])
+                if give_back:
+                    yield self.store.update_multi_async(give_back)
+                raise RateLimited(max(refused))
+        except:
+            self.release()
+            raise
+        raise ndb.Return(True)
+
+    @ndb.tasklet
+    def acquire_async(self, athlete_id=None, priority=INTERACTIVE):
+        """
+        Wait for a free slot and take a token from each bucket. Every
+        acquire must be matched with a release().
+        """
+        while True:
+            acquired = yield self._try_acquire_async(athlete_id, priority)
+            if acquired:
+                break
+            yield ndb.sleep(CONCURRENCY_POLL_SECONDS)
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    @ndb.tasklet
+    def record_response_async(self, headers=None, status_code=None):
+        """
+        Correct the buckets from strava's rate limit headers, and back
+        off everything after a 429.
+        """
+        now = self.clock()
+        futures = []
+        updates = self.usage_updates(headers, now)
+        if updates:
+            futures.append(self.store.update_multi_async(updates))
+        if status_code == 429:
+            # strava's windows start on the quarter hour
+            backoff_until = now - now % SHORT_PERIOD + SHORT_PERIOD
+            logging.warning("Got a 429 from strava, backing off for %ds",
+                            backoff_until - now)
+            futures.append(self.store.set_async(BACKOFF_KEY, backoff_until, time=SHORT_PERIOD))
+        if futures:
+            yield futures
+
+    def usage_updates(self, headers, now):
+        usage = _header(headers, 'X-RateLimit-Usage')
+        limit = _header(headers, 'X-RateLimit-Limit')
+        if not usage or not limit:
+            return {}
+        try:
+            usage = [int(value) for value in usage.split(',')]
+            limit = [int(value) for value in limit.split(',')]
+        except ValueError:
+            logging.warning("Unparseable rate limit headers: %r / %r", usage, limit)
+            return {}
+        return dict((bucket.key, bucket.set_usage(now, bucket_usage, bucket_limit))
+                    for bucket, bucket_usage, bucket_limit in zip(
+                        (self.short_bucket, self.daily_bucket), usage, limit)
+                    if bucket_limit)
+
+    @ndb.tasklet
+    def retry_after_async(self):
+        now = self.clock()
+        backoff_until, short_state, daily_state = yield self.store.get_multi_async(
+            [BACKOFF_KEY, self.short_bucket.key, self.daily_bucket.key])
+        raise ndb.Return(max((backoff_until or now) - now,
+                             self.short_bucket.retry_after(short_state, now),
+                             self.daily_bucket.retry_after(daily_state, now)))
+
+    @ndb.tasklet
+    def utilisation_async(self, athlete_id=None):
+        now = self.clock()
+        buckets = [self.short_bucket, self.daily_bucket]
+        if athlete_id is not None:
+            buckets.append(self.athlete_bucket(athlete_id))
+        values = yield self.store.get_multi_async(
+            [BACKOFF_KEY] + [bucket.key for bucket in buckets])
+        states = dict((bucket.key, state) for bucket, state in zip(buckets, values[1:]))
+        result = {
+            'short': self.short_bucket.utilisation(states[self.short_bucket.key], now),
+            'daily': self.daily_bucket.utilisation(states[self.daily_bucket.key], now),
+            'active': self.active,
+            'max_concurrent': self.max_concurrent,
+            'backoff_until': values[0],
+            }
+        if athlete_id is not None:
+            result['athlete'] = buckets[2].utilisation(states[buckets[2].key], now)
+        raise ndb.Return(result)
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
+
+
+def set_scheduler(scheduler):
+    global _scheduler
+    _scheduler = scheduler
@@ -0,0 +1,261 @@
+"""
+Detection of recurring routes ("raceways").
+
+An athlete's activities are clustered into routes: groups of
+activities that start and end in the same places and follow the same
+track in between. This is the server side, offline version of what
+generate_proximity_streams approximates visually in the browser.
+
+Comparing tracks is expensive, so candidates are narrowed down first:
+
+1. Each route is indexed by the grid cells (START_CELL_DEGREES wide)
+   of its first activity's start and end points. An activity is only
+   compared with routes whose cells neighbor its own.
+2. Their bounding boxes must agree to within BBOX_SLACK meters.
+3. Finally the discrete Frechet distance between the activity's track
+   and the route's first track, both simplified to SIMPLIFY_TOLERANCE
+   and resampled to evenly spaced points, must be under MAX_FRECHET
+   meters.
+
+Clustering is greedy: activities are taken oldest first, and each one
+joins the first matching route or starts a new one.
+
+The routes with at least MIN_ACTIVITIES activities are stored as
+model.Route entities by rebuild_routes_async(), which runs on the task
+queue (see RouteTaskHandler).
+"""
+import logging
+import math
+from collections import defaultdict, namedtuple
+
+import numpy
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from raceways import model
+from raceways.simplify import EARTH_RADIUS
+
+ROUTE_TASK_URL = '/tasks/routes'
+
+START_CELL_DEGREES = 0.005  # about 550m north-south
+
+BBOX_SLACK = 500.0  # meters
+
+MAX_FRECHET = 200.0  # meters
+
+SIMPLIFY_TOLERANCE = 25  # meters, one of simplify.LEVELS
+
+# simplified tracks are resampled to a point every SAMPLE_SPACING
+# meters, but no more than MAX_POINTS points, which bounds each
+# comparison to MAX_POINTS^2
+SAMPLE_SPACING = 50.0
+MAX_POINTS = 150
+
+MIN_ACTIVITIES = 2
+
+# streams are loaded this many activities at a time
+LOAD_BATCH_SIZE = 100
+
+Track = namedtuple('Track', 'activity_id start end bbox points')
+
+
+def resample(points, count):
+    """
+    count points evenly spaced along the track through points, so
+    that the discrete Frechet distance between two tracks isn't thrown
+    off by where their vertices happen to be.
+    """
+    cos_lat = math.cos(math.radians(points[0, 0]))
+    steps = numpy.sqrt((numpy.diff(to_meters(points, cos_lat), axis=0) ** 2).sum(axis=1))
+    along = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+    if along[-1] == 0:
+        return points[:1]
+    targets = numpy.linspace(0, along[-1], count)
+    return numpy.column_stack((numpy.interp(targets, along, points[:, 0]),
+                               numpy.interp(targets, along, points[:, 1])))
+
+
+def track_length(points):
+    cos_lat = math.cos(math.radians(points[0, 0]))
+    return numpy.sqrt((numpy.diff(to_meters(points, cos_lat), axis=0) ** 2).sum(axis=1)).sum()
+
+
+def make_track(activity_id, latlng, start=None, end=None):
+    """
+    A Track from a simplified latlng stream, resampled to a point
+    every SAMPLE_SPACING meters, or MAX_POINTS points for long tracks.
+    start and end default to the stream's first and last points.
+    """
+    points = numpy.asarray(latlng, dtype=float)
+    count = int(min(MAX_POINTS, max(2, track_length(points) / SAMPLE_SPACING + 1)))
+    points = resample(points, count)
+    if start is None:
+        start = points[0]
+    if end is None:
+        end = points[-1]
+    bbox = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+    return Track(activity_id, tuple(start), tuple(end), bbox, points)
+
+
+def cell(latlng):
+    return (int(math.floor(latlng[0] / START_CELL_DEGREES)),
+            int(math.floor(latlng[1] / START_CELL_DEGREES)))
+
+
+def neighbors(cell_id):
+    row, column = cell_id
+    return [(row + d_row, column + d_column)
+            for d_row in (-1, 0, 1) for d_column in (-1, 0, 1)]
+
+
+def to_meters(points, cos_lat):
+    radians = numpy.radians(points)
+    return numpy.column_stack((radians[:, 1] * cos_lat * EARTH_RADIUS,
+                               radians[:, 0] * EARTH_RADIUS))
+
+
+def bbox_close(a, b, cos_lat):
+    slack_lat = math.degrees(BBOX_SLACK / EARTH_RADIUS)
+    slack_lng = slack_lat / cos_lat
+    return (abs(a[0] - b[0]) <= slack_lat and abs(a[2] - b[2]) <= slack_lat and
+            abs(a[1] - b[1]) <= slack_lng and abs(a[3] - b[3]) <= slack_lng)
+
+
+def frechet_within(p, q, threshold):
+    """
+    Whether the discrete Frechet distance between point arrays p and q
+    (in meters) is at most threshold.
+
+    This is the decision version: a pair of points is free if they are
+    within threshold, and the answer is whether the last pair can be
+    reached from the first through free pairs, moving forward on p, q
+    or both. Each row is computed from the one before with a handful
+    of vectorized operations: a free pair is reachable if its run of
+    free pairs in the row was entered at or before it.
+    """
+    distances = numpy.sqrt(((p[:, numpy.newaxis, :] - q[numpy.newaxis, :, :]) ** 2).sum(axis=2))
+    free = distances <= threshold
+    if not free[0, 0] or not free[-1, -1]:
+        return False
+    # cheap rejection: every point needs a partner within threshold
+    if not free.any(axis=1).all() or not free.any(axis=0).all():
+        return False
+
+    columns = numpy.arange(free.shape[1])
+    entered = numpy.zeros(free.shape[1], dtype=bool)
+    entered[0] = True
+    for row in free:
+        entry = entered & row
+        last_entry = numpy.maximum.accumulate(numpy.where(entry, columns, -1))
+        run_start = numpy.maximum.accumulate(numpy.where(row, 0, columns + 1))
+        reachable = row & (last_entry >= run_start)
+        if not reachable.any():
+            return False
+        # the next row can be entered from straight above, or diagonally
+        entered = reachable.copy()
+        entered[1:] |= reachable[:-1]
+    return bool(reachable[-1])
+
+
+class Clusterer(object):
+    """
+    Greedy clustering of Tracks, see the module docstring. Tracks are
+    add()ed oldest first. routes is a list of lists of Tracks, the
+    first of which is the one the others were compared with. stats
+    counts how many candidates each stage let through.
+    """
+    def __init__(self, max_frechet=MAX_FRECHET):
+        self.max_frechet = max_frechet
+        self.routes = []
+        self.by_cells = defaultdict(list)
+        self.stats = defaultdict(int)
+
+    def add(self, track):
+        cos_lat = math.cos(math.radians(track.start[0]))
+        start_cells = neighbors(cell(track.start))
+        end_cells = neighbors(cell(track.end))
+        seen = set()
+        for start_cell in start_cells:
+            for end_cell in end_cells:
+                for route_index in self.by_cells.get((start_cell, end_cell), ()):
+                    if route_index in seen:
+                        continue
+                    seen.add(route_index)
+                    self.stats['cell_candidates'] += 1
+                    leader = self.routes[route_index][0]
+                    if not bbox_close(leader.bbox, track.bbox, cos_lat):
+                        continue
+                    self.stats['frechet_comparisons'] += 1
+                    if frechet_within(to_meters(leader.points, cos_lat),
+                                      to_meters(track.points, cos_lat),
+                                      self.max_frechet):
+                        self.routes[route_index].append(track)
+                        return route_index
+
+        self.routes.append([track])
+        route_index = len(self.routes) - 1
+        self.by_cells[(cell(track.start), cell(track.end))].append(route_index)
+        return route_index
+
+
+@ndb.tasklet
+def load_tracks_async(athlete_id, resolution=model.Stream.SOURCE_RESOLUTION):
+    """
+    Tracks for all of the athlete's activities with a latlng stream,
+    oldest first.
+    """
+    activities = yield model.Activity.query(
+        model.Activity.athlete_id == int(athlete_id)).fetch_async()
+    activities.sort(key=lambda activity: activity.start_date)
+
+    tracks = []
+    for offset in xrange(0, len(activities), LOAD_BATCH_SIZE):
+        batch = activities[offset:offset + LOAD_BATCH_SIZE]
+        streams = yield model.Stream.get_multi_async(
+            [(activity.key.id(), 'latlng') for activity in batch], resolution=resolution)
+        for activity, stream in zip(batch, streams):
+            if stream is None:
+                continue
+            latlng = stream.get_data(tolerance=SIMPLIFY_TOLERANCE)
+            if not latlng:
+                continue
+            tracks.append(make_track(activity.key.id(), latlng,
+                                     start=activity.start_latlng or None,
+                                     end=activity.end_latlng or None))
+    raise ndb.Return(tracks)
+
+
+@ndb.tasklet
+def rebuild_routes_async(athlete_id, resolution=model.Stream.SOURCE_RESOLUTION):
+    """
+    Recluster all of the athlete's activities, replacing their stored
+    routes.
+    """
+    tracks = yield load_tracks_async(athlete_id, resolution=resolution)
+    if not tracks:
+        # more likely the streams aren't there (yet) than that every
+        # route is gone, so keep what we have
+        logging.warning("No tracks for athlete %s at resolution %s, keeping their routes",
+                        athlete_id, resolution)
+        raise ndb.Return([])
+    clusterer = Clusterer()
+    for track in tracks:
+        clusterer.add(track)
+    logging.info("Clustered %d activities of athlete %s into %d routes: %r",
+                 len(tracks), athlete_id, len(clusterer.routes), dict(clusterer.stats))
+
+    routes = [model.Route.create(athlete_id, tracks)
+              for tracks in clusterer.routes if len(tracks) >= MIN_ACTIVITIES]
+    old_keys = yield model.Route.query(
+        model.Route.athlete_id == int(athlete_id)).fetch_async(keys_only=True)
+    new_keys = set(route.key for route in routes)
+    yield (ndb.delete_multi_async([key for key in old_keys if key not in new_keys]),
+           ndb.put_multi_async(routes))
+    raise ndb.Return(routes)
+
+
+def enqueue_rebuild(athlete_id, resolution=model.Stream.SOURCE_RESOLUTION):
+    taskqueue.add(url=ROUTE_TASK_URL, params={
+        'athlete_id': athlete_id,
+        'resolution': resolution,
+        })
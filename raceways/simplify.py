@@ -0,0 +1,121 @@
+"""
+Douglas-Peucker simplification of latlng streams.
+
+Rather than storing a separate simplified copy of a stream for every
+tolerance, significance() runs Douglas-Peucker once and records, for
+every point, the largest tolerance (in meters) at which it would still
+be kept. The simplification at tolerance t is then just the points
+whose significance is above t, which is exactly what Douglas-Peucker
+run with tolerance t would produce.
+
+Streams are served at one of LEVELS, so responses for nearby
+tolerances or zooms are shared.
+"""
+import math
+
+import numpy
+
+# tolerances in meters, 0 being the raw stream
+LEVELS = (0, 2, 5, 10, 25, 50, 100, 250)
+
+# anything that would only be dropped below the smallest level is
+# never dropped, so don't bother refining it
+MIN_TOLERANCE = LEVELS[1]
+
+# stored significances are whole decimeters
+KEEP_ALWAYS = 2 ** 31 - 1
+
+EARTH_RADIUS = 6371000.0
+
+# meters per pixel at zoom 0 at the equator, in web mercator
+METERS_PER_PIXEL_AT_ZOOM_0 = 156543.03
+
+
+def project(latlng):
+    """
+    Equirectangular projection to meters around the mean latitude,
+    good enough at the scale of a single activity.
+    """
+    latlng = numpy.radians(numpy.asarray(latlng, dtype=float))
+    cos_lat = math.cos(latlng[:, 0].mean())
+    return numpy.column_stack((latlng[:, 1] * cos_lat * EARTH_RADIUS,
+                               latlng[:, 0] * EARTH_RADIUS))
+
+
+def segment_distances(points, start, end):
+    """
+    Distance of each of points from the segment start-end.
+    """
+    direction = end - start
+    length_squared = numpy.dot(direction, direction)
+    if length_squared == 0:
+        offsets = points - start
+    else:
+        t = numpy.clip(numpy.dot(points - start, direction) / length_squared, 0, 1)
+        offsets = points - (start + numpy.outer(t, direction))
+    return numpy.sqrt((offsets ** 2).sum(axis=1))
+
+
+def significance(latlng):
+    """
+    Returns a list with the significance of every point of a latlng
+    stream, in decimeters. The first and last points are KEEP_ALWAYS.
+    """
+    count = len(latlng)
+    result = numpy.zeros(count)
+    if count == 0:
+        return []
+    result[0] = result[-1] = numpy.inf
+    points = project(latlng)
+
+    stack = [(0, count - 1, numpy.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(points[first + 1:last], points[first], points[last])
+        index = int(distances.argmax())
+        # a point can't outlive the split that exposed it
+        distance = min(distances[index], parent)
+        if distance < MIN_TOLERANCE:
+            result[first + 1:last] = numpy.minimum(distances, parent)
+            continue
+        split = first + 1 + index
+        result[split] = distance
+        stack.append((first, split, distance))
+        stack.append((split, last, distance))
+
+    result = numpy.minimum(result * 10, KEEP_ALWAYS)
+    return result.astype(numpy.int64).tolist()
+
+
+def kept_indices(significances, tolerance):
+    """
+    Indices of the points to keep when simplifying to tolerance
+    meters.
+    """
+    significances = numpy.asarray(significances)
+    return numpy.flatnonzero(significances > tolerance * 10)
+
+
+def sample_indices(length, count):
+    """
+    Indices of count points spread evenly over a stream of length
+    points, always including the first and last.
+    """
+    if length <= count:
+        return numpy.arange(length)
+    return numpy.unique(numpy.linspace(0, length - 1, count).round().astype(numpy.int64))
+
+
+def choose_level(tolerance=None, zoom=None, latitude=0):
+    """
+    Snap a tolerance in meters, or a map zoom level (one pixel's worth
+    of meters), down to one of LEVELS.
+    """
+    if tolerance is None and zoom is not None:
+        tolerance = (METERS_PER_PIXEL_AT_ZOOM_0 * math.cos(math.radians(latitude)) /
+                     2 ** zoom)
+    if not tolerance or tolerance <= 0:
+        return 0
+    return max(level for level in LEVELS if level <= tolerance)
@@ -0,0 +1,222 @@
+"""
+Coalescing of concurrent identical fetches.
+
+When several callers want the same strava URL at the same time, only
+one of them (the owner) actually fetches it; the others wait for the
+owner and get its result. Within a request's event loop this is done
+by sharing the future. Across threads and instances the owner holds a
+memcache lock while fetching and publishes the result in memcache when
+it is done.
+
+Results that the owner doesn't want to share (e.g. errors) aren't
+published, and waiters whose owner gives up or times out fetch for
+themselves.
+
+The lock and the results go through the ndb context's asynchronous
+memcache calls, so waiting on another instance's fetch doesn't hold
+up the rest of the event loop. LocalBackend is an in-process stand-in
+for memcache, for tests.
+"""
+import cPickle as pickle
+import hashlib
+import logging
+import threading
+import uuid
+import zlib
+
+from google.appengine.ext import ndb
+
+from raceways.cache import MAX_MEMCACHE_BYTES
+
+LOCK_SECONDS = 30
+RESULT_SECONDS = 60
+POLL_SECONDS = 0.1
+
+
+def _completed(value):
+    future = ndb.Future()
+    future.set_result(value)
+    return future
+
+
+class MemcacheBackend(object):
+    def add_async(self, key, value, time=0):
+        return ndb.get_context().memcache_add(key, value, time=time)
+
+    def get_async(self, key):
+        return ndb.get_context().memcache_get(key)
+
+    def set_async(self, key, value, time=0):
+        return ndb.get_context().memcache_set(key, value, time=time)
+
+    def delete_async(self, key):
+        return ndb.get_context().memcache_delete(key)
+
+
+class LocalBackend(object):
+    """
+    In-process stand-in for MemcacheBackend. Expiry is ignored.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.values:
+                return False
+            self.values[key] = value
+            return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def add_async(self, key, value, time=0):
+        return _completed(self.add(key, value, time=time))
+
+    def get_async(self, key):
+        return _completed(self.get(key))
+
+    def set_async(self, key, value, time=0):
+        return _completed(self.set(key, value, time=time))
+
+    def delete_async(self, key):
+        return _completed(self.delete(key))
+
+
+class ThreadFutures(object):
+    """
+    Futures in flight, by key. Futures are tied to a thread's event
+    loop, so each thread gets its own dict of them from get().
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self):
+        if not hasattr(self.local, 'futures'):
+            self.local.futures = {}
+        return self.local.futures
+
+
+class FetchedResponse(object):
+    """
+    The parts of a urlfetch result worth sharing. Unlike the urlfetch
+    result itself, this pickles. shared is True when the response came
+    from somebody else's fetch.
+    """
+    shared = False
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = dict(headers or {})
+
+    @classmethod
+    def from_urlfetch(cls, result):
+        return cls(result.status_code, result.content, result.headers)
+
+
+class SingleFlight(object):
+    def __init__(self, backend=None, lock_seconds=LOCK_SECONDS,
+                 result_seconds=RESULT_SECONDS, poll_seconds=POLL_SECONDS):
+        self.backend = backend or MemcacheBackend()
+        self.lock_seconds = lock_seconds
+        self.result_seconds = result_seconds
+        self.poll_seconds = poll_seconds
+        self.futures = ThreadFutures()
+
+    @ndb.tasklet
+    def do_async(self, key, fn, share=None):
+        """
+        Return a tuple of (result, shared) where result is what fn()
+        returned (a value or a future), or the result of a concurrent
+        call with the same key if shared is True.
+
+        share(result) decides whether a result may be handed to other
+        callers, by default everything is.
+        """
+        in_flight = self.futures.get()
+        if key in in_flight:
+            result, shared, shareable = yield in_flight[key]
+            if shareable:
+                raise ndb.Return((result, True))
+
+        future = self._do_async(key, fn, share)
+        in_flight[key] = future
+        try:
+            result, shared, shareable = yield future
+        finally:
+            if in_flight.get(key) is future:
+                del in_flight[key]
+        raise ndb.Return((result, shared))
+
+    @ndb.tasklet
+    def _do_async(self, key, fn, share):
+        """
+        Returns (result, shared, shareable).
+        """
+        # urls can be longer than memcache allows for keys
+        digest = hashlib.sha1(key).hexdigest()
+        lock_key = 'singleflight|lock|' + digest
+        result_key = 'singleflight|result|' + digest
+        token = uuid.uuid4().hex
+
+        waited = 0.0
+        while True:
+            locked = yield self.backend.add_async(lock_key, token, time=self.lock_seconds)
+            if locked:
+                break
+            published, owner = yield (self.backend.get_async(result_key),
+                                      self.backend.get_async(lock_key))
+            if published is not None:
+                raise ndb.Return((pickle.loads(zlib.decompress(published)), True, True))
+            if owner is None or waited >= self.lock_seconds:
+                # the owner finished without publishing anything, or
+                # died: fetch it ourselves
+                break
+            yield ndb.sleep(self.poll_seconds)
+            waited += self.poll_seconds
+
+        try:
+            result = fn()
+            if isinstance(result, ndb.Future):
+                result = yield result
+            shareable = share is None or share(result)
+            if shareable:
+                yield self._publish_async(result_key, result)
+        finally:
+            owner = yield self.backend.get_async(lock_key)
+            if owner == token:
+                yield self.backend.delete_async(lock_key)
+        raise ndb.Return((result, False, shareable))
+
+    @ndb.tasklet
+    def _publish_async(self, result_key, result):
+        published = zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        if len(published) > MAX_MEMCACHE_BYTES:
+            logging.info("Not publishing %s, %d bytes is too big",
+                         result_key, len(published))
+            return
+        yield self.backend.set_async(result_key, published, time=self.result_seconds)
+
+
+_single_flight = None
+
+
+def get_single_flight():
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
+
+
+def set_single_flight(single_flight):
+    global _single_flight
+    _single_flight = single_flight
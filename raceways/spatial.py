@@ -0,0 +1,219 @@
+"""
+Spatial index of which activities pass through where.
+
+Every latlng stream is reduced to the set of geohash cells it passes
+through, at each of PRECISIONS, and stored as the repeated, indexed
+cells property of a model.ActivityCells. The datastore's index on that
+property is then the cell -> activities mapping, so a bounding box
+query is a single query for the cells covering the box, at the finest
+precision that needs no more than MAX_QUERY_CELLS of them.
+
+Answers are at cell resolution: an activity matches if it passes
+through a cell that overlaps the box.
+
+Boxes that would need more than MAX_QUERY_CELLS of even the coarsest
+cells are instead checked against every indexed activity's
+stream_extents.
+"""
+import numpy
+from google.appengine.ext import ndb
+
+from raceways import model
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# roughly 156km, 39km, 4.9km and 1.2km wide cells
+PRECISIONS = (3, 4, 5, 6)
+
+# the datastore turns IN into one query per value
+MAX_QUERY_CELLS = 30
+
+
+def _quantize(lat, lng, precision):
+    """
+    Row and column of the cells at precision that lat and lng
+    (arrays) fall into.
+    """
+    bits = 5 * precision
+    lat_bits, lng_bits = bits // 2, (bits + 1) // 2
+    rows = numpy.floor((numpy.asarray(lat, dtype=float) + 90) / 180 * 2 ** lat_bits)
+    columns = numpy.floor((numpy.asarray(lng, dtype=float) + 180) / 360 * 2 ** lng_bits)
+    return (numpy.clip(rows, 0, 2 ** lat_bits - 1).astype(numpy.int64),
+            numpy.clip(columns, 0, 2 ** lng_bits - 1).astype(numpy.int64))
+
+
+def _interleave(rows, columns, precision):
+    """
+    Geohash bits of each cell: longitude bits in the even positions,
+    latitude in the odd ones, most significant first.
+    """
+    bits = 5 * precision
+    lat_bits, lng_bits = bits // 2, (bits + 1) // 2
+    codes = numpy.zeros(numpy.shape(rows), dtype=numpy.int64)
+    for bit in xrange(lng_bits):
+        codes |= ((columns >> (lng_bits - 1 - bit)) & 1) << (bits - 1 - 2 * bit)
+    for bit in xrange(lat_bits):
+        codes |= ((rows >> (lat_bits - 1 - bit)) & 1) << (bits - 2 - 2 * bit)
+    return codes
+
+
+def _to_string(code, precision):
+    return ''.join(BASE32[(code >> (5 * (precision - 1 - index))) & 31]
+                   for index in xrange(precision))
+
+
+def geohash(lat, lng, precision):
+    rows, columns = _quantize([lat], [lng], precision)
+    return _to_string(int(_interleave(rows, columns, precision)[0]), precision)
+
+
+def cell_bounds(cell):
+    """
+    (min_lat, min_lng, max_lat, max_lng) of a geohash cell.
+    """
+    precision = len(cell)
+    code = 0
+    for character in cell:
+        code = code * 32 + BASE32.index(character)
+    bits = 5 * precision
+    lat_bits, lng_bits = bits // 2, (bits + 1) // 2
+    row = column = 0
+    for bit in xrange(bits):
+        value = (code >> (bits - 1 - bit)) & 1
+        if bit % 2:
+            row = row * 2 + value
+        else:
+            column = column * 2 + value
+    height = 180.0 / 2 ** lat_bits
+    width = 360.0 / 2 ** lng_bits
+    return (row * height - 90, column * width - 180,
+            (row + 1) * height - 90, (column + 1) * width - 180)
+
+
+def boxes_overlap(a, b):
+    """
+    Whether two (min_lat, min_lng, max_lat, max_lng) boxes overlap.
+    """
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def stream_cells(latlng, precisions=PRECISIONS):
+    """
+    The sorted geohashes of every cell, at each of precisions, that a
+    latlng stream passes through.
+    """
+    if not len(latlng):
+        return []
+    latlng = numpy.asarray(latlng, dtype=float)
+    cells = []
+    for precision in precisions:
+        rows, columns = _quantize(latlng[:, 0], latlng[:, 1], precision)
+        codes = numpy.unique(_interleave(rows, columns, precision))
+        cells.extend(_to_string(int(code), precision) for code in codes)
+    return sorted(cells)
+
+
+def covering_cells(min_lat, min_lng, max_lat, max_lng):
+    """
+    The geohashes of the cells covering a bounding box, at the finest
+    of PRECISIONS that needs no more than MAX_QUERY_CELLS. None if even
+    the coarsest needs more.
+    """
+    for precision in reversed(PRECISIONS):
+        (low_row, high_row), (low_column, high_column) = _quantize(
+            [min_lat, max_lat], [min_lng, max_lng], precision)
+        count = (high_row - low_row + 1) * (high_column - low_column + 1)
+        if count <= MAX_QUERY_CELLS:
+            rows, columns = numpy.mgrid[low_row:high_row + 1, low_column:high_column + 1]
+            codes = _interleave(rows.ravel(), columns.ravel(), precision)
+            return [_to_string(int(code), precision) for code in codes]
+    return None
+
+
+def parse_bbox(bbox):
+    """
+    Parse "min_lng,min_lat,max_lng,max_lat" (the GeoJSON order) into
+    (min_lat, min_lng, max_lat, max_lng).
+    """
+    values = [float(value) for value in bbox.split(',')]
+    if len(values) != 4:
+        raise ValueError("bbox needs 4 values: min_lng,min_lat,max_lng,max_lat")
+    min_lng, min_lat, max_lng, max_lat = values
+    if min_lat > max_lat or min_lng > max_lng:
+        raise ValueError("bbox minimums must come before maximums")
+    return min_lat, min_lng, max_lat, max_lng
+
+
+@ndb.tasklet
+def index_activity_async(athlete_id, activity_id, latlng):
+    """
+    Store the cells of a newly ingested latlng stream.
+    """
+    record = model.ActivityCells(id=int(activity_id),
+                                 athlete_id=int(athlete_id),
+                                 cells=stream_cells(latlng))
+    yield record.put_async()
+    raise ndb.Return(record)
+
+
+@ndb.tasklet
+def index_stored_async(athlete_id, resolution=model.Stream.SOURCE_RESOLUTION):
+    """
+    Index every activity of the athlete that has a stored latlng
+    stream, for streams ingested before there was an index.
+    """
+    activity_keys = yield model.Activity.query(
+        model.Activity.athlete_id == int(athlete_id)).fetch_async(keys_only=True)
+    activity_ids = [key.id() for key in activity_keys]
+    streams = yield model.Stream.get_multi_async(
+        [(activity_id, 'latlng') for activity_id in activity_ids],
+        resolution=resolution)
+    records = []
+    for activity_id, stream in zip(activity_ids, streams):
+        if stream is not None:
+            records.append(model.ActivityCells(id=activity_id,
+                                               athlete_id=int(athlete_id),
+                                               cells=stream_cells(stream.get_data())))
+    yield ndb.put_multi_async(records)
+    raise ndb.Return(len(records))
+
+
+@ndb.tasklet
+def activities_in_bbox_async(athlete_id, min_lat, min_lng, max_lat, max_lng):
+    """
+    Sorted ids of the athlete's activities that pass through the box.
+    """
+    cells = covering_cells(min_lat, min_lng, max_lat, max_lng)
+    if cells is None:
+        activity_ids = yield _activities_in_large_bbox_async(
+            athlete_id, (min_lat, min_lng, max_lat, max_lng))
+        raise ndb.Return(activity_ids)
+    query = model.ActivityCells.query(model.ActivityCells.athlete_id == int(athlete_id),
+                                      model.ActivityCells.cells.IN(cells))
+    keys = yield query.fetch_async(keys_only=True)
+    raise ndb.Return(sorted(set(key.id() for key in keys)))
+
+
+@ndb.tasklet
+def _activities_in_large_bbox_async(athlete_id, bbox):
+    """
+    activities_in_bbox_async() for boxes too big to query by cell:
+    every indexed activity is checked against the box, by its
+    stream_extents, or by its coarsest cells if it has none.
+    """
+    records = yield model.ActivityCells.query(
+        model.ActivityCells.athlete_id == int(athlete_id)).fetch_async()
+    activities = yield ndb.get_multi_async([ndb.Key(model.Activity, record.key.id())
+                                            for record in records])
+    activity_ids = []
+    for record, activity in zip(records, activities):
+        extents = activity and activity.stream_extents
+        if extents:
+            matches = boxes_overlap(bbox, (extents['min_lat'], extents['min_lng'],
+                                           extents['max_lat'], extents['max_lng']))
+        else:
+            matches = any(boxes_overlap(bbox, cell_bounds(cell))
+                          for cell in record.cells if len(cell) == PRECISIONS[0])
+        if matches:
+            activity_ids.append(record.key.id())
+    raise ndb.Return(sorted(activity_ids))
@@ -0,0 +1,63 @@
+"""
+Timing of instance startup.
+
+Everything main.py imports is paid for before a fresh instance can
+answer its first request. So the handler modules are only imported
+when a route first needs them (see main.LazyRouter), and the gitkit
+client and the template environment are only built when first used.
+Each of those is timed here, so a slow first request shows up in the
+logs along with what it spent its time loading.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# as close to the start of the instance as we can get
+STARTED = time.time()
+
+timings = OrderedDict()
+
+
+def record(name, seconds):
+    timings[name] = seconds
+    logging.info("Startup: %s took %.1fms", name, seconds * 1000)
+
+
+@contextmanager
+def timed(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+def report():
+    """
+    {name: milliseconds} of everything timed so far, in order.
+    """
+    return OrderedDict((name, round(seconds * 1000, 1))
+                       for name, seconds in timings.iteritems())
+
+
+class Lazy(object):
+    """
+    A value built by factory() the first time get() is called, timed
+    under name.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    with timed(self.name):
+                        self.value = self.factory()
+        return self.value
+
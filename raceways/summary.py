@@ -0,0 +1,121 @@
+"""
+Precomputed per athlete activity totals.
+
+Every activity is added to one bucket, keyed by its type, the year and
+month it started (local time, the month as 2014-06 like
+raceways.facets has it) and its gear. Each bucket holds the count,
+distance, moving time and elevation gain of its activities. Totals
+and facet counts for any combination of those dimensions are then a
+pass over the buckets, however many activities there are.
+
+The buckets are kept in a model.ActivitySummary, updated as
+UpdateHandler writes new activities. It remembers which activities it
+has counted, so adding the same activity twice is harmless.
+"""
+from google.appengine.ext import ndb
+
+from raceways import model
+
+DIMENSIONS = ('type', 'year', 'month', 'gear_id')
+
+TOTALS = ('count', 'distance', 'moving_time', 'total_elevation_gain')
+
+
+def bucket_key(activity):
+    start_date = activity.start_date_local or activity.start_date or ''
+    # strava dates look like 2014-06-01T07:30:00Z
+    year, month = start_date[:4], start_date[:7]
+    return '|'.join([activity.type or '', year, month, activity.gear_id or ''])
+
+
+def bucket_values(key):
+    values = dict(zip(DIMENSIONS, key.split('|')))
+    if values['month'] and '-' not in values['month']:
+        # buckets stored before months had their year
+        values['month'] = '{}-{:02d}'.format(values['year'], int(values['month']))
+    return values
+
+
+def add_activity(buckets, activity):
+    totals = buckets.setdefault(bucket_key(activity), dict.fromkeys(TOTALS, 0))
+    totals['count'] += 1
+    totals['distance'] += activity.distance or 0
+    totals['moving_time'] += activity.moving_time or 0
+    totals['total_elevation_gain'] += activity.total_elevation_gain or 0
+
+
+def _add(totals, other):
+    for name in TOTALS:
+        totals[name] += other[name]
+
+
+def aggregate(buckets, filters=None):
+    """
+    Totals of the buckets that match filters ({dimension: [values]}),
+    and for each dimension, the totals for each of its values. Facet
+    totals ignore the filter on their own dimension, so they show what
+    picking a different value would give.
+    """
+    filters = dict((dimension, set(values))
+                   for dimension, values in (filters or {}).iteritems() if values)
+    result = {
+        'totals': dict.fromkeys(TOTALS, 0),
+        'facets': dict((dimension, {}) for dimension in DIMENSIONS),
+        }
+    for key, totals in buckets.iteritems():
+        values = bucket_values(key)
+        failed = [dimension for dimension, allowed in filters.iteritems()
+                  if values[dimension] not in allowed]
+        if not failed:
+            _add(result['totals'], totals)
+        for dimension in DIMENSIONS:
+            if not failed or failed == [dimension]:
+                facet = result['facets'][dimension]
+                _add(facet.setdefault(values[dimension], dict.fromkeys(TOTALS, 0)), totals)
+    return result
+
+
+@ndb.tasklet
+def add_activities_async(athlete_id, activities):
+    """
+    Add newly written activities (model.Activity) to the athlete's
+    summary.
+    """
+    # make sure the summary has everything from before it existed
+    yield get_summary_async(athlete_id)
+    summary = yield _add_activities_async(athlete_id, activities)
+    raise ndb.Return(summary)
+
+
+@ndb.transactional_tasklet
+def _add_activities_async(athlete_id, activities):
+    summary = yield model.ActivitySummary.get_by_id_async(int(athlete_id))
+    if summary is None:
+        summary = model.ActivitySummary(id=int(athlete_id), buckets={})
+    counted = set(summary.activity_ids)
+    added = False
+    for activity in activities:
+        activity_id = activity.key.id()
+        if activity_id in counted:
+            continue
+        add_activity(summary.buckets, activity)
+        summary.activity_ids.append(activity_id)
+        counted.add(activity_id)
+        added = True
+    if added:
+        yield summary.put_async()
+    raise ndb.Return(summary)
+
+
+@ndb.tasklet
+def get_summary_async(athlete_id):
+    """
+    The athlete's summary, built from the stored activities if there
+    isn't one yet.
+    """
+    summary = yield model.ActivitySummary.get_by_id_async(int(athlete_id))
+    if summary is None:
+        activities = yield model.Activity.query(
+            model.Activity.athlete_id == int(athlete_id)).fetch_async()
+        summary = yield _add_activities_async(athlete_id, activities)
+    raise ndb.Return(summary)
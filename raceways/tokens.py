@@ -0,0 +1,227 @@
+"""
+Refreshing strava OAuth credentials.
+
+oauth2client's OAuth2Credentials.refresh() needs an httplib2.Http and
+blocks until the token endpoint answers. request_refresh_async() makes
+the same request through the transport instead (see
+raceways.transport), so the event loop carries on while it is in
+flight.
+
+When a token expires, every request that was using it gets a 401 at
+about the same time, so refreshes go through a RefreshCoordinator:
+
+- Within a thread's event loop, everyone waiting on an athlete's
+  refresh shares one future.
+- Across threads and instances, the refresher holds a memcache lease
+  for the athlete. Others poll the credentials' stored entity until
+  the new token shows up there, or the lease goes away. Both go
+  through ndb's asynchronous calls, so waiting doesn't hold up the
+  event loop.
+- Credentials whose athlete isn't known are identified by their
+  refresh token instead (see identity()).
+- A refresh is skipped if the token has already changed from the one
+  that was rejected.
+
+Credentials are also refreshed ahead of time, once they are within
+REFRESH_MARGIN of expiring (see needs_refresh()), so a burst of
+requests doesn't all run into the expiry.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import uuid
+
+from google.appengine.ext import ndb
+from oauth2client.client import AccessTokenRefreshError
+
+from raceways import singleflight
+from raceways import transport
+
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+LEASE_SECONDS = 30
+POLL_SECONDS = 0.25
+
+# what a refresh changes on the credentials
+REFRESHED_FIELDS = ('access_token', 'refresh_token', 'token_expiry',
+                    'token_response', 'invalid')
+
+
+def identity(credentials, athlete_id=None):
+    """
+    Who credentials belong to, for keys shared between everyone using
+    them: athlete_id, or when that isn't known, a digest of the
+    refresh token, which stays the same when the access token is
+    refreshed.
+    """
+    if athlete_id is not None:
+        return athlete_id
+    secret = credentials.refresh_token or credentials.access_token or ''
+    return 'refresh-' + hashlib.sha1(secret).hexdigest()
+
+
+def needs_refresh(credentials, margin=REFRESH_MARGIN, now=None):
+    """
+    Whether credentials have expired or will within margin.
+    """
+    if credentials.token_expiry is None:
+        return False
+    now = now or datetime.datetime.utcnow()
+    return now + margin >= credentials.token_expiry
+
+
+@ndb.tasklet
+def request_refresh_async(credentials):
+    """
+    Exchange the credentials' refresh token for a new access token,
+    updating credentials and their store in place the way
+    OAuth2Credentials.refresh() does.
+    """
+    response = yield transport.get_transport().fetch_async(
+        credentials.token_uri, method='POST',
+        headers=credentials._generate_refresh_request_headers(),
+        payload=credentials._generate_refresh_request_body())
+    if response.status_code != 200:
+        logging.error("Refreshing the access token failed with %s: %s",
+                      response.status_code, response.content)
+        error = "Invalid response {}.".format(response.status_code)
+        try:
+            error = json.loads(response.content).get('error', error)
+        except ValueError:
+            pass
+        credentials.invalid = True
+        if credentials.store:
+            credentials.store.locked_put(credentials)
+        raise AccessTokenRefreshError(error)
+
+    token_response = json.loads(response.content)
+    credentials.access_token = token_response['access_token']
+    credentials.refresh_token = token_response.get('refresh_token',
+                                                   credentials.refresh_token)
+    credentials.token_expiry = None
+    if 'expires_in' in token_response:
+        credentials.token_expiry = (
+            datetime.timedelta(seconds=int(token_response['expires_in'])) +
+            datetime.datetime.utcnow())
+    # strava only sends the athlete with the code exchange, keep it
+    credentials.token_response = dict(credentials.token_response or {},
+                                      **token_response)
+    credentials.invalid = False
+    if credentials.store:
+        credentials.store.locked_put(credentials)
+    raise ndb.Return(credentials)
+
+
+class RefreshCoordinator(object):
+    def __init__(self, backend=None, lease_seconds=LEASE_SECONDS,
+                 poll_seconds=POLL_SECONDS):
+        self.backend = backend or singleflight.MemcacheBackend()
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.futures = singleflight.ThreadFutures()
+
+    @ndb.tasklet
+    def refresh_async(self, credentials, athlete_id, stale_token=None):
+        """
+        Make sure credentials have a token other than stale_token (by
+        default, the one they have now), refreshing them at most once
+        for everyone who asks at the same time.
+        """
+        if stale_token is None:
+            stale_token = credentials.access_token
+        if credentials.access_token != stale_token:
+            # somebody sharing these credentials already did it
+            return
+
+        key = identity(credentials, athlete_id)
+        in_flight = self.futures.get()
+        future = in_flight.get(key)
+        if future is None:
+            future = self._refresh_async(credentials, key, stale_token)
+            in_flight[key] = future
+        try:
+            fresh = yield future
+        finally:
+            if in_flight.get(key) is future:
+                del in_flight[key]
+        if fresh is not credentials:
+            adopt(credentials, fresh)
+
+    @ndb.tasklet
+    def _refresh_async(self, credentials, key, stale_token):
+        """
+        Returns the refreshed credentials.
+        """
+        lease_key = 'tokens|lease|{}'.format(key)
+        token = uuid.uuid4().hex
+
+        waited = 0.0
+        while True:
+            leased = yield self.backend.add_async(lease_key, token, time=self.lease_seconds)
+            if leased:
+                break
+            stored, holder = yield (load_stored_async(credentials),
+                                    self.backend.get_async(lease_key))
+            if stored is not None and stored.access_token != stale_token:
+                raise ndb.Return(stored)
+            if holder is None or waited >= self.lease_seconds:
+                # the refresher gave up or died, try for ourselves
+                break
+            yield ndb.sleep(self.poll_seconds)
+            waited += self.poll_seconds
+
+        try:
+            # it may have been refreshed between our 401 and the lease
+            stored = yield load_stored_async(credentials)
+            if stored is not None and stored.access_token != stale_token:
+                raise ndb.Return(stored)
+            logging.info("Refreshing the access token of %s", key)
+            yield request_refresh_async(credentials)
+        finally:
+            holder = yield self.backend.get_async(lease_key)
+            if holder == token:
+                yield self.backend.delete_async(lease_key)
+        raise ndb.Return(credentials)
+
+
+@ndb.tasklet
+def load_stored_async(credentials):
+    """
+    The credentials as currently stored, or None if they have no store.
+    A StorageByKeyName of an ndb model (like the one from
+    handler.get_credentials_storage()) is read straight from its
+    entity, skipping the in-context cache so a poll sees new writes.
+    Other stores are read with locked_get().
+    """
+    store = credentials.store
+    if not store:
+        raise ndb.Return(None)
+    model = getattr(store, '_model', None)
+    if not (isinstance(model, type) and issubclass(model, ndb.Model)):
+        raise ndb.Return(store.locked_get())
+    entity = yield ndb.Key(model, store._key_name).get_async(use_cache=False)
+    stored = entity and getattr(entity, store._property_name)
+    if stored is not None:
+        stored.set_store(store)
+    raise ndb.Return(stored)
+
+
+def adopt(credentials, fresh):
+    for field in REFRESHED_FIELDS:
+        setattr(credentials, field, getattr(fresh, field))
+
+
+_coordinator = None
+
+
+def get_coordinator():
+    global _coordinator
+    if _coordinator is None:
+        _coordinator = RefreshCoordinator()
+    return _coordinator
+
+
+def set_coordinator(coordinator):
+    global _coordinator
+    _coordinator = coordinator
@@ -0,0 +1,120 @@
+"""
+HTTP to strava, all through one Transport.
+
+StravaClient, AuthRequestContext and the OAuth token requests (see
+raceways.tokens) all fetch through get_transport(), so every strava
+request is asynchronous and can run in parallel with the others.
+
+UrlfetchTransport is the real one. It is shared by the whole instance
+and goes through the ndb context's urlfetch, which batches the RPCs
+and leaves the connections to the urlfetch service, which keeps them
+alive between requests. Nothing builds an httplib2.Http per request
+any more; libraries that insist on one (oauth2client's code exchange)
+get an HttpAdapter, which is the transport in httplib2's shape.
+
+FakeTransport is an in-process stand-in for tests, answering from
+canned responses and recording what was fetched.
+"""
+import threading
+
+import httplib2
+from google.appengine.ext import ndb
+
+from raceways.singleflight import FetchedResponse
+
+DEADLINE = 30  # seconds
+
+
+class Transport(object):
+    def fetch_async(self, url, method='GET', headers=None, payload=None, **kwds):
+        """
+        Returns a future for a response with status_code, headers and
+        content, like urlfetch's.
+        """
+        raise NotImplementedError()
+
+    def fetch(self, url, **kwds):
+        return self.fetch_async(url, **kwds).get_result()
+
+
+class UrlfetchTransport(Transport):
+    def __init__(self, deadline=DEADLINE):
+        self.deadline = deadline
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @ndb.tasklet
+    def fetch_async(self, url, method='GET', headers=None, payload=None, **kwds):
+        kwds.setdefault('deadline', self.deadline)
+        kwds.setdefault('validate_certificate', True)
+        with self.lock:
+            self.in_flight += 1
+        try:
+            result = yield ndb.get_context().urlfetch(
+                url, method=method, headers=headers or {}, payload=payload, **kwds)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        raise ndb.Return(result)
+
+
+class FakeTransport(Transport):
+    """
+    Answers from responses, a dict of {url: response} where response
+    is a FetchedResponse, a (status_code, content) tuple or a callable
+    taking the request and returning either. Unknown urls get a 404.
+    Every request is appended to requests as a dict of url, method,
+    headers and payload.
+    """
+    def __init__(self, responses=None):
+        self.responses = dict(responses or {})
+        self.requests = []
+
+    def fetch_async(self, url, method='GET', headers=None, payload=None, **kwds):
+        request = {
+            'url': url,
+            'method': method,
+            'headers': dict(headers or {}),
+            'payload': payload,
+            }
+        self.requests.append(request)
+        response = self.responses.get(url, (404, ''))
+        if callable(response):
+            response = response(request)
+        if isinstance(response, tuple):
+            response = FetchedResponse(response[0], response[1], {})
+        future = ndb.Future()
+        future.set_result(response)
+        return future
+
+
+class HttpAdapter(object):
+    """
+    The transport with httplib2.Http's request() method, for code that
+    wants an http object. Blocks until the response is back.
+    """
+    def __init__(self, transport=None):
+        self.transport = transport
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=None, connection_type=None):
+        transport = self.transport or get_transport()
+        result = transport.fetch(uri, method=method, headers=headers, payload=body)
+        info = dict((key.lower(), value) for key, value in result.headers.items())
+        info['status'] = result.status_code
+        return httplib2.Response(info), result.content
+
+
+_transport = None
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport = UrlfetchTransport()
+    return _transport
+
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
@@ -1,13 +1,23 @@
 
 # much of this stolen from stravalib
+import calendar
 import pytz
 from datetime import datetime
 
+STRAVA_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
 def reformat_date(datestring, source, athlete):
     timezone = source['timezone'].split(' ')[-1]
     tzinfo = pytz.timezone(timezone)
-    date = datetime.strptime(datestring, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=tzinfo)
+    date = datetime.strptime(datestring, STRAVA_DATE_FORMAT).replace(tzinfo=tzinfo)
 
     localdate = date.strftime(athlete['date_preference'])
 
     return localdate
+
+def strava_timestamp(datestring):
+    """
+    Convert a strava UTC date string (like start_date) to seconds
+    since the epoch, as used by the before/after API parameters.
+    """
+    return calendar.timegm(datetime.strptime(datestring, STRAVA_DATE_FORMAT).timetuple())
@@ -0,0 +1,92 @@
+"""
+Binary encoding of /api/streams responses.
+
+JSON spends most of a stream response on printing floats. With
+format=binary (or Accept: application/x-raceways-streams) the streams
+are sent as little-endian float32 arrays instead, which a browser can
+wrap in a Float32Array without parsing anything.
+
+The response is MAGIC followed by records. Each record is:
+
+    uint32 (little-endian)  length of the metadata, a multiple of 4
+    metadata                JSON, padded with spaces
+    float32 * length        the data, if metadata has a length
+
+The first record's metadata is the response-level information
+(format version and tolerance) and has no data. Every other record is
+one stream: its metadata is the Stream.to_dict() fields except data,
+plus activity_id, type, length (number of floats) and shape (e.g.
+[n, 2] for latlng). Missing streams have {"missing": true} and no
+data.
+
+float32 keeps about 7 significant digits, which is under half a meter
+for latitudes and longitudes.
+"""
+import json
+import struct
+
+import numpy
+
+from raceways import jsonstream
+
+MAGIC = 'RWS1'
+VERSION = 1
+CONTENT_TYPE = 'application/x-raceways-streams'
+
+
+class BinaryResult(object):
+    """
+    A handler result that api_handler writes out as is, rather than
+    wrapping it in a JSON envelope.
+    """
+    content_type = 'application/octet-stream'
+
+    def write_to(self, write):
+        raise NotImplementedError()
+
+
+def encode_record(metadata, data=None):
+    """
+    Returns the bytes of one record.
+    """
+    metadata = dict(metadata)
+    values = None
+    if data is not None:
+        values = numpy.asarray(data, dtype='<f4')
+        metadata['length'] = int(values.size)
+        metadata['shape'] = list(values.shape)
+    encoded = json.dumps(metadata, separators=(',', ':'))
+    encoded += ' ' * (-len(encoded) % 4)
+    chunks = [struct.pack('<I', len(encoded)), encoded]
+    if values is not None:
+        chunks.append(values.tostring())
+    return ''.join(chunks)
+
+
+class StreamRecords(BinaryResult):
+    """
+    Streams to write in the binary format, one record at a time.
+    streams is a list of (activity_id, stream_type, stream) where
+    stream is a Stream.to_dict() result, a callable returning one (see
+    raceways.jsonstream), or None if it is missing.
+    """
+    content_type = CONTENT_TYPE
+
+    def __init__(self, tolerance, streams):
+        self.tolerance = tolerance
+        self.streams = streams
+
+    def write_to(self, write):
+        write(MAGIC)
+        write(encode_record({'format': VERSION, 'tolerance': self.tolerance}))
+        for activity_id, stream_type, stream in self.streams:
+            stream = jsonstream.resolve(stream)
+            metadata = {'activity_id': activity_id, 'type': stream_type}
+            if not stream:
+                metadata['missing'] = True
+                write(encode_record(metadata))
+                continue
+            for key, value in stream.iteritems():
+                if key != 'data':
+                    metadata[key] = value
+            write(encode_record(metadata, stream.get('data') or []))
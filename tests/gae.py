@@ -0,0 +1,55 @@
+"""
+A TestCase running against the App Engine testbed, with every strava
+facing singleton replaced by its in-process stand-in.
+"""
+import datetime
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from oauth2client.client import OAuth2Credentials
+
+from raceways import ratelimit
+from raceways import singleflight
+from raceways import tokens
+from raceways import transport
+
+TOKEN_URI = 'https://www.strava.com/oauth/token'
+
+
+def make_credentials(athlete_id, access_token='token', expires_in=3600):
+    return OAuth2Credentials(
+        access_token, 'client-id', 'client-secret', 'refresh-{}'.format(athlete_id),
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in),
+        TOKEN_URI, 'raceways-tests',
+        token_response={'athlete': {'id': athlete_id}})
+
+
+class AppEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_urlfetch_stub()
+        ndb.get_context().clear_cache()
+
+        self.transport = transport.FakeTransport()
+        transport.set_transport(self.transport)
+        ratelimit.set_scheduler(ratelimit.Scheduler(store=ratelimit.LocalStore()))
+        self.backend = singleflight.LocalBackend()
+        singleflight.set_single_flight(singleflight.SingleFlight(
+            backend=self.backend, poll_seconds=0.01))
+        tokens.set_coordinator(tokens.RefreshCoordinator(
+            backend=self.backend, poll_seconds=0.01))
+
+    def tearDown(self):
+        transport.set_transport(None)
+        ratelimit.set_scheduler(None)
+        singleflight.set_single_flight(None)
+        tokens.set_coordinator(None)
+        self.testbed.deactivate()
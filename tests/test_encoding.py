@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from raceways import encoding
+
+
+class TestStreamEncoding(unittest.TestCase):
+    def round_trip(self, stream_type, data, compress=True):
+        name, blob = encoding.encode_stream(stream_type, data, compress=compress)
+        return name, encoding.decode_stream(stream_type, name, blob)
+
+    def test_latlng(self):
+        data = [[37.7749295, -122.4194155], [37.7750001, -122.4193002],
+                [37.7751234, -122.4191111]]
+        name, decoded = self.round_trip('latlng', data)
+        self.assertEqual(name, 'delta-e7/zlib')
+        for (lat, lng), (decoded_lat, decoded_lng) in zip(data, decoded):
+            self.assertAlmostEqual(lat, decoded_lat, places=7)
+            self.assertAlmostEqual(lng, decoded_lng, places=7)
+
+    def test_floats(self):
+        data = [10.5, 10.25, 9.75, 12.0, -3.5]
+        name, decoded = self.round_trip('altitude', data)
+        self.assertEqual(name, 'delta-e2/zlib')
+        for value, decoded_value in zip(data, decoded):
+            self.assertAlmostEqual(value, decoded_value, places=2)
+
+    def test_ints(self):
+        data = [0, 5, 12, 20, 19]
+        name, decoded = self.round_trip('time', data, compress=False)
+        self.assertEqual(name, 'delta-e0')
+        self.assertEqual(decoded, data)
+
+    def test_falls_back_to_json(self):
+        data = [True, False, True]
+        name, decoded = self.round_trip('moving', data)
+        self.assertEqual(name, 'json/zlib')
+        self.assertEqual(decoded, data)
+
+    def test_overflow_falls_back_to_json(self):
+        data = [0, 2 ** 40]
+        name, decoded = self.round_trip('distance', data)
+        self.assertEqual(name, 'json/zlib')
+        self.assertEqual(decoded, data)
+
+    def test_empty(self):
+        name, decoded = self.round_trip('latlng', [])
+        self.assertEqual(decoded, [])
+
+    def test_pure_python_decoding(self):
+        data = [[37.7749295, -122.4194155], [37.7750001, -122.4193002]]
+        name, blob = encoding.encode_stream('latlng', data)
+        with_numpy = encoding.decode_stream('latlng', name, blob)
+        numpy, encoding.numpy = encoding.numpy, None
+        try:
+            without_numpy = encoding.decode_stream('latlng', name, blob)
+        finally:
+            encoding.numpy = numpy
+        for a, b in zip(sum(with_numpy, []), sum(without_numpy, [])):
+            self.assertAlmostEqual(a, b, places=9)
+
+    def test_parse_encoding(self):
+        self.assertEqual(encoding.parse_encoding('delta-e7/zlib'),
+                         (encoding.DELTA, 7, True))
+        self.assertEqual(encoding.parse_encoding('json'), (encoding.JSON, 0, False))
+        self.assertRaises(ValueError, encoding.parse_encoding, 'gzip')
+
+    def test_pack_ints(self):
+        values = [3, 1, 4, 1, 5, 9, 2, 6]
+        self.assertEqual(encoding.unpack_ints(encoding.pack_ints(values)), values)
+
+
+if __name__ == '__main__':
+    unittest.main()
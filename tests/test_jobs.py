@@ -0,0 +1,117 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from tests.gae import AppEngineTestCase, make_credentials
+
+from raceways import ingest
+from raceways import jobs
+from raceways import model
+from raceways import ratelimit
+from raceways.client import api_call
+from raceways.handler import get_credentials_storage
+
+USER_ID = 'user'
+ATHLETE_ID = 7
+
+
+def streams_url(activity_id):
+    return api_call('activities/{}/streams/{}'.format(activity_id,
+                                                      ','.join(ingest.STREAM_TYPES)),
+                    resolution=model.Stream.SOURCE_RESOLUTION)
+
+
+def streams_response(activity_id):
+    latlng = [[37.77 + i * 0.001, -122.42 + activity_id * 0.01] for i in xrange(20)]
+    return (200, json.dumps([
+        {'type': 'latlng', 'data': latlng, 'series_type': 'distance',
+         'original_size': len(latlng), 'resolution': 'high'},
+        {'type': 'altitude', 'data': [10.0 + i for i in xrange(20)],
+         'series_type': 'distance', 'original_size': 20, 'resolution': 'high'},
+        ]))
+
+
+class TestStreamJobs(AppEngineTestCase):
+    def setUp(self):
+        super(TestStreamJobs, self).setUp()
+        get_credentials_storage(USER_ID).put(make_credentials(ATHLETE_ID))
+        # the queue's sleeps move the scheduler's clock along
+        self.now = 1000 * ratelimit.SHORT_PERIOD
+        self.sleeps = []
+        ratelimit.set_scheduler(ratelimit.Scheduler(store=ratelimit.LocalStore(),
+                                                    clock=lambda: self.now))
+        self.queue = jobs.LocalQueue(sleep=self.sleep)
+        jobs.set_queue(self.queue)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def tearDown(self):
+        jobs.set_queue(None)
+        super(TestStreamJobs, self).tearDown()
+
+    def run_job(self, activity_ids):
+        job = jobs.enqueue_stream_jobs_async(
+            USER_ID, ATHLETE_ID, activity_ids,
+            resolution=model.Stream.SOURCE_RESOLUTION).get_result()
+        self.assertEqual(len(self.queue.tasks), len(activity_ids))
+        self.queue.run()
+        return job.key.get().progress()
+
+    def test_fan_out(self):
+        for activity_id in (1, 2, 3):
+            self.transport.responses[streams_url(activity_id)] = streams_response(activity_id)
+        progress = self.run_job([1, 2, 3])
+        self.assertEqual((progress['total'], progress['completed'], progress['failed']),
+                         (3, 3, 0))
+        self.assertTrue(progress['done'])
+        streams = model.Stream.get_multi_async(
+            [(activity_id, 'latlng') for activity_id in (1, 2, 3)],
+            resolution=model.Stream.SOURCE_RESOLUTION).get_result()
+        self.assertEqual([len(stream.get_data()) for stream in streams], [20, 20, 20])
+
+    def test_no_streams(self):
+        # a manual entry: strava has no streams, which isn't a failure
+        progress = self.run_job([4])
+        self.assertEqual((progress['completed'], progress['failed']), (1, 0))
+
+    def test_retries_then_fails(self):
+        self.transport.responses[streams_url(1)] = streams_response(1)
+        self.transport.responses[streams_url(2)] = (500, '')
+        progress = self.run_job([1, 2])
+        self.assertEqual((progress['completed'], progress['failed']), (1, 1))
+        self.assertTrue(progress['done'])
+        self.assertEqual(self.sleeps, [jobs.backoff(attempt)
+                                       for attempt in xrange(jobs.MAX_ATTEMPTS - 1)])
+
+    def test_retried_task_completes(self):
+        answers = [(500, ''), streams_response(1)]
+        self.transport.responses[streams_url(1)] = lambda request: answers.pop(0)
+        progress = self.run_job([1])
+        self.assertEqual((progress['completed'], progress['failed']), (1, 0))
+
+    def test_rate_limited_is_requeued(self):
+        answers = [(429, ''), streams_response(1)]
+        self.transport.responses[streams_url(1)] = lambda request: answers.pop(0)
+        progress = self.run_job([1])
+        self.assertEqual((progress['completed'], progress['failed']), (1, 0))
+        # waited out strava's window, without using up an attempt
+        self.assertEqual(self.sleeps, [ratelimit.SHORT_PERIOD + 1])
+
+    def test_outcomes_are_recorded_once(self):
+        jobs.record_progress_async(1, 5).get_result()
+        jobs.record_progress_async(1, 5).get_result()
+        jobs.record_progress_async(1, 6, failed=True).get_result()
+        job = model.SyncJob(id=1, athlete_id=ATHLETE_ID, activity_ids=[5, 6, 8])
+        job.put()
+        progress = job.progress()
+        self.assertEqual((progress['completed'], progress['failed'], progress['done']),
+                         (1, 1, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
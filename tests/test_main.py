@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+import webapp2
+
+import main
+from raceways import startup
+
+HANDLER = 'tests.test_main.HelloHandler'
+
+
+class HelloHandler(webapp2.RequestHandler):
+    def get(self):
+        self.response.write('hello')
+
+
+class TestLazyRouter(unittest.TestCase):
+    def setUp(self):
+        startup.timings.pop(HANDLER, None)
+        self.app = main.WSGIApplication([('/hello', HANDLER)])
+
+    def test_handler_import_is_timed(self):
+        response = webapp2.Request.blank('/hello').get_response(self.app)
+        self.assertEqual((response.status_int, response.body), (200, 'hello'))
+        self.assertIn(HANDLER, startup.report())
+
+    def test_adapter_is_reused(self):
+        webapp2.Request.blank('/hello').get_response(self.app)
+        route = self.app.router.match_routes[0]
+        adapter = route.handler_adapter
+        self.assertIsNotNone(adapter)
+        startup.timings.pop(HANDLER)
+        response = webapp2.Request.blank('/hello').get_response(self.app)
+        self.assertEqual(response.status_int, 200)
+        self.assertIs(route.handler_adapter, adapter)
+        self.assertNotIn(HANDLER, startup.report())
+
+    def test_app_routes_are_lazy(self):
+        for route in main.app.router.match_routes:
+            self.assertIsInstance(route.handler, basestring)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import math
+import os
+import random
+import sys
+import unittest
+
+import numpy
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from raceways import routes
+
+
+def frechet_distance(p, q):
+    """
+    The discrete Frechet distance, by the textbook dynamic program.
+    """
+    distances = numpy.sqrt(((p[:, numpy.newaxis, :] - q[numpy.newaxis, :, :]) ** 2).sum(axis=2))
+    table = numpy.zeros(distances.shape)
+    for i in xrange(len(p)):
+        for j in xrange(len(q)):
+            if i == 0 and j == 0:
+                previous = 0
+            elif i == 0:
+                previous = table[0, j - 1]
+            elif j == 0:
+                previous = table[i - 1, 0]
+            else:
+                previous = min(table[i - 1, j], table[i - 1, j - 1], table[i, j - 1])
+            table[i, j] = max(previous, distances[i, j])
+    return table[-1, -1]
+
+
+def wander(count, rng, step=30.0):
+    angles = numpy.cumsum([rng.uniform(-0.5, 0.5) for i in xrange(count)])
+    steps = numpy.column_stack((numpy.cos(angles), numpy.sin(angles))) * step
+    return numpy.cumsum(steps, axis=0)
+
+
+class TestFrechet(unittest.TestCase):
+    def test_matches_dynamic_program(self):
+        rng = random.Random(4)
+        for attempt in xrange(50):
+            p = wander(rng.randint(2, 30), rng)
+            q = p[::rng.choice((1, 2))] + [[rng.uniform(-60, 60), rng.uniform(-60, 60)]]
+            distance = frechet_distance(p, q)
+            for threshold in (distance * 0.9, distance, distance * 1.1, 50.0, 150.0):
+                self.assertEqual(routes.frechet_within(p, q, threshold),
+                                 distance <= threshold,
+                                 (attempt, threshold, distance))
+
+    def test_reversed_track_is_far(self):
+        p = numpy.array([[0.0, 0.0], [0.0, 500.0], [0.0, 1000.0]])
+        self.assertTrue(routes.frechet_within(p, p, 1.0))
+        self.assertFalse(routes.frechet_within(p, p[::-1], routes.MAX_FRECHET))
+
+
+class TestClusterer(unittest.TestCase):
+    def track(self, activity_id, lat_offset=0.0):
+        latlng = [[37.77 + lat_offset + i * 0.001, -122.42 + 0.0005 * math.sin(i / 2.0)]
+                  for i in xrange(20)]
+        return routes.make_track(activity_id, latlng)
+
+    def test_same_route(self):
+        clusterer = routes.Clusterer()
+        self.assertEqual(clusterer.add(self.track(1)), 0)
+        # about 50m off
+        self.assertEqual(clusterer.add(self.track(2, lat_offset=0.00045)), 0)
+        self.assertEqual([track.activity_id for track in clusterer.routes[0]], [1, 2])
+
+    def test_different_route(self):
+        clusterer = routes.Clusterer()
+        clusterer.add(self.track(1))
+        # about 5km off
+        self.assertEqual(clusterer.add(self.track(2, lat_offset=0.045)), 1)
+        self.assertEqual(len(clusterer.routes), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import math
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from raceways import simplify
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Plain recursive Douglas-Peucker on projected points, returning the
+    kept indices.
+    """
+    def recurse(first, last):
+        if last - first < 2:
+            return []
+        distances = simplify.segment_distances(points[first + 1:last],
+                                               points[first], points[last])
+        index = int(distances.argmax())
+        if distances[index] <= tolerance:
+            return []
+        split = first + 1 + index
+        return recurse(first, split) + [split] + recurse(split, last)
+    return [0] + recurse(0, len(points) - 1) + [len(points) - 1]
+
+
+class TestSignificance(unittest.TestCase):
+    def setUp(self):
+        # a wiggly line about 2km long
+        self.latlng = [[37.77 + i * 0.0002, -122.42 + 0.0004 * math.sin(i / 3.0)]
+                       for i in xrange(100)]
+
+    def test_ends_always_kept(self):
+        significances = simplify.significance(self.latlng)
+        self.assertEqual(significances[0], simplify.KEEP_ALWAYS)
+        self.assertEqual(significances[-1], simplify.KEEP_ALWAYS)
+        kept = simplify.kept_indices(significances, simplify.LEVELS[-1])
+        self.assertEqual(kept[0], 0)
+        self.assertEqual(kept[-1], len(self.latlng) - 1)
+
+    def test_levels_match_douglas_peucker(self):
+        significances = simplify.significance(self.latlng)
+        points = simplify.project(self.latlng)
+        for level in simplify.LEVELS[1:]:
+            kept = simplify.kept_indices(significances, level).tolist()
+            self.assertEqual(kept, douglas_peucker(points, level), level)
+
+    def test_levels_nest(self):
+        significances = simplify.significance(self.latlng)
+        previous = None
+        for level in simplify.LEVELS:
+            kept = set(simplify.kept_indices(significances, level).tolist())
+            if previous is not None:
+                self.assertTrue(kept <= previous, level)
+            previous = kept
+
+    def test_empty(self):
+        self.assertEqual(simplify.significance([]), [])
+
+
+class TestChooseLevel(unittest.TestCase):
+    def test_tolerance(self):
+        self.assertEqual(simplify.choose_level(tolerance=30), 25)
+        self.assertEqual(simplify.choose_level(tolerance=1), 0)
+        self.assertEqual(simplify.choose_level(tolerance=10000), simplify.LEVELS[-1])
+        self.assertEqual(simplify.choose_level(), 0)
+
+    def test_zoom(self):
+        # a pixel is about 2.4m at zoom 16 at the equator
+        self.assertEqual(simplify.choose_level(zoom=16), 2)
+        self.assertEqual(simplify.choose_level(zoom=0), simplify.LEVELS[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from google.appengine.ext import ndb
+
+from tests.gae import AppEngineTestCase, make_credentials
+
+from raceways import singleflight
+from raceways.handler import AuthRequestContext
+
+URL = 'https://www.strava.com/api/v3/activities/1/streams/latlng,altitude'
+
+
+def lock_key(key):
+    return 'singleflight|lock|' + hashlib.sha1(key).hexdigest()
+
+
+def result_key(key):
+    return 'singleflight|result|' + hashlib.sha1(key).hexdigest()
+
+
+class Counter(object):
+    """
+    A fn for do_async() that counts its calls and answers after a
+    moment, so that concurrent callers find it in flight.
+    """
+    def __init__(self, result='result'):
+        self.result = result
+        self.calls = 0
+
+    @ndb.tasklet
+    def __call__(self):
+        self.calls += 1
+        yield ndb.sleep(0.01)
+        raise ndb.Return(self.result)
+
+
+class TestSingleFlight(AppEngineTestCase):
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.single_flight = singleflight.SingleFlight(
+            backend=self.backend, lock_seconds=0.2, poll_seconds=0.01)
+
+    def test_owner_fetches_and_publishes(self):
+        fn = Counter()
+        self.assertEqual(self.single_flight.do_async('key', fn).get_result(),
+                         ('result', False))
+        self.assertEqual(fn.calls, 1)
+        self.assertIsNotNone(self.backend.get(result_key('key')))
+        self.assertIsNone(self.backend.get(lock_key('key')))
+
+    def test_waiters_in_the_same_thread_share(self):
+        fn = Counter()
+        futures = [self.single_flight.do_async('key', fn) for i in xrange(3)]
+        results = [future.get_result() for future in futures]
+        self.assertEqual(fn.calls, 1)
+        self.assertEqual(results, [('result', False), ('result', True), ('result', True)])
+
+    def test_waiter_gets_published_result(self):
+        # somebody else, on another instance, is fetching it
+        self.backend.add(lock_key('key'), 'owner')
+        owner = singleflight.SingleFlight(backend=self.backend)
+        owner._publish_async(result_key('key'), 'theirs').get_result()
+        fn = Counter()
+        self.assertEqual(self.single_flight.do_async('key', fn).get_result(),
+                         ('theirs', True))
+        self.assertEqual(fn.calls, 0)
+
+    def test_waiter_fetches_when_owner_gives_up(self):
+        self.backend.add(lock_key('key'), 'owner')
+
+        @ndb.tasklet
+        def give_up():
+            yield ndb.sleep(0.05)
+            self.backend.delete(lock_key('key'))
+
+        fn = Counter()
+        future = self.single_flight.do_async('key', fn)
+        give_up().get_result()
+        self.assertEqual(future.get_result(), ('result', False))
+        self.assertEqual(fn.calls, 1)
+
+    def test_waiter_times_out(self):
+        # the owner died holding the lock
+        self.backend.add(lock_key('key'), 'owner')
+        fn = Counter()
+        self.assertEqual(self.single_flight.do_async('key', fn).get_result(),
+                         ('result', False))
+        self.assertEqual(fn.calls, 1)
+        # and doesn't release a lock that isn't its own
+        self.assertEqual(self.backend.get(lock_key('key')), 'owner')
+
+    def test_unshared_results_are_not_published(self):
+        fn = Counter('error')
+        futures = [self.single_flight.do_async('key', fn, share=lambda result: False)
+                   for i in xrange(2)]
+        results = [future.get_result() for future in futures]
+        self.assertEqual(results, [('error', False), ('error', False)])
+        self.assertEqual(fn.calls, 2)
+        self.assertIsNone(self.backend.get(result_key('key')))
+
+    def test_failures_release_the_lock(self):
+        @ndb.tasklet
+        def fail():
+            yield ndb.sleep(0.01)
+            raise ValueError()
+        self.assertRaises(ValueError, self.single_flight.do_async('key', fail).get_result)
+        self.assertIsNone(self.backend.get(lock_key('key')))
+        self.assertEqual(self.single_flight.do_async('key', Counter()).get_result(),
+                         ('result', False))
+
+
+class TestCoalescedFetches(AppEngineTestCase):
+    def test_same_athlete_shares(self):
+        self.transport.responses[URL] = (200, '[]')
+        arc = AuthRequestContext(make_credentials(1), athlete_id=1)
+        futures = [arc.urlfetch(URL, coalesce=True) for i in xrange(2)]
+        self.assertEqual([future.get_result().shared for future in futures],
+                         [False, True])
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_athletes_dont_share(self):
+        self.transport.responses[URL] = (200, '[]')
+        futures = [AuthRequestContext(make_credentials(athlete_id, 'token-{}'.format(athlete_id)),
+                                      athlete_id=athlete_id).urlfetch(URL, coalesce=True)
+                   for athlete_id in (1, 2)]
+        self.assertEqual([future.get_result().shared for future in futures],
+                         [False, False])
+        self.assertEqual([request['headers']['Authorization']
+                          for request in self.transport.requests],
+                         ['Bearer token-1', 'Bearer token-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
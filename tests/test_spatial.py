@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from raceways import spatial
+
+
+class TestGeohash(unittest.TestCase):
+    def test_known_hashes(self):
+        self.assertEqual(spatial.geohash(57.64911, 10.40744, 6), 'u4pruy')
+        self.assertEqual(spatial.geohash(42.6, -5.6, 5), 'ezs42')
+        self.assertEqual(spatial.geohash(37.7749, -122.4194, 5), '9q8yy')
+
+    def test_cell_bounds(self):
+        self.assertEqual(spatial.cell_bounds('s'), (0, 0, 45, 45))
+        for lat, lng in ((57.64911, 10.40744), (-33.8688, 151.2093),
+                         (37.7749, -122.4194)):
+            for precision in spatial.PRECISIONS:
+                min_lat, min_lng, max_lat, max_lng = spatial.cell_bounds(
+                    spatial.geohash(lat, lng, precision))
+                self.assertTrue(min_lat <= lat <= max_lat)
+                self.assertTrue(min_lng <= lng <= max_lng)
+
+    def test_stream_cells(self):
+        latlng = [[37.7749, -122.4194], [37.7750, -122.4195], [37.80, -122.27]]
+        cells = spatial.stream_cells(latlng)
+        self.assertEqual(cells, sorted(set(cells)))
+        for lat, lng in latlng:
+            for precision in spatial.PRECISIONS:
+                self.assertIn(spatial.geohash(lat, lng, precision), cells)
+        self.assertEqual(spatial.stream_cells([]), [])
+
+    def test_covering_cells(self):
+        bbox = (37.76, -122.43, 37.78, -122.41)
+        cells = spatial.covering_cells(*bbox)
+        self.assertTrue(0 < len(cells) <= spatial.MAX_QUERY_CELLS)
+        self.assertIn(spatial.geohash(37.77, -122.42, len(cells[0])), cells)
+        for cell in cells:
+            self.assertTrue(spatial.boxes_overlap(spatial.cell_bounds(cell), bbox))
+
+    def test_covering_cells_too_large(self):
+        self.assertEqual(spatial.covering_cells(-60, -170, 60, 170), None)
+
+    def test_parse_bbox(self):
+        self.assertEqual(spatial.parse_bbox('-122.43,37.76,-122.41,37.78'),
+                         (37.76, -122.43, 37.78, -122.41))
+        self.assertRaises(ValueError, spatial.parse_bbox, '1,2,3')
+        self.assertRaises(ValueError, spatial.parse_bbox, '-122.41,37.76,-122.43,37.78')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), ".."),]
+
+from oauth2client.client import AccessTokenRefreshError
+
+from tests.gae import AppEngineTestCase, make_credentials, TOKEN_URI
+
+from raceways import transport
+from raceways.handler import AuthRequestContext
+from raceways.singleflight import FetchedResponse
+
+URL = 'https://www.strava.com/api/v3/athlete/activities'
+
+
+def authorized(token, content='[]'):
+    """
+    A FakeTransport response that only accepts the given token.
+    """
+    def respond(request):
+        if request['headers'].get('Authorization') != 'Bearer ' + token:
+            return (401, '{"message": "Authorization Error"}')
+        return (200, content)
+    return respond
+
+
+def refreshed(token):
+    return (200, json.dumps({'access_token': token, 'expires_in': 21600}))
+
+
+class TestFakeTransport(AppEngineTestCase):
+    def test_responses(self):
+        self.transport.responses[URL] = (200, '[]')
+        response = self.transport.fetch(URL, headers={'X-Test': '1'})
+        self.assertIsInstance(response, FetchedResponse)
+        self.assertEqual((response.status_code, response.content), (200, '[]'))
+        self.assertEqual(self.transport.fetch(URL + '/missing').status_code, 404)
+        self.assertEqual([(request['url'], request['headers']) for request in self.transport.requests],
+                         [(URL, {'X-Test': '1'}), (URL + '/missing', {})])
+
+    def test_http_adapter(self):
+        self.transport.responses[URL] = FetchedResponse(201, 'created',
+                                                        {'Content-Type': 'text/plain'})
+        response, content = transport.HttpAdapter().request(URL, method='POST', body='x=1')
+        self.assertEqual((response.status, response['content-type'], content),
+                         (201, 'text/plain', 'created'))
+        self.assertEqual(self.transport.requests[0]['payload'], 'x=1')
+
+
+class TestAuthRequestContext(AppEngineTestCase):
+    def test_retries_after_refreshing(self):
+        self.transport.responses[URL] = authorized('fresh')
+        self.transport.responses[TOKEN_URI] = refreshed('fresh')
+        credentials = make_credentials(1, 'stale')
+        arc = AuthRequestContext(credentials, athlete_id=1)
+        response = arc.urlfetch(URL).get_result()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(credentials.access_token, 'fresh')
+        self.assertEqual([(request['method'], request['url']) for request in self.transport.requests],
+                         [('GET', URL), ('POST', TOKEN_URI), ('GET', URL)])
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.transport.responses[URL] = authorized('fresh')
+        self.transport.responses[TOKEN_URI] = refreshed('fresh')
+        credentials = make_credentials(1, 'expiring', expires_in=60)
+        response = AuthRequestContext(credentials, athlete_id=1).urlfetch(URL).get_result()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([request['url'] for request in self.transport.requests],
+                         [TOKEN_URI, URL])
+
+    def test_concurrent_rejections_refresh_once(self):
+        self.transport.responses[URL] = authorized('fresh')
+        self.transport.responses[TOKEN_URI] = refreshed('fresh')
+        credentials = make_credentials(1, 'stale')
+        arc = AuthRequestContext(credentials, athlete_id=1)
+        futures = [arc.urlfetch(URL) for i in xrange(3)]
+        self.assertEqual([future.get_result().status_code for future in futures],
+                         [200, 200, 200])
+        self.assertEqual([request['url'] for request in self.transport.requests].count(TOKEN_URI), 1)
+
+    def test_concurrent_rejections_without_athlete_refresh_once(self):
+        self.transport.responses[URL] = authorized('fresh')
+        self.transport.responses[TOKEN_URI] = refreshed('fresh')
+        arc = AuthRequestContext(make_credentials(None, 'stale'))
+        futures = [arc.urlfetch(URL) for i in xrange(3)]
+        self.assertEqual([future.get_result().status_code for future in futures],
+                         [200, 200, 200])
+        self.assertEqual([request['url'] for request in self.transport.requests].count(TOKEN_URI), 1)
+
+    def test_failed_refresh(self):
+        self.transport.responses[URL] = authorized('fresh')
+        self.transport.responses[TOKEN_URI] = (400, '{"error": "invalid_grant"}')
+        credentials = make_credentials(1, 'stale')
+        future = AuthRequestContext(credentials, athlete_id=1).urlfetch(URL)
+        self.assertRaises(AccessTokenRefreshError, future.get_result)
+        self.assertTrue(credentials.invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()